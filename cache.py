@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from osgeo import gdal
+
+# Bump when the cached preprocessing changes so stale entries are never reused
+CACHE_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'unsupervised_classifier_cache')
+
+DEFAULT_CACHE_MB = 2048
+
+# Output metadata item holding the fingerprint of the run that produced it
+FINGERPRINT_KEY = 'UNSUPERVISED_CLASSIFIER_FINGERPRINT'
+
+
+def file_signature(path):
+    """Absolute path, size and modification time identifying one version of a file"""
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def run_fingerprint(path, bands, method, parameters):
+    """Fingerprint of everything that determines a classified output"""
+    description = {
+        'version': CACHE_VERSION,
+        'file': file_signature(path),
+        'bands': list(bands),
+        'method': method,
+        'parameters': parameters,
+    }
+    encoded = json.dumps(description, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def output_fingerprint(output_file):
+    """Fingerprint recorded in an existing output raster, or None"""
+    if not os.path.exists(output_file):
+        return None
+    dataset = gdal.Open(output_file)
+    if dataset is None:
+        return None
+    fingerprint = dataset.GetMetadataItem(FINGERPRINT_KEY)
+    dataset = None
+    return fingerprint
+
+
+class FeatureCache:
+    """On-disk LRU cache of normalized feature matrices.
+
+    Each entry is a directory holding features.npy (loaded memory-mapped) and
+    preprocess.npz (the fitted normalization/PCA arrays), keyed by the input
+    file signature, the selected bands and the preprocessing options. Using
+    an entry refreshes its timestamp; when the cache grows past max_bytes the
+    least recently used entries are deleted.
+    """
+    def __init__(self, directory=None, max_bytes=DEFAULT_CACHE_MB * 1024 * 1024):
+        self.directory = directory or DEFAULT_CACHE_DIR
+        self.max_bytes = max_bytes
+
+    def key(self, path, bands, preprocessing):
+        """Cache key for a raster, its selected bands and the preprocessing options"""
+        description = {
+            'version': CACHE_VERSION,
+            'file': file_signature(path),
+            'bands': list(bands),
+            'preprocessing': preprocessing,
+        }
+        encoded = json.dumps(description, sort_keys=True).encode('utf-8')
+        return hashlib.sha1(encoded).hexdigest()
+
+    def load(self, key):
+        """Return (preprocessing arrays, features) for key, or None on a miss"""
+        entry = os.path.join(self.directory, key)
+        try:
+            with np.load(os.path.join(entry, 'preprocess.npz')) as arrays:
+                preprocessing = {name: arrays[name] for name in arrays.files}
+            features = np.load(os.path.join(entry, 'features.npy'), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        os.utime(entry)
+        return preprocessing, features
+
+    def store(self, key, preprocessing, features):
+        """Add an entry, evicting old ones to stay under the size cap; returns True if stored"""
+        if features.nbytes > self.max_bytes:
+            return False
+        self.evict(self.max_bytes - features.nbytes)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        # Write into a temporary directory and rename, so readers never see a partial entry
+        staging = tempfile.mkdtemp(prefix='.staging_', dir=self.directory)
+        try:
+            np.savez(os.path.join(staging, 'preprocess.npz'), **preprocessing)
+            np.save(os.path.join(staging, 'features.npy'), features)
+            entry = os.path.join(self.directory, key)
+            if os.path.exists(entry):
+                shutil.rmtree(entry, ignore_errors=True)
+            os.replace(staging, entry)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+            return False
+        return True
+
+    def entries(self):
+        """(last used time, size in bytes, path) of each entry, least recently used first"""
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for name in os.listdir(self.directory):
+            entry = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
+            size = sum(
+                os.path.getsize(os.path.join(entry, filename)) for filename in os.listdir(entry)
+            )
+            entries.append((os.path.getmtime(entry), size, entry))
+        return sorted(entries)
+
+    def evict(self, max_bytes=None):
+        """Delete least recently used entries until the cache is at most max_bytes"""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """Delete every entry"""
+        shutil.rmtree(self.directory, ignore_errors=True)
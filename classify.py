@@ -1,5 +1,11 @@
 # -*- coding: utf-8 -*-
+import importlib.util
 import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from qgis.PyQt.QtCore import QSettings, QTranslator, qVersion, QCoreApplication, Qt
 from qgis.PyQt.QtGui import QIcon
@@ -7,32 +13,40 @@ from qgis.PyQt.QtWidgets import QAction, QFileDialog, QMessageBox, QToolBar
 from qgis.core import QgsProject, QgsRasterLayer
 from osgeo import gdal, osr
 from .classify_dialog import UnsupervisedClassifierDialog
-from . import resources_rc
+from .raster_io import (ClassifiedRasterWriter, RasterWindowReader, DEFAULT_PROFILE, BLOCK_SIZE,
+                        read_feature_matrix, iter_windows, band_statistics, store_band_statistics,
+                        read_preview, build_mosaic, raster_metadata, aligned_window_rows,
+                        profile_block_rows)
+from .pipeline import (run_pipeline, map_row_chunks, limit_native_threads, native_threads_per_worker,
+                       Feedback, Cancelled)
+from .memory import ScratchSpace, MB, default_budget_mb
+from .cache import FeatureCache, FINGERPRINT_KEY, run_fingerprint, output_fingerprint
+from .instrumentation import (StageRecorder, BusyTime, format_stages, write_run_report, profiled,
+                              profiler_from_env)
 
 # Suppress all warnings
 import warnings
 warnings.filterwarnings('ignore')
 
-# Try to import sklearn (required)
-try:
-    from sklearn.cluster import AgglomerativeClustering, DBSCAN, SpectralClustering, KMeans
-    sklearn_available = True
-except ImportError:
-    sklearn_available = False
+# Check for sklearn (required) without importing it: importing scikit-learn
+# takes seconds, so the functions that use it import it when a run starts
+sklearn_available = importlib.util.find_spec('sklearn') is not None
+if not sklearn_available:
     print("Warning: scikit-learn not available. Please install it.")
 
-# Try to import scipy for distance calculations only
-try:
-    from scipy.spatial.distance import cdist
-    scipy_available = True
-except ImportError:
-    scipy_available = False
-    # Fallback to numpy-based distance calculation
-    def cdist(A, B, metric='euclidean'):
-        if metric == 'euclidean':
-            return np.sqrt(((A[:, np.newaxis, :] - B[np.newaxis, :, :]) ** 2).sum(axis=2))
-        else:
-            raise ValueError("Only euclidean metric supported in fallback")
+# scipy is used for distance calculations only, also imported on first use
+scipy_available = importlib.util.find_spec('scipy') is not None
+
+
+def cdist(A, B, metric='euclidean'):
+    """Pairwise distances between the rows of A and B, with a numpy fallback without scipy"""
+    if scipy_available:
+        from scipy.spatial.distance import cdist as scipy_cdist
+        return scipy_cdist(A, B, metric=metric)
+    if metric == 'euclidean':
+        return np.sqrt(((A[:, np.newaxis, :] - B[np.newaxis, :, :]) ** 2).sum(axis=2))
+    else:
+        raise ValueError("Only euclidean metric supported in fallback")
 
 
 class UnsupervisedClassifier:
@@ -43,12 +57,19 @@ class UnsupervisedClassifier:
         self.menu = self.tr(u'&MAS Raster Processing')
         self.toolbar = None
         self.first_start = None
+        self.report_lines = []
+        self.preview = None
+        self.preview_layer_id = None
+        self.preview_dir = None
+        self.feedback = None
 
     def tr(self, message):
         return QCoreApplication.translate('UnsupervisedClassifier', message)
 
     def initGui(self):
-        icon_path = ':/cluster.png'
+        # Loaded from the plugin folder: importing the compiled resources_rc module
+        # at plugin load cost time and kept the embedded image bytes in memory
+        icon_path = os.path.join(self.plugin_dir, 'cluster.png')
         self.toolbar = self.iface.mainWindow().findChild(QToolBar, 'MASRasterProcessingToolbar')
         if self.toolbar is None:
             self.toolbar = self.iface.addToolBar(u'MAS Raster Processing')
@@ -66,11 +87,18 @@ class UnsupervisedClassifier:
             self.iface.removeToolBarIcon(action)
         if self.toolbar:
             del self.toolbar
+        self.remove_preview_layer()
+        if self.preview_dir:
+            shutil.rmtree(self.preview_dir, ignore_errors=True)
+        if hasattr(self, 'dlg'):
+            self.dlg.metadataProber.shutdown()
 
     def run(self):
         if not hasattr(self, 'dlg'):
             self.dlg = UnsupervisedClassifierDialog(iface=self.iface, parent=self.iface.mainWindow())
             self.dlg.runButton.clicked.connect(self.run_clustering)
+            self.dlg.previewButton.clicked.connect(self.run_preview)
+            self.dlg.cancelButton.clicked.connect(self.cancel_processing)
         self.dlg.show()
         result = self.dlg.exec_()
 
@@ -86,9 +114,6 @@ class UnsupervisedClassifier:
             QMessageBox.critical(self.dlg, "Error", "scikit-learn is required but not installed. Please install it using: pip install scikit-learn")
             return
         
-        self.dlg.runButton.setEnabled(False)
-        self.dlg.runButton.setText("Processing...")
-        
         clustering_method = self.dlg.algorithmComboBox.currentText()
         num_clusters = self.dlg.numClustersSpinBox.value()
         max_iter = self.dlg.maxIterSpinBox.value()
@@ -97,68 +122,371 @@ class UnsupervisedClassifier:
         max_std = self.dlg.maxStdDoubleSpinBox.value()
         min_samples = self.dlg.minSamplesSpinBox.value()
         open_in_qgis = self.dlg.openInQgisCheckBox.isChecked()
+        options = self.dlg.get_processing_options()
+        if options.get('reuse_preview') and self.preview and self.preview['method'] == clustering_method:
+            options['initial_centers'] = self.preview['centers']
         
-        total_files = len(selected_rasters)
-        self.dlg.update_progress(0, total_files, "Starting batch processing...")
-        
-        success_count = 0
-        failed_files = []
+        # Check the memory plans before anything runs, so over-budget rasters never start unasked
+        plans, mosaic_errors = self.plan_batch(selected_rasters, clustering_method, num_clusters, options)
+        over_budget = [path for path, plan in plans.items() if not plan['fits']]
+        if over_budget and options.get('memory_policy') == 'ask':
+            details = "\n".join(f"{os.path.basename(path)}: {plans[path]['message']}" for path in over_budget[:10])
+            if len(over_budget) > 10:
+                details += f"\n... and {len(over_budget) - 10} more"
+            reply = QMessageBox.question(
+                self.dlg, "Memory Budget",
+                f"{len(over_budget)} raster(s) are expected to exceed the memory budget:\n\n{details}\n\n"
+                "Running them may exhaust the memory of this machine. Run anyway?",
+                QMessageBox.Yes | QMessageBox.No, QMessageBox.No
+            )
+            if reply != QMessageBox.Yes:
+                return
+            options['memory_policy'] = 'continue'
         
-        for idx, raster_info in enumerate(selected_rasters, start=1):
-            input_file = raster_info['input']
-            output_file = raster_info['output']
-            selected_bands = raster_info.get('bands', [])  # Get bands from the dict
-            file_name = os.path.basename(input_file)
+        self.dlg.set_batch_controls_enabled(False)
+        try:
+            self.dlg.runButton.setText("Processing...")
+            self.feedback = Feedback()
+            self.dlg.cancelButton.setEnabled(True)
             
-            self.dlg.update_progress(idx - 1, total_files, f"Processing ({idx}/{total_files}): {file_name}")
+            total_files = len(selected_rasters)
+            self.dlg.update_progress(0, total_files * 100, "Starting batch processing...")
             
-            try:
-                if not os.path.exists(input_file):
-                    failed_files.append(f"{file_name}: File not found")
-                    continue
-                
-                # Check if bands are selected
-                if not selected_bands:
-                    failed_files.append(f"{file_name}: No bands selected")
-                    continue
-                
-                output_dir = os.path.dirname(output_file)
-                if output_dir and not os.path.exists(output_dir):
-                    os.makedirs(output_dir)
+            success_count = 0
+            skipped_count = 0
+            failed_files = []
+            self.report_lines = []
+            file_reports = []
+            parameters = result_parameters(num_clusters, max_iter, max_merge, min_split_std,
+                                           max_std, min_samples, options)
+            run_started = time.time()
+            profiler = options.get('profiler') or profiler_from_env()
+            profile_files = []
+            if options.get('trace_memory'):
+                tracemalloc.start()
+            
+            for idx, raster_info in enumerate(selected_rasters, start=1):
+                if self.feedback.cancelled.is_set():
+                    break
+                input_file = raster_info['input']
+                output_file = raster_info['output']
+                selected_bands = raster_info.get('bands', [])  # Get bands from the dict
+                file_name = os.path.basename(input_file)
                 
-                success, error_msg = self.process_single_raster(
-                    input_file, output_file, clustering_method, num_clusters,
-                    selected_bands, max_iter, max_merge, min_split_std,
-                    max_std, min_samples, open_in_qgis
-                )
+                self.dlg.update_progress((idx - 1) * 100, total_files * 100, f"Processing ({idx}/{total_files}): {file_name}")
                 
-                if success:
-                    success_count += 1
-                    self.dlg.update_progress(idx, total_files, f"Completed ({idx}/{total_files}): {file_name}")
-                else:
-                    failed_files.append(f"{file_name}: {error_msg}")
+                try:
+                    if input_file in mosaic_errors:
+                        failed_files.append(f"{file_name}: {mosaic_errors[input_file]}")
+                        continue
+                    
+                    if not os.path.exists(input_file):
+                        failed_files.append(f"{file_name}: File not found")
+                        continue
+                    
+                    # Check if bands are selected
+                    if not selected_bands:
+                        failed_files.append(f"{file_name}: No bands selected")
+                        continue
+                    
+                    # The effective plan rather than the budget, which differs between machines
+                    plan = plans.get(input_file)
+                    file_parameters = parameters
+                    if plan is not None:
+                        file_parameters = dict(parameters, out_of_core=plan['out_of_core'], sample_size=plan['sample_size'])
+                    fingerprint = run_fingerprint(input_file, selected_bands, clustering_method, file_parameters)
+                    if options.get('skip_unchanged') and output_fingerprint(output_file) == fingerprint:
+                        skipped_count += 1
+                        self.dlg.update_progress(idx * 100, total_files * 100, f"Up to date ({idx}/{total_files}): {file_name}")
+                        continue
                     
-            except Exception as e:
-                failed_files.append(f"{file_name}: {str(e)}")
+                    output_dir = os.path.dirname(output_file)
+                    if output_dir and not os.path.exists(output_dir):
+                        os.makedirs(output_dir)
+                    
+                    recorder = StageRecorder()
+                    self.feedback.callback = self.progress_callback(idx, total_files, file_name)
+                    with limit_native_threads(options.get('native_threads')), recorder.stage('total'), \
+                            profiled(profiler, os.path.splitext(output_file)[0]) as written:
+                        success, error_msg = self.process_single_raster(
+                            input_file, output_file, clustering_method, num_clusters,
+                            selected_bands, max_iter, max_merge, min_split_std,
+                            max_std, min_samples, open_in_qgis, options,
+                            fingerprint=fingerprint, recorder=recorder, feedback=self.feedback,
+                            plan=plan
+                        )
+                    profile_files += written
+                    file_reports.append({
+                        'input': input_file,
+                        'tiles': len(raster_info.get('tiles', [])),
+                        'output': output_file,
+                        'success': success,
+                        'message': error_msg,
+                        'stages': recorder.stages,
+                        'profile': written,
+                    })
+                    
+                    if success:
+                        success_count += 1
+                        self.dlg.update_progress(idx * 100, total_files * 100, f"Completed ({idx}/{total_files}): {file_name}")
+                    else:
+                        failed_files.append(f"{file_name}: {error_msg}")
+                        
+                except Exception as e:
+                    failed_files.append(f"{file_name}: {str(e)}")
+        finally:
+            if options.get('trace_memory'):
+                tracemalloc.stop()
+            cancelled = self.feedback.cancelled.is_set()
+            self.feedback = None
+            self.dlg.cancelButton.setEnabled(False)
+            self.dlg.hide_progress()
+            self.dlg.set_batch_controls_enabled(True)
+            self.dlg.runButton.setText("Run Classification")
         
-        self.dlg.hide_progress()
-        self.dlg.runButton.setEnabled(True)
-        self.dlg.runButton.setText("Run Classification")
+        report_file = None
+        if options.get('run_report') and file_reports:
+            started = time.localtime(run_started)
+            report = {
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', started),
+                'wall_seconds': time.time() - run_started,
+                'method': clustering_method,
+                'parameters': parameters,
+                'skipped': skipped_count,
+                'files': file_reports,
+            }
+            report_file = os.path.join(
+                os.path.dirname(file_reports[0]['output']),
+                f"classification_report_{time.strftime('%Y%m%d_%H%M%S', started)}.json"
+            )
+            if not write_run_report(report_file, report):
+                report_file = None
         
         message = f"Successfully processed {success_count} out of {total_files} raster(s)."
+        if cancelled:
+            message += "\nProcessing was cancelled; the partial output of the raster in progress was removed."
+        if skipped_count:
+            message += f"\nSkipped {skipped_count} raster(s) with up-to-date outputs."
         if failed_files:
             message += f"\n\nFailed files:\n" + "\n".join(failed_files[:10])
             if len(failed_files) > 10:
                 message += f"\n... and {len(failed_files) - 10} more"
+        if self.report_lines:
+            message += "\n\n" + "\n".join(self.report_lines)
+        if file_reports:
+            timings = [f"{os.path.basename(r['input'])}: {format_stages(r['stages'])}" for r in file_reports[:10]]
+            message += "\n\nTimings:\n" + "\n".join(timings)
+            if len(file_reports) > 10:
+                message += f"\n... and {len(file_reports) - 10} more"
+        if report_file:
+            message += f"\n\nRun report: {report_file}"
+        if profile_files:
+            message += f"\n\nProfiles written next to the outputs ({len(profile_files)} file(s))."
         
-        if success_count > 0:
+        if cancelled:
+            QMessageBox.warning(self.dlg, "Classification Cancelled", message)
+        elif success_count + skipped_count > 0:
             QMessageBox.information(self.dlg, "Classification Complete", message)
         else:
             QMessageBox.critical(self.dlg, "Classification Failed", message)
 
+    def plan_batch(self, selected_rasters, clustering_method, num_clusters, options):
+        """Build the mosaics of a batch and plan the memory of each raster from its header.
+
+        Returns (plans, errors): the plan_memory dict of each readable raster and
+        the error of each mosaic that could not be built, both by input path.
+        """
+        plans, errors = {}, {}
+        for raster_info in selected_rasters:
+            input_file = raster_info['input']
+            if raster_info.get('tiles'):
+                success, error_msg = self.prepare_mosaic(raster_info)
+                if not success:
+                    errors[input_file] = error_msg
+                    continue
+                # The VRT may just have been rebuilt, so its cached header can be stale
+                metadata = raster_metadata(input_file)
+            else:
+                metadata = self.dlg.metadataProber.probe_now(input_file)
+            bands = [b for b in raster_info.get('bands', []) if metadata and b <= metadata['band_count']]
+            if bands:
+                plans[input_file] = run_memory_plan(
+                    metadata['ysize'], metadata['xsize'], len(bands), clustering_method, num_clusters, options,
+                    input_block_rows=metadata['block_size'][1]
+                )
+        return plans, errors
+
+    def progress_callback(self, idx, total_files, file_name):
+        """Progress callback showing the stages of file idx as a fraction of the whole batch"""
+        def report(stage, done, total):
+            start, end = STAGE_PROGRESS.get(stage, (0, 100))
+            percent = start + (end - start) * done / max(total, 1)
+            self.dlg.update_progress(
+                int((idx - 1) * 100 + percent), total_files * 100,
+                f"Processing ({idx}/{total_files}): {file_name} - {STAGE_LABELS.get(stage, stage)} {done}/{total}"
+            )
+        return report
+
+    def cancel_processing(self):
+        """Ask the running batch to stop at its next checkpoint"""
+        if self.feedback is not None:
+            self.feedback.cancel()
+            self.dlg.cancelButton.setEnabled(False)
+            self.dlg.progressLabel.setText("Cancelling...")
+
+    def run_preview(self):
+        """Classify a downsampled copy of the first selected raster and show it as a temporary layer"""
+        selected_rasters = self.dlg.get_selected_rasters()
+        if not selected_rasters:
+            QMessageBox.warning(self.dlg, "Warning", "No rasters selected. Please add and select a raster to preview.")
+            return
+        
+        if not sklearn_available:
+            QMessageBox.critical(self.dlg, "Error", "scikit-learn is required but not installed. Please install it using: pip install scikit-learn")
+            return
+        
+        raster_info = selected_rasters[0]
+        if not raster_info.get('bands'):
+            QMessageBox.warning(self.dlg, "Warning", "No bands selected for the raster to preview.")
+            return
+        
+        self.dlg.set_batch_controls_enabled(False)
+        self.dlg.previewButton.setText("Previewing...")
+        QCoreApplication.processEvents()
+        try:
+            success, message = True, ""
+            if raster_info.get('tiles'):
+                success, message = self.prepare_mosaic(raster_info)
+            if success:
+                success, message = self.process_preview(
+                    raster_info['input'], raster_info['bands'],
+                    self.dlg.algorithmComboBox.currentText(),
+                    self.dlg.numClustersSpinBox.value(),
+                    {
+                        'max_iter': self.dlg.maxIterSpinBox.value(),
+                        'max_merge': self.dlg.maxMergeDoubleSpinBox.value(),
+                        'min_split_std': self.dlg.minSplitStdDoubleSpinBox.value(),
+                        'max_std': self.dlg.maxStdDoubleSpinBox.value(),
+                        'min_samples': self.dlg.minSamplesSpinBox.value(),
+                    },
+                    self.dlg.get_processing_options()
+                )
+        except Exception as e:
+            success, message = False, str(e)
+        finally:
+            self.dlg.set_batch_controls_enabled(True)
+            self.dlg.previewButton.setText("Preview")
+        
+        self.dlg.set_preview_available(self.preview)
+        if not success:
+            QMessageBox.critical(self.dlg, "Preview Failed", message)
+
+    def prepare_mosaic(self, raster_info):
+        """Build the VRT of a mosaic entry from its tiles; returns (success, message)"""
+        vrt_dir = os.path.dirname(raster_info['input'])
+        if vrt_dir and not os.path.exists(vrt_dir):
+            os.makedirs(vrt_dir)
+        return build_mosaic(raster_info['input'], raster_info['tiles'])
+
+    def process_preview(self, input_file, selected_bands, clustering_method, num_clusters, isodata, options):
+        """Fit and classify a downsampled copy of a raster; returns (success, message).
+
+        The result is added to the project as a temporary layer replacing the
+        previous preview. Fitted centers are kept in raw band values in
+        self.preview so that a full run can start from them.
+        """
+        dataset = gdal.Open(input_file)
+        if dataset is None:
+            return False, "Could not open file"
+        valid_bands = [b for b in selected_bands if b <= dataset.RasterCount]
+        dataset = None
+        if not valid_bands:
+            return False, "No valid bands"
+        
+        if clustering_method in PREVIEW_TRANSDUCTIVE_METHODS:
+            max_pixels = PREVIEW_TRANSDUCTIVE_PIXELS
+        else:
+            max_pixels = PREVIEW_PIXELS
+        preview = read_preview(input_file, valid_bands, max_pixels)
+        data = clean_data(preview['data'], copy=False)
+        preprocessor, normalized_data = fit_preprocessor(
+            data,
+            pca_enabled=options.get('pca_enabled', False),
+            pca_components=options.get('pca_components'),
+            pca_variance=options.get('pca_variance')
+        )
+        
+        init_centers = None
+        if options.get('auto_k') and clustering_method in AUTO_K_METHODS:
+            sweep = select_num_clusters(
+                normalized_data,
+                options.get('auto_k_min', 2),
+                options.get('auto_k_max', 10),
+                criterion=options.get('auto_k_criterion', 'silhouette'),
+                n_jobs=options.get('worker_threads') or 1
+            )
+            num_clusters = sweep['k']
+            init_centers = sweep['centers']
+        
+        try:
+            predictor = fit_predictor(normalized_data, clustering_method, num_clusters, isodata,
+                                      init_centers=init_centers)
+        except ClusteringError as cluster_error:
+            return False, str(cluster_error)
+        
+        labels = predictor.predict(normalized_data).reshape(preview['ysize'], preview['xsize'])
+        out_dtype, gdal_type = output_dtype_for(predictor.max_label)
+        
+        if self.preview_dir is None:
+            self.preview_dir = tempfile.mkdtemp(prefix='unsupervised_classifier_preview_')
+        name = os.path.splitext(os.path.basename(input_file))[0]
+        k = predictor.max_label + 1
+        # A new file per preview: the previous one may still be held open by its layer
+        preview_file = os.path.join(self.preview_dir, f"{name}_{int(time.time() * 1000)}.tif")
+        writer = ClassifiedRasterWriter(
+            preview_file, preview['xsize'], preview['ysize'], gdal_type,
+            preview['geotransform'], preview['projection'], profile='GeoTIFF (Uncompressed)'
+        )
+        writer.write(labels.astype(out_dtype))
+        writer.close()
+        
+        self.remove_preview_layer()
+        layer = QgsRasterLayer(preview_file, f"Preview - {name} ({clustering_method}, k={k})")
+        if not layer.isValid():
+            return False, "Could not load the preview layer"
+        QgsProject.instance().addMapLayer(layer)
+        self.preview_layer_id = layer.id()
+        
+        # Only methods with cluster centers can seed a full run
+        centers = predictor.fitted_centers
+        if centers is not None:
+            self.preview = {
+                'method': clustering_method,
+                'k': k,
+                'centers': preprocessor.inverse_transform(centers),
+            }
+        else:
+            self.preview = None
+        return True, "Success"
+
+    def remove_preview_layer(self):
+        """Remove the current preview layer from the project, if any"""
+        if self.preview_layer_id and QgsProject.instance().mapLayer(self.preview_layer_id):
+            QgsProject.instance().removeMapLayer(self.preview_layer_id)
+        self.preview_layer_id = None
+
     def process_single_raster(self, input_file, output_file, clustering_method, num_clusters,
                              selected_bands, max_iter, max_merge, min_split_std,
-                             max_std, min_samples, open_in_qgis):
+                             max_std, min_samples, open_in_qgis, options=None, fingerprint=None,
+                             recorder=None, feedback=None, plan=None):
+        options = options or {}
+        recorder = recorder or StageRecorder()
+        isodata = {
+            'max_iter': max_iter, 'max_merge': max_merge, 'min_split_std': min_split_std,
+            'max_std': max_std, 'min_samples': min_samples,
+        }
+        scratch = ScratchSpace(options.get('scratch_dir'), enabled=options.get('out_of_core', False))
+        worker_threads = options.get('worker_threads') or os.cpu_count() or 1
         try:
             sat_dataset = gdal.Open(input_file)
             if sat_dataset is None:
@@ -170,57 +498,160 @@ class UnsupervisedClassifier:
             if not valid_bands:
                 return False, f"No valid bands (file has {actual_band_count} bands)"
             
-            bands_data = [sat_dataset.GetRasterBand(i).ReadAsArray().astype(float) for i in valid_bands]
+            nrows, ncols = sat_dataset.RasterYSize, sat_dataset.RasterXSize
+            preprocessing = {
+                'pca_enabled': options.get('pca_enabled', False),
+                'pca_components': options.get('pca_components'),
+                'pca_variance': options.get('pca_variance'),
+                'band_stats': options.get('use_band_stats', False),
+            }
+            
+            # Size the run to the RAM budget before anything large is allocated
+            if plan is None:
+                plan = run_memory_plan(
+                    nrows, ncols, len(valid_bands), clustering_method, num_clusters, options,
+                    input_block_rows=sat_dataset.GetRasterBand(valid_bands[0]).GetBlockSize()[1]
+                )
+            if not plan['fits']:
+                # Over-budget runs go ahead only once the user has confirmed them
+                if options.get('memory_policy') != 'continue':
+                    return False, plan['message']
+                self.report_lines.append(f"{os.path.basename(input_file)}: Warning: {plan['message']}")
+            if plan['out_of_core'] and not scratch.enabled:
+                scratch.enabled = True
+                self.report_lines.append(
+                    f"{os.path.basename(input_file)}: switched to out-of-core processing to fit the memory budget"
+                )
+            
+            cache, cache_key, cached = None, None, None
+            if options.get('cache_enabled'):
+                cache = FeatureCache(options.get('cache_dir'), options.get('cache_mb', 2048) * 1024 * 1024)
+                cache_key = cache.key(input_file, valid_bands, preprocessing)
+                with recorder.stage('cache_load'):
+                    cached = cache.load(cache_key)
             
-            nrows, ncols = bands_data[0].shape
-            reshaped_data = np.stack(bands_data, axis=-1).reshape(-1, len(valid_bands))
-            reshaped_data = clean_data(reshaped_data)
-            normalized_data = normalize_data(reshaped_data)
+            if cached is not None:
+                preprocessor = Preprocessor.from_arrays(cached[0])
+                reshaped_data = normalized_data = cached[1]
+            else:
+                with recorder.stage('read'):
+                    reshaped_data = read_feature_matrix(
+                        input_file, valid_bands,
+                        n_threads=options.get('read_threads'),
+                        postprocess=lambda block: clean_data(block, copy=False),
+                        out=scratch.empty((nrows * ncols, len(valid_bands)), np.float64, 'features'),
+                        feedback=feedback
+                    )
+                with recorder.stage('normalize'):
+                    stats = None
+                    if preprocessing['band_stats']:
+                        stats = band_statistics(input_file, valid_bands)
+                        if stats is None:
+                            # Save what the matrix in memory gives for the next run, rather than
+                            # having GDAL scan the file again
+                            stats = normalization_stats(reshaped_data)
+                            minimum, maximum = value_range(reshaped_data)
+                            store_band_statistics(input_file, valid_bands, minimum, maximum, stats[0],
+                                                  np.where(maximum > minimum, stats[1], 0))
+                    preprocessor, normalized_data = fit_preprocessor(
+                        reshaped_data, scratch=scratch, stats=stats,
+                        pca_enabled=preprocessing['pca_enabled'],
+                        pca_components=preprocessing['pca_components'],
+                        pca_variance=preprocessing['pca_variance']
+                    )
+                if cache is not None:
+                    with recorder.stage('cache_store'):
+                        cache.store(cache_key, preprocessor.to_arrays(), normalized_data)
+            
+            init_centers = None
+            initial_centers = options.get('initial_centers')
+            if initial_centers is not None and initial_centers.shape[1] == len(valid_bands):
+                # Centroids from a preview, given in raw band values
+                init_centers = preprocessor.transform(np.array(initial_centers, dtype=np.float64))
+                num_clusters = init_centers.shape[0]
+            elif options.get('auto_k') and clustering_method in AUTO_K_METHODS:
+                with recorder.stage('select_k'):
+                    sweep = select_num_clusters(
+                        normalized_data,
+                        options.get('auto_k_min', 2),
+                        options.get('auto_k_max', 10),
+                        criterion=options.get('auto_k_criterion', 'silhouette'),
+                        n_jobs=worker_threads,
+                        feedback=feedback
+                    )
+                num_clusters = sweep['k']
+                init_centers = sweep['centers']
+                self.report_lines.append(f"{os.path.basename(input_file)}:\n{format_k_sweep(sweep)}")
             
             try:
-                if clustering_method == 'Kmeans (Best Method)':
-                    model = KMeans(n_clusters=num_clusters, n_init=10, max_iter=300, random_state=42)
-                    labels = model.fit_predict(normalized_data)
-                        
-                elif clustering_method == 'ISODATA (Time Taking)':
-                    labels = isodata_clustering(normalized_data, num_clusters, max_iter, 
-                                               max_merge, min_split_std, max_std, min_samples)
-                        
-                elif clustering_method == 'Agglomerative Clustering':
-                    if reshaped_data.shape[0] > 10000:
-                        return False, "Dataset too large for Agglomerative Clustering (>10k pixels)"
-                    model = AgglomerativeClustering(n_clusters=num_clusters)
-                    labels = model.fit_predict(normalized_data)
-                    
-                elif clustering_method == 'DBSCAN':
-                    model = DBSCAN(eps=0.5, min_samples=5)
-                    labels = model.fit_predict(normalized_data)
-                    unique_labels = np.unique(labels)
-                    if len(unique_labels) < 2:
-                        return False, "DBSCAN failed to find sufficient clusters"
-                    labels = np.where(labels == -1, len(unique_labels), labels)
-                    
-                elif clustering_method == 'Spectral Clustering':
-                    if reshaped_data.shape[0] > 10000:
-                        return False, "Dataset too large for Spectral Clustering (>10k pixels)"
-                    model = SpectralClustering(n_clusters=num_clusters, random_state=42)
-                    labels = model.fit_predict(normalized_data)
-                else:
-                    return False, f"Unknown clustering method: {clustering_method}"
-                    
+                with recorder.stage('fit'):
+                    predictor = fit_predictor(
+                        normalized_data, clustering_method, num_clusters, isodata,
+                        init_centers=init_centers, scratch=scratch, n_threads=worker_threads,
+                        sample_size=plan['sample_size'], feedback=feedback
+                    )
+            except Cancelled:
+                raise
+            except ClusteringError as cluster_error:
+                return False, str(cluster_error)
             except Exception as cluster_error:
                 return False, f"Clustering error: {str(cluster_error)}"
 
-            clustered_image = labels.reshape(nrows, ncols).astype(np.uint8)
+            out_dtype, gdal_type = output_dtype_for(predictor.max_label)
+            
+            writer = ClassifiedRasterWriter(
+                output_file, ncols, nrows, gdal_type,
+                sat_dataset.GetGeoTransform(), sat_dataset.GetProjection(),
+                profile=options.get('output_profile', DEFAULT_PROFILE)
+            )
+            
+            if predictor.is_inductive and cached is None and scratch.enabled:
+                # Out of core: free the feature matrix and stream tiles back from the input,
+                # prefetched by the pipeline's reader thread while the workers label earlier ones
+                reshaped_data = normalized_data = None
+                reader = RasterWindowReader(input_file, valid_bands)
+            else:
+                # Label slices of the feature matrix (or cached features) already at hand
+                reader = None
+            
+            # The pipeline stages overlap, so their busy time is recorded separately
+            busy = BusyTime()
+            
+            def read(window):
+                if not reader:
+                    return None
+                with busy.measure('read'):
+                    return reader.read(*window)
             
-            driver = gdal.GetDriverByName('GTiff')
-            out_dataset = driver.Create(output_file, ncols, nrows, 1, gdal.GDT_Byte)
-            out_dataset.SetGeoTransform(sat_dataset.GetGeoTransform())
-            out_dataset.SetProjection(sat_dataset.GetProjection())
-            out_band = out_dataset.GetRasterBand(1)
-            out_band.WriteArray(clustered_image)
-            out_band.FlushCache()
-            out_dataset = None
+            def compute(window, block):
+                yoff, rows = window
+                start = yoff * ncols
+                with busy.measure('predict'):
+                    if reader:
+                        block = preprocessor.transform(block)
+                    else:
+                        block = normalized_data[start:start + rows * ncols]
+                    return predictor.predict(block, start).reshape(rows, ncols).astype(out_dtype)
+            
+            def write(window, labels):
+                with busy.measure('write'):
+                    writer.write(labels, 0, window[0])
+            
+            try:
+                with recorder.stage('classify') as stage:
+                    run_pipeline(
+                        iter_windows(nrows, plan['window_rows']), read, compute, write,
+                        n_workers=worker_threads, feedback=feedback
+                    )
+                    stage['busy_seconds'] = busy.seconds
+            except Exception:
+                writer.abort()
+                raise
+            finally:
+                if reader:
+                    reader.close()
+            with recorder.stage('finalize'):
+                writer.close(metadata={FINGERPRINT_KEY: fingerprint} if fingerprint else None)
             sat_dataset = None
 
             if open_in_qgis:
@@ -229,45 +660,806 @@ class UnsupervisedClassifier:
 
             return True, "Success"
 
+        except Cancelled:
+            # A partially written output has already been deleted by writer.abort()
+            return False, "Cancelled"
         except Exception as e:
             return False, str(e)
+        finally:
+            reshaped_data = normalized_data = None
+            scratch.close()
+
+
+# Options that change the classified output (threading, caching and scratch settings do not)
+RESULT_OPTION_KEYS = (
+    'pca_enabled', 'pca_components', 'pca_variance',
+    'auto_k', 'auto_k_min', 'auto_k_max', 'auto_k_criterion', 'use_band_stats',
+    'output_profile', 'initial_centers',
+)
+
+
+def result_parameters(num_clusters, max_iter, max_merge, min_split_std, max_std, min_samples, options):
+    """Parameters of a run that determine its output, for the run fingerprint"""
+    parameters = {
+        'num_clusters': num_clusters,
+        'max_iter': max_iter,
+        'max_merge': max_merge,
+        'min_split_std': min_split_std,
+        'max_std': max_std,
+        'min_samples': min_samples,
+    }
+    for key in RESULT_OPTION_KEYS:
+        value = options.get(key)
+        parameters[key] = value.tolist() if isinstance(value, np.ndarray) else value
+    return parameters
+
+
+# Methods that can use an automatically selected number of clusters
+AUTO_K_METHODS = ('Kmeans (Best Method)', 'ISODATA (Time Taking)', 'Gaussian Mixture')
+
+# Criteria for automatic cluster selection and whether higher scores are better
+K_CRITERIA = {
+    'elbow': None,
+    'silhouette': True,
+    'calinski_harabasz': True,
+    'bic': False,
+}
+
+GMM_SAMPLE_SIZE = 200000
+
+# EM iterations of a Gaussian mixture fit, as in scikit-learn, and how many run per progress step
+GMM_MAX_ITER = 100
+GMM_ITER_BLOCK = 5
+
+# Lloyd iterations of a K-means fit and their relative convergence tolerance, as in scikit-learn
+KMEANS_MAX_ITER = 300
+KMEANS_TOL = 1e-4
+
+# Rows on which the k-means++ seedings of a K-means fit are refined and compared
+KMEANS_SEED_SAMPLE = 20000
+
+# Pixel budget of a preview; methods without out-of-sample prediction get a smaller one
+PREVIEW_PIXELS = 250000
+PREVIEW_TRANSDUCTIVE_PIXELS = 10000
+PREVIEW_TRANSDUCTIVE_METHODS = ('Agglomerative Clustering', 'DBSCAN', 'Spectral Clustering')
+
+# Share of a file's progress bar span covered by each stage (start and end percent)
+STAGE_PROGRESS = {
+    'read': (0, 30),
+    'select_k': (30, 40),
+    'fit': (40, 50),
+    'isodata': (50, 60),
+    'write': (60, 100),
+}
 
+STAGE_LABELS = {
+    'read': "reading tiles",
+    'select_k': "selecting the number of clusters",
+    'fit': "fitting",
+    'isodata': "ISODATA round",
+    'write': "writing tiles",
+}
 
-def clean_data(data):
+# Shares of the RAM budget for the tiles in flight and for the Gaussian mixture training sample
+TILE_BUDGET_FRACTION = 0.25
+SAMPLE_BUDGET_FRACTION = 0.25
+
+# Above this many clusters K-means runs a single k-means++ initialisation
+LARGE_K = 50
+
+# Output label types, smallest first: (max label, numpy dtype, GDAL type)
+OUTPUT_TYPES = (
+    (np.iinfo(np.uint8).max, np.uint8, gdal.GDT_Byte),
+    (np.iinfo(np.uint16).max, np.uint16, gdal.GDT_UInt16),
+    (np.iinfo(np.uint32).max, np.uint32, gdal.GDT_UInt32),
+)
+
+
+def clean_data(data, copy=True):
     """Clean data by replacing NaN and infinite values"""
-    return np.nan_to_num(data, nan=0.0, posinf=0.0, neginf=0.0)
+    return np.nan_to_num(data, copy=copy, nan=0.0, posinf=0.0, neginf=0.0)
+
 
+def normalization_stats(data, chunk_size=65536):
+    """Per-band mean and standard deviation for z-score normalization.
 
-def normalize_data(data):
-    """Normalize data using standardization (z-score)"""
-    std = np.std(data, axis=0)
+    Computed in two chunked passes so no full-size temporary is created,
+    which also lets the data be a memory-mapped scratch array.
+    """
+    n_rows = data.shape[0]
+    total = np.zeros(data.shape[1])
+    for rows in iter_chunks(n_rows, chunk_size):
+        total += data[rows].sum(axis=0)
+    mean = total / n_rows
+    squares = np.zeros(data.shape[1])
+    for rows in iter_chunks(n_rows, chunk_size):
+        squares += ((data[rows] - mean) ** 2).sum(axis=0)
+    std = np.sqrt(squares / n_rows)
     std[std == 0] = 1  # Avoid division by zero
-    mean = np.mean(data, axis=0)
-    normalized = (data - mean) / std
-    return normalized
+    return mean, std
+
+
+def value_range(data, chunk_size=65536):
+    """Per-band minimum and maximum, computed chunk-wise"""
+    minimum = np.full(data.shape[1], np.inf)
+    maximum = np.full(data.shape[1], -np.inf)
+    for rows in iter_chunks(data.shape[0], chunk_size):
+        minimum = np.minimum(minimum, data[rows].min(axis=0))
+        maximum = np.maximum(maximum, data[rows].max(axis=0))
+    return minimum, maximum
+
+
+class Preprocessor:
+    """Cleaning, z-score normalization and optional PCA fitted on one raster.
+
+    Once fitted, transform() applies the same preprocessing to any block of raw
+    pixels, so tiles read after the fit are labelled consistently.
+    """
+    def __init__(self, mean, std, components=None, pca_mean=None):
+        self.mean = mean
+        self.std = std
+        self.components = components
+        self.pca_mean = pca_mean
+
+    def transform(self, block):
+        """Return the preprocessed features for a (pixels, bands) block of raw values"""
+        block = clean_data(block, copy=False)
+        block -= self.mean
+        block /= self.std
+        if self.components is not None:
+            block = transform_pca(block, self.components, self.pca_mean)
+        return block
+
+    def inverse_transform(self, features):
+        """Map rows of preprocessed features (e.g. cluster centers) back to raw band values"""
+        raw = np.array(features, dtype=np.float64)
+        if self.components is not None:
+            raw = raw @ self.components + self.pca_mean
+        return raw * self.std + self.mean
+
+    def to_arrays(self):
+        """Plain arrays describing the preprocessing, e.g. for np.savez"""
+        arrays = {'mean': self.mean, 'std': self.std}
+        if self.components is not None:
+            arrays['components'] = self.components
+            arrays['pca_mean'] = self.pca_mean
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Rebuild a preprocessor from to_arrays() output"""
+        return cls(arrays['mean'], arrays['std'], arrays.get('components'), arrays.get('pca_mean'))
+
+
+def fit_preprocessor(data, pca_enabled=False, pca_components=None, pca_variance=None, scratch=None,
+                     stats=None):
+    """Fit the preprocessing on a cleaned feature matrix; returns (preprocessor, normalized data).
+
+    The matrix is normalized in place to avoid another full-scene copy. The
+    PCA projection, if any, is allocated from scratch when given. stats, if
+    given, is a precomputed (mean, std) pair that replaces the statistics pass.
+    """
+    if stats is not None:
+        mean, std = stats
+        std = np.where(std == 0, 1, std)
+    else:
+        mean, std = normalization_stats(data)
+    for rows in iter_chunks(data.shape[0], 65536):
+        data[rows] -= mean
+        data[rows] /= std
+    normalized = data
+    components, pca_mean = None, None
+    if pca_enabled and data.shape[1] > 1:
+        pca, n_keep = fit_pca(normalized, pca_components, pca_variance)
+        if n_keep < data.shape[1]:
+            components, pca_mean = pca.components_[:n_keep], pca.mean_
+            out = scratch.empty((data.shape[0], n_keep), data.dtype, 'pca') if scratch else None
+            normalized = transform_pca(normalized, components, pca_mean, out=out)
+    return Preprocessor(mean, std, components, pca_mean), normalized
+
+
+def output_dtype_for(max_label):
+    """Return the smallest (numpy dtype, GDAL type) that can hold labels up to max_label"""
+    for limit, dtype, gdal_type in OUTPUT_TYPES:
+        if max_label <= limit:
+            return dtype, gdal_type
+    raise ValueError(f"Too many classes for the output raster: {max_label + 1}")
+
+
+def method_memory(method, n_pixels, n_features, num_clusters, out_of_core=False, sample_size=GMM_SAMPLE_SIZE,
+                  n_threads=1):
+    """Estimated working memory in bytes for fitting method, not counting the feature matrix"""
+    n, d, k = n_pixels, n_features, num_clusters
+    if method in ('Kmeans (Best Method)', 'ISODATA (Time Taking)'):
+        # Distance buffers of the assign_labels chunks in flight, one per thread
+        chunk_rows = min(n, label_chunk_rows(k))
+        n_chunks = -(-n // max(chunk_rows, 1))
+        buffers = min(n_threads, n_chunks) * chunk_rows * (k + 1) * 8
+        if out_of_core:
+            # Mini-batch chunks and the initialisation sample
+            estimate = 2 * max(65536, k * 100) * (d + k) * 8
+            if method == 'ISODATA (Time Taking)':
+                estimate += buffers
+        else:
+            # int64 labels, the distance buffers, and the k-means++ seeding sample with its labels
+            sample = min(n, max(KMEANS_SEED_SAMPLE, k * 100))
+            estimate = n * 8 + buffers + sample * (d + 1) * 8 + 2 * k * d * 8
+        return estimate
+    if method == 'Gaussian Mixture':
+        sample = min(n, sample_size)
+        return sample * (d + 3 * k) * 8
+    if method == 'Agglomerative Clustering':
+        # Condensed pairwise distance matrix
+        return n * (n - 1) // 2 * 8 + n * d * 8
+    if method == 'Spectral Clustering':
+        # Dense affinity matrix, its Laplacian and a working copy
+        return 3 * n * n * 8
+    if method == 'DBSCAN':
+        # scikit-learn keeps the index list of every point's eps-neighbourhood; on dense
+        # clusters these approach one entry per pixel pair, so bound them like a pairwise
+        # matrix, plus the neighbour tree over a copy of the data
+        return n * n * 8 + n * (2 * d * 8 + 16)
+    return 0
+
+
+def plan_memory(nrows, ncols, n_bands, method, num_clusters, budget_bytes, out_of_core=False,
+                pca=False, n_workers=1, queue_size=4, input_block_rows=1, output_block_rows=BLOCK_SIZE):
+    """Estimate the peak memory of a run and size it to fit budget_bytes.
+
+    Returns a dict with the pipeline window height (window_rows), the Gaussian
+    mixture sample size (sample_size), whether to use out-of-core scratch
+    arrays (out_of_core, switched on when that brings an in-memory run under
+    budget), the estimated peak_bytes, and fits/message saying whether the
+    run is expected to stay within the budget. Estimates are upper bounds of
+    the dominant allocations, not exact figures. The window height is lined
+    up with the input and output blocks (see aligned_window_rows).
+    """
+    n_pixels = nrows * ncols
+    inductive = method not in PREVIEW_TRANSDUCTIVE_METHODS
+    
+    # Each pixel in flight holds raw values, features, per-cluster scores and labels
+    in_flight = 2 * queue_size + n_workers + 1
+    row_bytes = ncols * 8 * (2 * n_bands + 2 * num_clusters + 2)
+    fitting_rows = int(budget_bytes * TILE_BUDGET_FRACTION // (row_bytes * in_flight))
+    window_rows = aligned_window_rows(
+        min(max(BLOCK_SIZE, input_block_rows), fitting_rows), output_block_rows, input_block_rows
+    )
+    tiles = window_rows * row_bytes * in_flight
+    
+    sample_budget = int(budget_bytes * SAMPLE_BUDGET_FRACTION // ((n_bands + 3 * num_clusters) * 8))
+    sample_size = max(num_clusters * 10, min(GMM_SAMPLE_SIZE, sample_budget))
+    
+    def peak(scratch):
+        features = 0 if scratch else n_pixels * n_bands * 8 * (2 if pca else 1)
+        fit = method_memory(method, n_pixels, n_bands, num_clusters, scratch, sample_size, n_workers)
+        if inductive:
+            # The fit's working memory is freed before the tiles are classified from the
+            # feature matrix (out of core, from the input itself)
+            return features + max(fit, tiles)
+        return features + fit + tiles
+    
+    peak_bytes = peak(out_of_core)
+    if peak_bytes > budget_bytes and inductive and not out_of_core and peak(True) < peak_bytes:
+        out_of_core = True
+        peak_bytes = peak(True)
+    
+    fits = peak_bytes <= budget_bytes
+    message = "" if fits else (
+        f"{method} on {n_pixels} pixels needs an estimated {peak_bytes / MB:.0f} MB, "
+        f"over the {budget_bytes / MB:.0f} MB memory budget"
+    )
+    return {
+        'window_rows': window_rows,
+        'sample_size': sample_size,
+        'out_of_core': out_of_core,
+        'peak_bytes': peak_bytes,
+        'fits': fits,
+        'message': message,
+    }
+
+
+def run_memory_plan(nrows, ncols, n_bands, method, num_clusters, options, input_block_rows=1):
+    """plan_memory for a raster classified with the given run options"""
+    if options.get('initial_centers') is not None:
+        planned_k = len(options['initial_centers'])
+    elif options.get('auto_k') and method in AUTO_K_METHODS:
+        planned_k = max(num_clusters, options.get('auto_k_max', 10))
+    else:
+        planned_k = num_clusters
+    return plan_memory(
+        nrows, ncols, n_bands, method, planned_k,
+        (options.get('memory_budget_mb') or default_budget_mb()) * MB,
+        out_of_core=options.get('out_of_core', False), pca=options.get('pca_enabled', False),
+        n_workers=options.get('worker_threads') or os.cpu_count() or 1,
+        input_block_rows=input_block_rows,
+        output_block_rows=profile_block_rows(options.get('output_profile', DEFAULT_PROFILE))
+    )
+
+
+def kmeans_n_init(num_clusters):
+    """Number of K-means initialisations, reduced for large k where each run is expensive"""
+    return 10 if num_clusters <= LARGE_K else 1
+
+
+def label_chunk_rows(n_centers):
+    """Rows per assign_labels chunk, keeping its (rows, k) distance buffer near 64 MB"""
+    return max(1024, (64 * 1024 * 1024) // (8 * n_centers))
+
+
+def assign_labels(data, centers, chunk_size=None, out=None, n_threads=1):
+    """Assign each row of data to its nearest center.
+
+    Uses the expansion |x - c|^2 = |x|^2 - 2 x.c + |c|^2 so that the heavy work
+    is a single matrix product per chunk; |x|^2 is constant per row and is
+    dropped. The chunk size bounds the (rows, k) distance buffer to ~64 MB,
+    which keeps large k (thousands of clusters) tractable. Chunks are
+    spread over n_threads threads.
+    """
+    centers = np.asarray(centers, dtype=data.dtype)
+    if chunk_size is None:
+        chunk_size = label_chunk_rows(centers.shape[0])
+    if out is None:
+        out = np.empty(data.shape[0], dtype=np.int64)
+    half_sq_norms = 0.5 * np.einsum('ij,ij->i', centers, centers)
+    
+    def assign_chunk(rows):
+        scores = data[rows] @ centers.T
+        scores -= half_sq_norms
+        out[rows] = np.argmax(scores, axis=1)
+    
+    map_row_chunks(assign_chunk, data.shape[0], chunk_size, n_threads)
+    return out
+
+
+def fit_kmeans_chunked(data, num_clusters, init=None, chunk_size=65536, n_epochs=3, random_state=42,
+                       feedback=None):
+    """Fit K-means one chunk at a time with mini-batch updates and return the centers.
+
+    Used for out-of-core runs: the (possibly memory-mapped) matrix is streamed
+    in chunks, in a shuffled order each epoch, instead of being scanned by
+    every Lloyd iteration. The centers are initialised on a random sample.
+    feedback, if given, receives a 'fit' step per chunk.
+    """
+    from sklearn.cluster import MiniBatchKMeans
+    rng = np.random.default_rng(random_state)
+    model = MiniBatchKMeans(
+        n_clusters=num_clusters,
+        init=init if init is not None else 'k-means++',
+        batch_size=chunk_size,
+        random_state=random_state
+    )
+    model.partial_fit(sample_rows(data, max(chunk_size, num_clusters * 100), random_state))
+    chunks = list(iter_chunks(data.shape[0], chunk_size))
+    for epoch in range(n_epochs):
+        for step, i in enumerate(rng.permutation(len(chunks)), start=1):
+            model.partial_fit(data[chunks[i]])
+            if feedback is not None:
+                feedback.report('fit', epoch * len(chunks) + step, n_epochs * len(chunks))
+    return model.cluster_centers_
+
+
+def fit_kmeans(data, num_clusters, init=None, n_init=1, max_iter=KMEANS_MAX_ITER, tol=KMEANS_TOL,
+               n_threads=1, random_state=42, labels=None, feedback=None):
+    """Fit K-means with Lloyd iterations and return (centers, labels).
+
+    Without init, n_init k-means++ seedings are refined on a sample of the
+    rows and the one with the lowest inertia starts the run on all rows.
+    Iterations stop once the centers move by less than tol times the mean
+    feature variance. labels, if given, is the buffer the labels are written
+    to. feedback, if given, receives a 'fit' step per iteration.
+    """
+    from sklearn.cluster import kmeans_plusplus
+    sample = sample_rows(data, max(KMEANS_SEED_SAMPLE, num_clusters * 100), random_state)
+    threshold = tol * np.mean(np.var(sample, axis=0))
+    if init is None:
+        best = None
+        for seed in range(n_init):
+            centers, _ = kmeans_plusplus(sample, num_clusters, random_state=random_state + seed)
+            centers, sample_labels = lloyd_iterations(sample, centers, max_iter, threshold, n_threads=n_threads)
+            score = inertia(sample, centers, sample_labels)
+            if best is None or score < best[0]:
+                best = (score, centers)
+            if feedback is not None:
+                feedback.check()
+        init = best[1]
+    return lloyd_iterations(data, init, max_iter, threshold, labels=labels, n_threads=n_threads,
+                            feedback=feedback)
+
+
+def lloyd_iterations(data, centers, max_iter, threshold, labels=None, n_threads=1, feedback=None):
+    """Move centers to the mean of their rows until the squared shift is at most threshold.
+
+    A center left without rows stays where it was. Returns (centers, labels)
+    with the labels of the final centers. feedback, if given, receives a
+    'fit' step per iteration.
+    """
+    centers = np.array(centers, dtype=np.float64)
+    for iteration in range(1, max_iter + 1):
+        labels = assign_labels(data, centers, out=labels, n_threads=n_threads)
+        counts, means = cluster_means(data, labels, len(centers))
+        empty = counts == 0
+        means[empty] = centers[empty]
+        shift = np.sum((means - centers) ** 2)
+        centers = means
+        if feedback is not None:
+            feedback.report('fit', iteration, max_iter)
+        if shift <= threshold:
+            break
+    return centers, assign_labels(data, centers, out=labels, n_threads=n_threads)
+
 
+def inertia(data, centers, labels, chunk_size=65536):
+    """Sum of squared distances of the rows to their centers"""
+    total = 0.0
+    for rows in iter_chunks(data.shape[0], chunk_size):
+        difference = data[rows] - centers[labels[rows]]
+        total += np.einsum('ij,ij->', difference, difference)
+    return total
 
-def isodata_clustering(data, num_clusters, max_iter, max_merge, min_split_std, max_std, min_samples):
-    """ISODATA clustering algorithm using sklearn KMeans"""
+
+def cluster_means(data, labels, n_labels, chunk_size=65536):
+    """Per-label pixel counts and means, accumulated chunk-wise"""
+    counts = np.zeros(n_labels, dtype=np.int64)
+    sums = np.zeros((n_labels, data.shape[1]))
+    for rows in iter_chunks(data.shape[0], chunk_size):
+        block, block_labels = data[rows], labels[rows]
+        counts += np.bincount(block_labels, minlength=n_labels)
+        for j in range(data.shape[1]):
+            sums[:, j] += np.bincount(block_labels, weights=block[:, j], minlength=n_labels)
+    return counts, sums / np.maximum(counts, 1)[:, np.newaxis]
+
+
+def cluster_statistics(data, labels, n_labels, chunk_size=65536):
+    """Per-label pixel counts, means and standard deviations, accumulated chunk-wise"""
+    n_features = data.shape[1]
+    counts, means = cluster_means(data, labels, n_labels, chunk_size)
+    squares = np.zeros((n_labels, n_features))
+    for rows in iter_chunks(data.shape[0], chunk_size):
+        block, block_labels = data[rows], labels[rows]
+        for j in range(n_features):
+            deviation = block[:, j] - means[block_labels, j]
+            squares[:, j] += np.bincount(block_labels, weights=deviation ** 2, minlength=n_labels)
+    stds = np.sqrt(squares / np.maximum(counts, 1)[:, np.newaxis])
+    return counts, means, stds
+
+
+class LabelPredictor:
+    """Label blocks of feature rows once a clustering model has been fitted.
+
+    Centroid methods (K-means, ISODATA) assign rows to the nearest center,
+    models with a predict method (Gaussian mixture) delegate to it, and
+    methods without out-of-sample prediction (Agglomerative, DBSCAN,
+    Spectral) slice the labels computed during the fit.
+    """
+    def __init__(self, centers=None, model=None, labels=None):
+        self.centers = None if centers is None else np.asarray(centers)
+        self.model = model
+        self.labels = labels
+
+    @property
+    def is_inductive(self):
+        """Whether the predictor can label pixels it was not fitted on"""
+        return self.labels is None
+
+    @property
+    def max_label(self):
+        """Largest label the predictor can produce"""
+        if self.centers is not None:
+            return self.centers.shape[0] - 1
+        if self.model is not None:
+            return self.model.n_components - 1
+        return int(self.labels.max())
+
+    @property
+    def fitted_centers(self):
+        """Cluster centers in feature space (K-means/ISODATA centers, mixture means), or None"""
+        if self.centers is not None:
+            return self.centers
+        return getattr(self.model, 'means_', None)
+
+    def predict(self, block, start=0):
+        """Return labels for block, the feature rows starting at row start"""
+        if self.centers is not None:
+            return assign_labels(block, self.centers)
+        if self.model is not None:
+            return self.model.predict(block)
+        return self.labels[start:start + block.shape[0]]
+
+
+class ClusteringError(Exception):
+    """A clustering method cannot be applied to the data"""
+
+
+def fit_predictor(data, method, num_clusters, isodata, init_centers=None, scratch=None, n_threads=1,
+                  sample_size=GMM_SAMPLE_SIZE, feedback=None):
+    """Fit a clustering method on normalized features and return its LabelPredictor.
+
+    isodata holds the ISODATA parameters (max_iter, max_merge, min_split_std,
+    max_std, min_samples). init_centers, if given, seeds K-means, ISODATA and
+    the Gaussian mixture means, which are fitted on sample_size rows. Raises
+    ClusteringError when the method cannot handle the data. feedback, if
+    given, receives progress per K-means iteration, chunk, mixture EM
+    iteration or ISODATA round; the other scikit-learn fits only report
+    when they start.
+    """
+    if feedback is not None:
+        feedback.report('fit', 0, 1)
+    if method == 'Kmeans (Best Method)':
+        if scratch is not None and scratch.enabled:
+            return LabelPredictor(centers=fit_kmeans_chunked(data, num_clusters, init=init_centers,
+                                                             feedback=feedback))
+        centers, _ = fit_kmeans(data, num_clusters, init=init_centers, n_init=kmeans_n_init(num_clusters),
+                                n_threads=n_threads, feedback=feedback)
+        return LabelPredictor(centers=centers)
+    
+    if method == 'ISODATA (Time Taking)':
+        centroids = isodata_centroids(data, num_clusters, isodata['max_iter'], isodata['max_merge'],
+                                      isodata['min_split_std'], isodata['max_std'], isodata['min_samples'],
+                                      scratch=scratch, n_threads=n_threads, init=init_centers,
+                                      feedback=feedback)
+        return LabelPredictor(centers=centroids)
+    
+    if method == 'Agglomerative Clustering':
+        from sklearn.cluster import AgglomerativeClustering
+        model = AgglomerativeClustering(n_clusters=num_clusters)
+        return LabelPredictor(labels=model.fit_predict(data))
+    
+    if method == 'DBSCAN':
+        from sklearn.cluster import DBSCAN
+        model = DBSCAN(eps=0.5, min_samples=5)
+        labels = model.fit_predict(data)
+        unique_labels = np.unique(labels)
+        if len(unique_labels) < 2:
+            raise ClusteringError("DBSCAN failed to find sufficient clusters")
+        labels = np.where(labels == -1, len(unique_labels), labels)
+        return LabelPredictor(labels=labels)
+    
+    if method == 'Spectral Clustering':
+        from sklearn.cluster import SpectralClustering
+        model = SpectralClustering(n_clusters=num_clusters, random_state=42)
+        return LabelPredictor(labels=model.fit_predict(data))
+    
+    if method == 'Gaussian Mixture':
+        from sklearn.exceptions import ConvergenceWarning
+        from sklearn.mixture import GaussianMixture
+        # A few EM iterations per fit call, so that progress and cancellation are checked
+        # in between without the extra E-step of every call weighing on each iteration
+        model = GaussianMixture(n_components=num_clusters, means_init=init_centers, random_state=42,
+                                warm_start=True, max_iter=GMM_ITER_BLOCK)
+        sample = sample_rows(data, sample_size)
+        lower_bound = -np.inf
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', ConvergenceWarning)
+            for iteration in range(GMM_ITER_BLOCK, GMM_MAX_ITER + 1, GMM_ITER_BLOCK):
+                model.fit(sample)
+                if feedback is not None:
+                    feedback.report('fit', iteration, GMM_MAX_ITER)
+                if model.converged_ or abs(model.lower_bound_ - lower_bound) < model.tol:
+                    break
+                lower_bound = model.lower_bound_
+        return LabelPredictor(model=model)
+    
+    raise ClusteringError(f"Unknown clustering method: {method}")
+
+
+def iter_chunks(n_rows, chunk_size):
+    """Yield row slices covering n_rows in blocks of chunk_size"""
+    for start in range(0, n_rows, chunk_size):
+        yield slice(start, min(start + chunk_size, n_rows))
+
+
+def sample_rows(data, sample_size, random_state=42):
+    """Return a random subset of rows (or all rows if the data is small enough)"""
+    if sample_size is None or data.shape[0] <= sample_size:
+        return data
+    rng = np.random.default_rng(random_state)
+    indices = np.sort(rng.choice(data.shape[0], size=sample_size, replace=False))
+    return data[indices]
+
+
+def fit_pca(data, n_components=None, variance_threshold=None, sample_size=100000, chunk_size=65536):
+    """Fit an incremental PCA on a pixel sample.
+
+    Keeps n_components components, or the smallest number of components whose
+    cumulative explained variance reaches variance_threshold (0-1).
+    Returns the fitted model and the number of components to keep.
+    """
+    from sklearn.decomposition import IncrementalPCA
+    n_features = data.shape[1]
+    sample = sample_rows(data, sample_size)
+    batch_size = max(chunk_size, n_features)
+    pca = IncrementalPCA(n_components=n_features, batch_size=batch_size)
+    pca.fit(sample)
+    
+    if n_components:
+        n_keep = min(int(n_components), n_features)
+    elif variance_threshold:
+        cumulative = np.cumsum(pca.explained_variance_ratio_)
+        n_keep = int(np.searchsorted(cumulative, variance_threshold) + 1)
+        n_keep = min(n_keep, n_features)
+    else:
+        n_keep = n_features
+    return pca, n_keep
+
+
+def transform_pca(data, components, mean, chunk_size=65536, out=None):
+    """Project data onto (n_keep, bands) principal components, one chunk at a time"""
+    n_keep = components.shape[0]
+    projected = out if out is not None else np.empty((data.shape[0], n_keep), dtype=data.dtype)
+    for rows in iter_chunks(data.shape[0], chunk_size):
+        projected[rows] = (data[rows] - mean) @ components.T
+    return projected
+
+
+def farthest_point(data, centers):
+    """Return the row of data farthest from its nearest center"""
+    distances = cdist(data, centers, metric='euclidean').min(axis=1)
+    return data[np.argmax(distances)]
+
+
+def elbow_index(k_values, inertias):
+    """Pick the elbow of an inertia curve as the point farthest from the first-last chord"""
+    if len(k_values) < 3:
+        return 0
+    x = np.asarray(k_values, dtype=float)
+    y = np.asarray(inertias, dtype=float)
+    x = (x - x[0]) / (x[-1] - x[0])
+    y = (y - y[-1]) / max(y[0] - y[-1], 1e-12)
+    # Distance from each point to the line from (0, 1) to (1, 0)
+    distances = np.abs(x + y - 1) / np.sqrt(2)
+    return int(np.argmax(distances))
+
+
+def score_k(sample, labels, centers, criterion, silhouette_size=5000, random_state=42):
+    """Score a single k of the sweep with the sampled cluster validity indices"""
+    from sklearn.metrics import silhouette_score, calinski_harabasz_score
+    start = time.perf_counter()
+    scores = {'silhouette': None, 'calinski_harabasz': None, 'bic': None}
+    if len(np.unique(labels)) > 1:
+        scores['silhouette'] = float(silhouette_score(
+            sample, labels, sample_size=min(silhouette_size, sample.shape[0]), random_state=random_state))
+        scores['calinski_harabasz'] = float(calinski_harabasz_score(sample, labels))
+    if criterion == 'bic':
+        from sklearn.mixture import GaussianMixture
+        gmm = GaussianMixture(n_components=len(centers), means_init=centers, random_state=random_state)
+        gmm.fit(sample)
+        scores['bic'] = float(gmm.bic(sample))
+    scores['score_seconds'] = time.perf_counter() - start
+    return scores
+
+
+def select_num_clusters(data, k_min=2, k_max=10, criterion='silhouette', sample_size=20000,
+                        batch_size=4096, n_jobs=None, random_state=42, feedback=None):
+    """Sweep k over a pixel sample and pick the best number of clusters.
+
+    Each k is fitted with mini-batch K-means warm-started from the previous k's
+    centers plus the farthest sample point; the scoring of all k values then
+    runs in parallel. Returns a dict with the chosen k, its centers (usable as
+    init for the full-raster fit) and per-k scores and timings. feedback, if
+    given, receives a 'select_k' step per fitted k.
+    """
+    if criterion not in K_CRITERIA:
+        raise ValueError(f"Unknown cluster selection criterion: {criterion}")
+    from sklearn.cluster import MiniBatchKMeans
+    
+    sweep_start = time.perf_counter()
+    sample = sample_rows(data, sample_size, random_state)
+    k_max = min(k_max, sample.shape[0] - 1)
+    k_values = list(range(max(2, k_min), k_max + 1))
+    if not k_values:
+        raise ValueError("Not enough pixels to select the number of clusters")
+    
+    fits = []
+    centers = None
+    for i, k in enumerate(k_values):
+        if feedback is not None:
+            feedback.report('select_k', i, len(k_values))
+        start = time.perf_counter()
+        if centers is None:
+            model = MiniBatchKMeans(n_clusters=k, batch_size=batch_size, n_init=3, random_state=random_state)
+        else:
+            init = np.vstack([centers, farthest_point(sample, centers)])
+            model = MiniBatchKMeans(n_clusters=k, init=init, batch_size=batch_size, n_init=1,
+                                    random_state=random_state)
+        labels = model.fit_predict(sample)
+        centers = model.cluster_centers_
+        fits.append({
+            'k': k,
+            'labels': labels,
+            'centers': centers,
+            'inertia': float(model.inertia_),
+            'fit_seconds': time.perf_counter() - start,
+        })
+    
+    n_jobs = n_jobs or os.cpu_count() or 1
+    with limit_native_threads(native_threads_per_worker(n_jobs)):
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            all_scores = list(executor.map(
+                lambda fit: score_k(sample, fit['labels'], fit['centers'], criterion, random_state=random_state),
+                fits
+            ))
+    
+    results = []
+    for fit, scores in zip(fits, all_scores):
+        result = {key: value for key, value in fit.items() if key not in ('labels', 'centers')}
+        result.update(scores)
+        results.append(result)
+    
+    if criterion == 'elbow':
+        best = elbow_index(k_values, [r['inertia'] for r in results])
+    else:
+        values = [r[criterion] for r in results]
+        if all(v is None for v in values):
+            best = 0
+        else:
+            higher_is_better = K_CRITERIA[criterion]
+            fill = -np.inf if higher_is_better else np.inf
+            values = np.array([fill if v is None else v for v in values])
+            best = int(np.argmax(values) if higher_is_better else np.argmin(values))
+    
+    return {
+        'k': k_values[best],
+        'centers': fits[best]['centers'],
+        'criterion': criterion,
+        'scores': results,
+        'total_seconds': time.perf_counter() - sweep_start,
+    }
+
+
+def format_k_sweep(sweep):
+    """Format the scores and timings of a k sweep as readable text"""
+    lines = [f"  Selected k={sweep['k']} by {sweep['criterion']} ({sweep['total_seconds']:.1f}s)"]
+    for r in sweep['scores']:
+        parts = [f"k={r['k']}", f"inertia={r['inertia']:.1f}"]
+        if r['silhouette'] is not None:
+            parts.append(f"silhouette={r['silhouette']:.3f}")
+        if r['calinski_harabasz'] is not None:
+            parts.append(f"CH={r['calinski_harabasz']:.1f}")
+        if r['bic'] is not None:
+            parts.append(f"BIC={r['bic']:.1f}")
+        parts.append(f"{r['fit_seconds'] + r['score_seconds']:.2f}s")
+        lines.append("  " + ", ".join(parts))
+    return "\n".join(lines)
+
+
+def isodata_centroids(data, num_clusters, max_iter, max_merge, min_split_std, max_std, min_samples,
+                      scratch=None, n_threads=1, init=None, feedback=None):
+    """Run ISODATA merge/split rounds on top of KMeans and return the final centroids.
+
+    With a scratch space the initial K-means is fitted chunk-wise and the label
+    buffer is allocated from it, so memory-mapped inputs are never loaded whole.
+    init, if given, replaces the k-means++ initialisation of the first K-means.
+    feedback, if given, receives an 'isodata' step per merge/split round.
+    """
+    from sklearn.cluster import KMeans
+    if init is not None:
+        num_clusters = len(init)
     try:
         # Initial clustering using KMeans
-        model = KMeans(n_clusters=num_clusters, n_init=10, max_iter=max_iter, random_state=42)
-        labels = model.fit_predict(data)
-        centroids = model.cluster_centers_
+        labels = scratch.empty(data.shape[0], np.int32, 'labels') if scratch else None
+        if scratch and scratch.enabled:
+            centroids = fit_kmeans_chunked(data, num_clusters, init=init, feedback=feedback)
+            labels = assign_labels(data, centroids, out=labels, n_threads=n_threads)
+        else:
+            centroids, labels = fit_kmeans(data, num_clusters, init=init, n_init=kmeans_n_init(num_clusters),
+                                           max_iter=max_iter, n_threads=n_threads, labels=labels,
+                                           feedback=feedback)
         
         # ISODATA iterations
-        for iteration in range(min(max_iter // 10, 10)):  # Limit ISODATA iterations
-            unique_labels = np.unique(labels)
+        n_rounds = min(max_iter // 10, 10)  # Limit ISODATA iterations
+        for iteration in range(n_rounds):
+            if feedback is not None:
+                feedback.report('isodata', iteration, n_rounds)
+            counts, means, stds = cluster_statistics(data, labels, len(centroids))
             cluster_stats = []
             
-            for label in unique_labels:
-                cluster_points = data[labels == label]
-                if len(cluster_points) >= min_samples:
+            for label in np.flatnonzero(counts):
+                if counts[label] >= min_samples:
                     cluster_stats.append({
                         'label': label,
-                        'mean': np.mean(cluster_points, axis=0),
-                        'std': np.std(cluster_points, axis=0),
-                        'size': len(cluster_points)
+                        'mean': means[label],
+                        'std': stds[label],
+                        'size': counts[label]
                     })
             
             if not cluster_stats:
@@ -313,18 +1505,20 @@ def isodata_clustering(data, num_clusters, max_iter, max_merge, min_split_std, m
             
             # Reassign labels based on new centroids
             centroids = np.array(final_centroids)
-            distances = cdist(data, centroids, metric='euclidean')
-            labels = np.argmin(distances, axis=1)
+            labels = assign_labels(data, centroids, out=labels if scratch else None, n_threads=n_threads)
             
             # Stop if we have enough clusters
             if len(final_centroids) >= num_clusters:
                 break
         
-        return labels
+        return centroids
         
+    except Cancelled:
+        raise
     except Exception as e:
         print(f"ISODATA error: {str(e)}, falling back to standard KMeans")
         # Fallback to standard KMeans
-        model = KMeans(n_clusters=num_clusters, n_init=10, max_iter=max_iter, random_state=42)
-        labels = model.fit_predict(data)
-        return labels
+        model = KMeans(n_clusters=num_clusters, n_init=kmeans_n_init(num_clusters),
+                       max_iter=max_iter, random_state=42)
+        model.fit(data)
+        return model.cluster_centers_
@@ -2,25 +2,91 @@
 from PyQt5.QtWidgets import (QDialog, QVBoxLayout, QComboBox, QSpinBox, QGroupBox, 
                              QFormLayout, QLabel, QDoubleSpinBox, QListWidget, QPushButton, 
                              QListWidgetItem, QLineEdit, QFileDialog, QCheckBox, QHBoxLayout,
-                             QTableWidget, QTableWidgetItem, QHeaderView, QWidget, QProgressBar)
-from PyQt5.QtCore import Qt
-from osgeo import gdal
+                             QTableView, QAbstractItemView, QHeaderView, QProgressBar)
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, QObject, pyqtSignal
+from concurrent.futures import ThreadPoolExecutor
+import importlib.util
 import os
+import threading
 from qgis.core import QgsProject, QgsRasterLayer
+from .raster_io import (OUTPUT_PROFILES, DEFAULT_PROFILE, RASTER_PATTERNS, default_threads,
+                        find_rasters, raster_metadata)
+from .cache import FeatureCache, DEFAULT_CACHE_MB
+from .instrumentation import PROFILE_ENV
+from .memory import default_budget_mb
 
-# Check for sklearn availability
-try:
-    from sklearn.cluster import AgglomerativeClustering, DBSCAN, SpectralClustering
-    sklearn_available = True
-except ImportError:
-    sklearn_available = False
+# Check for sklearn availability without importing it (slow; only needed when a run starts)
+sklearn_available = importlib.util.find_spec('sklearn') is not None
+
+
+# Default output file name of a mosaic of the checked rasters
+DEFAULT_MOSAIC_NAME = "mosaic_classified.tif"
+
+# Background threads probing raster headers; opening files on network shares is I/O bound
+METADATA_THREADS = 4
+
+
+class MetadataProber(QObject):
+    """Read raster metadata on background threads and cache it per path.
+
+    probed is emitted with (path, metadata) on the GUI thread when a probe
+    finishes; metadata is the raster_metadata dict, or None if the file could
+    not be opened. The cache is shared by the raster table and the band
+    selection dialog, so each file is opened once per session.
+    """
+    probed = pyqtSignal(str, object)
+    
+    def __init__(self, n_threads=METADATA_THREADS, parent=None):
+        super().__init__(parent)
+        self.cache = {}
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix='raster_metadata')
+    
+    def get(self, path):
+        """Cached metadata of path, None if not probed yet or unreadable"""
+        with self.lock:
+            return self.cache.get(path)
+    
+    def request(self, paths):
+        """Probe paths in the background; cached ones are reported straight away"""
+        with self.lock:
+            cached = [(path, self.cache[path]) for path in paths if path in self.cache]
+            queued = [path for path in paths if path not in self.cache and path not in self.pending]
+            self.pending.update(queued)
+        for path, metadata in cached:
+            self.probed.emit(path, metadata)
+        for path in queued:
+            self.executor.submit(self._probe, path)
+    
+    def probe_now(self, path):
+        """Metadata of path, probed on the calling thread if it is not cached"""
+        with self.lock:
+            if path in self.cache:
+                return self.cache[path]
+        metadata = raster_metadata(path)
+        with self.lock:
+            self.cache[path] = metadata
+        return metadata
+    
+    def _probe(self, path):
+        metadata = raster_metadata(path)
+        with self.lock:
+            self.cache[path] = metadata
+            self.pending.discard(path)
+        self.probed.emit(path, metadata)
+    
+    def shutdown(self):
+        """Drop queued probes; running ones finish in the background"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
 
 
 class BandSelectionDialog(QDialog):
     """Dialog for selecting bands for a specific raster"""
-    def __init__(self, raster_path, parent=None):
+    def __init__(self, raster_path, parent=None, metadata=None):
         super().__init__(parent)
         self.raster_path = raster_path
+        self.metadata = metadata
         self.setWindowTitle(f"Select Bands - {os.path.basename(raster_path)}")
         self.setMinimumWidth(400)
         self.setMinimumHeight(300)
@@ -67,23 +133,17 @@ class BandSelectionDialog(QDialog):
             item.setCheckState(Qt.Checked)
     
     def load_bands(self):
-        """Load bands from the raster file"""
+        """Load bands from the raster metadata, reading the file only if none was given"""
         self.bandListWidget.clear()
-        if os.path.exists(self.raster_path):
-            try:
-                dataset = gdal.Open(self.raster_path)
-                if dataset:
-                    num_bands = dataset.RasterCount
-                    for i in range(1, num_bands + 1):
-                        band = dataset.GetRasterBand(i)
-                        description = band.GetDescription() or f"Band {i}"
-                        item = QListWidgetItem(description)
-                        item.setCheckState(Qt.Checked)
-                        item.setData(Qt.UserRole, i)  # Store band number
-                        self.bandListWidget.addItem(item)
-                    dataset = None
-            except Exception as e:
-                print(f"Error loading bands: {e}")
+        if self.metadata is None and os.path.exists(self.raster_path):
+            self.metadata = raster_metadata(self.raster_path)
+        if self.metadata is None:
+            return
+        for i, description in enumerate(self.metadata['descriptions'], start=1):
+            item = QListWidgetItem(description)
+            item.setCheckState(Qt.Checked)
+            item.setData(Qt.UserRole, i)  # Store band number
+            self.bandListWidget.addItem(item)
     
     def select_all(self):
         """Select all bands"""
@@ -105,6 +165,163 @@ class BandSelectionDialog(QDialog):
         return selected
 
 
+class RasterTableModel(QAbstractTableModel):
+    """Rasters queued for batch processing, one dict per row.
+
+    Each row holds the input path, display name, output file name, checked
+    state and metadata (None until probed); paths maps each input path to its
+    row so duplicates are rejected in constant time, and the band selection of
+    each input is kept in band_selections (input path -> list of band numbers),
+    defaulting to all bands once the metadata arrives.
+    """
+    COLUMNS = ["Select", "Raster Name", "Output File Name", "Selected Bands"]
+    SELECT, NAME, OUTPUT, BANDS = range(4)
+    
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows = []
+        self.paths = {}
+        self.band_selections = {}
+    
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+    
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+    
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.COLUMNS[section]
+        return super().headerData(section, orientation, role)
+    
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self.rows[index.row()]
+        column = index.column()
+        if role == Qt.CheckStateRole and column == self.SELECT:
+            return Qt.Checked if row['checked'] else Qt.Unchecked
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            if column == self.NAME:
+                return row['name']
+            if column == self.OUTPUT:
+                return row['output']
+            if column == self.BANDS:
+                if row['input'] not in self.band_selections:
+                    return "Reading..."
+                return f"{len(self.band_selections[row['input']])} bands ..."
+        if role == Qt.ToolTipRole and column in (self.NAME, self.BANDS):
+            return self.describe(row)
+        if role == Qt.UserRole:
+            return row['input']
+        return None
+    
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        if index.column() == self.SELECT:
+            flags |= Qt.ItemIsUserCheckable
+        elif index.column() == self.OUTPUT:
+            flags |= Qt.ItemIsEditable
+        return flags
+    
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid():
+            return False
+        row = self.rows[index.row()]
+        if role == Qt.CheckStateRole and index.column() == self.SELECT:
+            row['checked'] = value == Qt.Checked
+        elif role == Qt.EditRole and index.column() == self.OUTPUT:
+            value = str(value).strip()
+            if not value:
+                return False
+            row['output'] = value
+        else:
+            return False
+        self.dataChanged.emit(index, index, [role])
+        return True
+    
+    def describe(self, row):
+        """Tooltip text: the input path plus size, bands, data type and nodata when known"""
+        metadata = row['metadata']
+        if metadata is None:
+            return row['input']
+        nodata = sorted({value for value in metadata['nodata'] if value is not None})
+        text = (f"{row['input']}\n{metadata['xsize']} x {metadata['ysize']} pixels, "
+                f"{metadata['band_count']} bands, {metadata['dtype']}")
+        if nodata:
+            text += f", nodata {', '.join(f'{value:g}' for value in nodata)}"
+        return text
+    
+    def add_rasters(self, paths):
+        """Append the existing, not yet listed rasters in paths; returns the new paths"""
+        new_rows = []
+        first = len(self.rows)
+        for path in paths:
+            if not path or path in self.paths or not os.path.exists(path):
+                continue
+            self.paths[path] = first + len(new_rows)
+            base_name = os.path.splitext(os.path.basename(path))[0]
+            new_rows.append({
+                'input': path,
+                'name': base_name,
+                'output': f"{base_name}_classified.tif",
+                'checked': True,
+                'metadata': None,
+            })
+        
+        if new_rows:
+            self.beginInsertRows(QModelIndex(), first, first + len(new_rows) - 1)
+            self.rows.extend(new_rows)
+            self.endInsertRows()
+        return [row['input'] for row in new_rows]
+    
+    def set_metadata(self, path, metadata):
+        """Fill in the probed metadata of a listed raster; all bands are selected by default"""
+        row = self.paths.get(path)
+        if row is None:
+            return
+        self.rows[row]['metadata'] = metadata
+        if path not in self.band_selections:
+            band_count = metadata['band_count'] if metadata else 0
+            self.band_selections[path] = list(range(1, band_count + 1))
+        self.dataChanged.emit(self.index(row, self.NAME), self.index(row, self.BANDS),
+                              [Qt.DisplayRole, Qt.ToolTipRole])
+    
+    def remove_checked(self):
+        """Remove the checked rows and their band selections; returns the number removed"""
+        kept = [row for row in self.rows if not row['checked']]
+        removed = len(self.rows) - len(kept)
+        if removed:
+            self.beginResetModel()
+            for row in self.rows:
+                if row['checked']:
+                    self.band_selections.pop(row['input'], None)
+            self.rows = kept
+            self.paths = {row['input']: i for i, row in enumerate(kept)}
+            self.endResetModel()
+        return removed
+    
+    def set_all_checked(self, checked):
+        """Check or uncheck every row"""
+        for row in self.rows:
+            row['checked'] = checked
+        if self.rows:
+            self.dataChanged.emit(self.index(0, self.SELECT), self.index(len(self.rows) - 1, self.SELECT),
+                                  [Qt.CheckStateRole])
+    
+    def checked_rows(self):
+        """Row dicts of the checked rasters, in table order"""
+        return [row for row in self.rows if row['checked']]
+    
+    def set_bands(self, row, bands):
+        """Store the band selection of a row"""
+        self.band_selections[self.rows[row]['input']] = bands
+        index = self.index(row, self.BANDS)
+        self.dataChanged.emit(index, index, [Qt.DisplayRole])
+
+
 class UnsupervisedClassifierDialog(QDialog):
     def __init__(self, iface, parent=None):
         super().__init__(parent)
@@ -116,24 +333,28 @@ class UnsupervisedClassifierDialog(QDialog):
         
         self.layout = QVBoxLayout(self)
         
-        # Store band selections for each raster
-        self.band_selections = {}
-        
         # ===== RASTER LAYERS TABLE SECTION =====
         self.rasterTableLabel = QLabel("Raster Layers for Batch Processing:", self)
         self.layout.addWidget(self.rasterTableLabel)
         
-        # Create table for raster layers - 4 columns
-        self.rasterTable = QTableWidget(self)
-        self.rasterTable.setColumnCount(4)
-        self.rasterTable.setHorizontalHeaderLabels(["Select", "Raster Name", "Output File Name", "Selected Bands"])
+        # Raster metadata is read in the background and shared by the table and band dialogs
+        self.metadataProber = MetadataProber(parent=self)
+        
+        # Table for raster layers - 4 columns, backed by a model so large batches stay responsive
+        self.rasterModel = RasterTableModel(self)
+        self.metadataProber.probed.connect(self.rasterModel.set_metadata)
+        # Store band selections for each raster
+        self.band_selections = self.rasterModel.band_selections
+        self.rasterTable = QTableView(self)
+        self.rasterTable.setModel(self.rasterModel)
+        self.rasterTable.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.rasterTable.setEditTriggers(QAbstractItemView.DoubleClicked | QAbstractItemView.EditKeyPressed)
         self.rasterTable.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeToContents)
         self.rasterTable.horizontalHeader().setSectionResizeMode(1, QHeaderView.Stretch)
         self.rasterTable.horizontalHeader().setSectionResizeMode(2, QHeaderView.Stretch)
         self.rasterTable.horizontalHeader().setSectionResizeMode(3, QHeaderView.ResizeToContents)
         self.rasterTable.setMinimumHeight(150)
-        self.rasterTable.setRowCount(0)
-        self.rasterTable.cellClicked.connect(self.table_cell_clicked)
+        self.rasterTable.clicked.connect(self.table_cell_clicked)
         self.layout.addWidget(self.rasterTable)
         
         # Auto-populate from loaded layers
@@ -174,6 +395,38 @@ class UnsupervisedClassifierDialog(QDialog):
         self.inputFileLayout.addWidget(self.inputFileButton)
         self.layout.addLayout(self.inputFileLayout)
         
+        # Folder selection (rasters matching the patterns, optionally in subfolders)
+        self.inputFolderLabel = QLabel("Add Input Rasters from Folder:", self)
+        self.layout.addWidget(self.inputFolderLabel)
+        
+        self.inputPatternLineEdit = QLineEdit(RASTER_PATTERNS, self)
+        self.inputPatternLineEdit.setToolTip("File name patterns separated by spaces or semicolons, e.g. *.tif *_B*.jp2")
+        self.recursiveCheckBox = QCheckBox("Include subfolders", self)
+        self.inputFolderButton = QPushButton("Folder...", self)
+        self.inputFolderButton.setMaximumWidth(100)
+        self.inputFolderButton.clicked.connect(self.select_input_folder)
+        
+        self.inputFolderLayout = QHBoxLayout()
+        self.inputFolderLayout.addWidget(self.inputPatternLineEdit)
+        self.inputFolderLayout.addWidget(self.recursiveCheckBox)
+        self.inputFolderLayout.addWidget(self.inputFolderButton)
+        self.layout.addLayout(self.inputFolderLayout)
+        
+        # Mosaic: classify the checked rasters as one virtual raster with one model
+        self.mosaicCheckBox = QCheckBox("Classify checked rasters as one mosaic (VRT)", self)
+        self.mosaicCheckBox.setToolTip(
+            "Build a GDAL VRT of all checked rasters next to the output and classify it as one raster.\n"
+            "The rasters must share band count, data type and projection; the bands of the first are used."
+        )
+        self.mosaicCheckBox.stateChanged.connect(self.toggle_mosaic)
+        self.mosaicNameLineEdit = QLineEdit(DEFAULT_MOSAIC_NAME, self)
+        self.mosaicNameLineEdit.setEnabled(False)
+        
+        self.mosaicLayout = QHBoxLayout()
+        self.mosaicLayout.addWidget(self.mosaicCheckBox)
+        self.mosaicLayout.addWidget(self.mosaicNameLineEdit)
+        self.layout.addLayout(self.mosaicLayout)
+        
         # ===== OUTPUT FOLDER SECTION =====
         self.outputFolderLabel = QLabel("Output Folder:", self)
         self.layout.addWidget(self.outputFolderLabel)
@@ -193,6 +446,14 @@ class UnsupervisedClassifierDialog(QDialog):
         self.sameAsInputCheckBox.stateChanged.connect(self.toggle_output_folder)
         self.layout.addWidget(self.sameAsInputCheckBox)
         
+        # Output format
+        self.outputProfileLabel = QLabel("Output Format:", self)
+        self.layout.addWidget(self.outputProfileLabel)
+        self.outputProfileComboBox = QComboBox(self)
+        self.outputProfileComboBox.addItems(list(OUTPUT_PROFILES))
+        self.outputProfileComboBox.setCurrentText(DEFAULT_PROFILE)
+        self.layout.addWidget(self.outputProfileComboBox)
+        
         # Algorithm selection
         self.algorithmLabel = QLabel("Select Clustering Method:", self)
         self.layout.addWidget(self.algorithmLabel)
@@ -204,17 +465,47 @@ class UnsupervisedClassifierDialog(QDialog):
             self.algorithmComboBox.addItem("Agglomerative Clustering")
             self.algorithmComboBox.addItem("DBSCAN")
             self.algorithmComboBox.addItem("Spectral Clustering")
+            self.algorithmComboBox.addItem("Gaussian Mixture")
         
         self.layout.addWidget(self.algorithmComboBox)
         
         # Number of clusters
         self.numClustersSpinBox = QSpinBox(self)
         self.numClustersSpinBox.setMinimum(2)
-        self.numClustersSpinBox.setMaximum(10)
+        self.numClustersSpinBox.setMaximum(10000)
         self.numClustersSpinBox.setValue(5)
         self.numClustersSpinBox.setPrefix("Number of Clusters: ")
         self.layout.addWidget(self.numClustersSpinBox)
         
+        # Automatic selection of the number of clusters
+        self.autoKGroupBox = QGroupBox("Automatic Number of Clusters", self)
+        self.autoKGroupBox.setCheckable(True)
+        self.autoKGroupBox.setChecked(False)
+        self.autoKGroupBox.toggled.connect(self.numClustersSpinBox.setDisabled)
+        self.autoKLayout = QFormLayout(self.autoKGroupBox)
+        
+        self.autoKMinLabel = QLabel("Min Clusters", self)
+        self.autoKMinSpinBox = QSpinBox(self)
+        self.autoKMinSpinBox.setRange(2, 1000)
+        self.autoKMinSpinBox.setValue(2)
+        self.autoKLayout.addRow(self.autoKMinLabel, self.autoKMinSpinBox)
+        
+        self.autoKMaxLabel = QLabel("Max Clusters", self)
+        self.autoKMaxSpinBox = QSpinBox(self)
+        self.autoKMaxSpinBox.setRange(2, 1000)
+        self.autoKMaxSpinBox.setValue(10)
+        self.autoKLayout.addRow(self.autoKMaxLabel, self.autoKMaxSpinBox)
+        
+        self.autoKCriterionLabel = QLabel("Criterion", self)
+        self.autoKCriterionComboBox = QComboBox(self)
+        self.autoKCriterionComboBox.addItem("Silhouette", "silhouette")
+        self.autoKCriterionComboBox.addItem("Calinski-Harabasz", "calinski_harabasz")
+        self.autoKCriterionComboBox.addItem("Elbow (Inertia)", "elbow")
+        self.autoKCriterionComboBox.addItem("BIC (Gaussian Mixture)", "bic")
+        self.autoKLayout.addRow(self.autoKCriterionLabel, self.autoKCriterionComboBox)
+        
+        self.layout.addWidget(self.autoKGroupBox)
+        
         # ISODATA options
         self.isodataOptionsGroupBox = QGroupBox("ISODATA Options", self)
         self.isodataOptionsLayout = QFormLayout(self.isodataOptionsGroupBox)
@@ -251,10 +542,156 @@ class UnsupervisedClassifierDialog(QDialog):
         
         self.layout.addWidget(self.isodataOptionsGroupBox)
         
+        # Band reduction (PCA) options
+        self.pcaGroupBox = QGroupBox("Band Reduction (PCA)", self)
+        self.pcaGroupBox.setCheckable(True)
+        self.pcaGroupBox.setChecked(False)
+        self.pcaLayout = QFormLayout(self.pcaGroupBox)
+        
+        self.pcaModeLabel = QLabel("Keep", self)
+        self.pcaModeComboBox = QComboBox(self)
+        self.pcaModeComboBox.addItem("Explained Variance")
+        self.pcaModeComboBox.addItem("Number of Components")
+        self.pcaModeComboBox.currentIndexChanged.connect(self.toggle_pca_mode)
+        self.pcaLayout.addRow(self.pcaModeLabel, self.pcaModeComboBox)
+        
+        self.pcaVarianceLabel = QLabel("Explained Variance (%)", self)
+        self.pcaVarianceDoubleSpinBox = QDoubleSpinBox(self)
+        self.pcaVarianceDoubleSpinBox.setRange(50.0, 100.0)
+        self.pcaVarianceDoubleSpinBox.setValue(95.0)
+        self.pcaLayout.addRow(self.pcaVarianceLabel, self.pcaVarianceDoubleSpinBox)
+        
+        self.pcaComponentsLabel = QLabel("Components", self)
+        self.pcaComponentsSpinBox = QSpinBox(self)
+        self.pcaComponentsSpinBox.setRange(1, 1000)
+        self.pcaComponentsSpinBox.setValue(3)
+        self.pcaLayout.addRow(self.pcaComponentsLabel, self.pcaComponentsSpinBox)
+        
+        self.layout.addWidget(self.pcaGroupBox)
+        self.toggle_pca_mode()
+        
+        # Performance options
+        self.performanceGroupBox = QGroupBox("Performance", self)
+        self.performanceLayout = QFormLayout(self.performanceGroupBox)
+        
+        self.readThreadsLabel = QLabel("Read Threads", self)
+        self.readThreadsSpinBox = QSpinBox(self)
+        self.readThreadsSpinBox.setRange(1, 64)
+        self.readThreadsSpinBox.setValue(default_threads())
+        self.performanceLayout.addRow(self.readThreadsLabel, self.readThreadsSpinBox)
+        
+        self.workerThreadsLabel = QLabel("Worker Threads", self)
+        self.workerThreadsSpinBox = QSpinBox(self)
+        self.workerThreadsSpinBox.setRange(1, 256)
+        self.workerThreadsSpinBox.setValue(os.cpu_count() or 1)
+        self.performanceLayout.addRow(self.workerThreadsLabel, self.workerThreadsSpinBox)
+        
+        self.nativeThreadsLabel = QLabel("Native Threads (BLAS/OpenMP)", self)
+        self.nativeThreadsSpinBox = QSpinBox(self)
+        self.nativeThreadsSpinBox.setRange(1, 256)
+        self.nativeThreadsSpinBox.setValue(os.cpu_count() or 1)
+        self.nativeThreadsSpinBox.setToolTip(
+            "Total threads for scikit-learn/NumPy native code per job. "
+            "Divided between the worker threads while they run in parallel."
+        )
+        self.performanceLayout.addRow(self.nativeThreadsLabel, self.nativeThreadsSpinBox)
+        
+        self.memoryBudgetLabel = QLabel("RAM Budget (MB)", self)
+        self.memoryBudgetSpinBox = QSpinBox(self)
+        self.memoryBudgetSpinBox.setRange(256, 4 * 1024 * 1024)
+        self.memoryBudgetSpinBox.setSingleStep(256)
+        self.memoryBudgetSpinBox.setValue(default_budget_mb())
+        self.memoryBudgetSpinBox.setToolTip(
+            "Tile and sample sizes are chosen to fit this budget. Rasters that would still exceed "
+            "it switch to out-of-core processing when possible."
+        )
+        self.performanceLayout.addRow(self.memoryBudgetLabel, self.memoryBudgetSpinBox)
+        
+        self.memoryPolicyLabel = QLabel("Over Budget", self)
+        self.memoryPolicyComboBox = QComboBox(self)
+        self.memoryPolicyComboBox.addItem("Ask before running", 'ask')
+        self.memoryPolicyComboBox.addItem("Skip the raster", 'reject')
+        self.memoryPolicyComboBox.setToolTip(
+            "What to do with rasters whose estimated memory use exceeds the budget. They are "
+            "checked before the batch starts."
+        )
+        self.performanceLayout.addRow(self.memoryPolicyLabel, self.memoryPolicyComboBox)
+        
+        self.outOfCoreCheckBox = QCheckBox("Out-of-core (memory-mapped scratch files)", self)
+        self.outOfCoreCheckBox.stateChanged.connect(self.toggle_scratch_folder)
+        self.performanceLayout.addRow(self.outOfCoreCheckBox)
+        
+        self.scratchFolderLabel = QLabel("Scratch Folder", self)
+        self.scratchFolderLineEdit = QLineEdit(self)
+        self.scratchFolderLineEdit.setPlaceholderText("System temporary folder")
+        self.scratchFolderButton = QPushButton("...", self)
+        self.scratchFolderButton.setMaximumWidth(50)
+        self.scratchFolderButton.clicked.connect(self.select_scratch_folder)
+        self.scratchFolderLayout = QHBoxLayout()
+        self.scratchFolderLayout.addWidget(self.scratchFolderLineEdit)
+        self.scratchFolderLayout.addWidget(self.scratchFolderButton)
+        self.performanceLayout.addRow(self.scratchFolderLabel, self.scratchFolderLayout)
+        self.toggle_scratch_folder()
+        
+        self.cacheCheckBox = QCheckBox("Cache normalized features between runs", self)
+        self.cacheCheckBox.stateChanged.connect(self.toggle_cache_options)
+        self.performanceLayout.addRow(self.cacheCheckBox)
+        
+        self.cacheSizeLabel = QLabel("Cache Size (MB)", self)
+        self.cacheSizeSpinBox = QSpinBox(self)
+        self.cacheSizeSpinBox.setRange(64, 1024 * 1024)
+        self.cacheSizeSpinBox.setValue(DEFAULT_CACHE_MB)
+        self.clearCacheButton = QPushButton("Clear Cache", self)
+        self.clearCacheButton.clicked.connect(lambda: FeatureCache().clear())
+        self.cacheSizeLayout = QHBoxLayout()
+        self.cacheSizeLayout.addWidget(self.cacheSizeSpinBox)
+        self.cacheSizeLayout.addWidget(self.clearCacheButton)
+        self.performanceLayout.addRow(self.cacheSizeLabel, self.cacheSizeLayout)
+        self.toggle_cache_options()
+        
+        self.bandStatsCheckBox = QCheckBox("Reuse GDAL band statistics (.aux.xml)", self)
+        self.bandStatsCheckBox.setToolTip(
+            "Normalize with statistics stored alongside the raster, and save them (in an .aux.xml "
+            "file next to the input) when missing. Only integer bands without a nodata value are used."
+        )
+        self.performanceLayout.addRow(self.bandStatsCheckBox)
+        
+        self.runReportCheckBox = QCheckBox("Write a JSON run report with per-stage timings", self)
+        self.runReportCheckBox.setToolTip(
+            "Record wall time, CPU time and peak memory of each stage (read, normalize, fit, "
+            "classify, ...) per raster, and save them next to the outputs."
+        )
+        self.performanceLayout.addRow(self.runReportCheckBox)
+        
+        self.traceMemoryCheckBox = QCheckBox("Trace memory allocations per stage (slower)", self)
+        self.traceMemoryCheckBox.setToolTip("Use tracemalloc to report the peak allocation of each stage.")
+        self.performanceLayout.addRow(self.traceMemoryCheckBox)
+        
+        self.profilerComboBox = QComboBox(self)
+        self.profilerComboBox.addItem("Off", None)
+        self.profilerComboBox.addItem("cProfile", 'cprofile')
+        if importlib.util.find_spec('pyinstrument') is not None:
+            self.profilerComboBox.addItem("pyinstrument", 'pyinstrument')
+        self.profilerComboBox.setToolTip(
+            f"Profile each raster and save the profile next to its output. "
+            f"Can also be enabled with the {PROFILE_ENV} environment variable."
+        )
+        self.performanceLayout.addRow("Profile Each Raster:", self.profilerComboBox)
+        
+        self.layout.addWidget(self.performanceGroupBox)
+        
         # Open output in QGIS
         self.openInQgisCheckBox = QCheckBox("Open the output in QGIS", self)
         self.layout.addWidget(self.openInQgisCheckBox)
         
+        # Skip rasters already classified with identical inputs and settings
+        self.skipUnchangedCheckBox = QCheckBox("Skip rasters whose output is up to date", self)
+        self.skipUnchangedCheckBox.setToolTip(
+            "Outputs record a fingerprint of the input file, bands, method and parameters. "
+            "Rasters whose existing output has the same fingerprint are not processed again."
+        )
+        self.layout.addWidget(self.skipUnchangedCheckBox)
+        
         # ===== PROGRESS BAR SECTION =====
         self.progressLabel = QLabel("", self)
         self.layout.addWidget(self.progressLabel)
@@ -264,13 +701,34 @@ class UnsupervisedClassifierDialog(QDialog):
         self.progressBar.setMaximum(100)
         self.progressBar.setValue(0)
         self.progressBar.setTextVisible(True)
-        self.progressBar.setFormat("%p% - %v/%m files")
+        self.progressBar.setFormat("%p%")
         self.progressBar.hide()
         self.layout.addWidget(self.progressBar)
         
-        # Run button
+        # Preview on a downsampled copy of the first selected raster
+        self.reusePreviewCheckBox = QCheckBox("Start the full run from the preview centroids", self)
+        self.reusePreviewCheckBox.setToolTip(
+            "Seed the full-resolution run with the cluster centers fitted by the last preview "
+            "(K-means, ISODATA and Gaussian Mixture with the same method selected)."
+        )
+        self.reusePreviewCheckBox.setEnabled(False)
+        self.layout.addWidget(self.reusePreviewCheckBox)
+        
+        # Run buttons
+        self.runButtonLayout = QHBoxLayout()
+        self.previewButton = QPushButton("Preview", self)
+        self.previewButton.setToolTip(
+            "Classify a downsampled copy of the first selected raster (read from its overviews "
+            "when available) and show it as a temporary layer."
+        )
         self.runButton = QPushButton("Run Classification", self)
-        self.layout.addWidget(self.runButton)
+        self.cancelButton = QPushButton("Cancel", self)
+        self.cancelButton.setToolTip("Stop processing; the output of the raster in progress is removed.")
+        self.cancelButton.setEnabled(False)
+        self.runButtonLayout.addWidget(self.previewButton)
+        self.runButtonLayout.addWidget(self.runButton)
+        self.runButtonLayout.addWidget(self.cancelButton)
+        self.layout.addLayout(self.runButtonLayout)
         
         # Connect signals
         self.algorithmComboBox.currentIndexChanged.connect(self.toggle_options)
@@ -284,53 +742,38 @@ class UnsupervisedClassifierDialog(QDialog):
     def populate_table_from_loaded_layers(self):
         """Automatically populate table with all loaded raster layers"""
         layers = QgsProject.instance().mapLayers().values()
-        raster_layers = [layer for layer in layers if isinstance(layer, QgsRasterLayer)]
-        
-        for layer in raster_layers:
-            self.add_raster_to_table_internal(layer.source())
+        self.add_rasters([layer.source() for layer in layers if isinstance(layer, QgsRasterLayer)])
     
-    def table_cell_clicked(self, row, column):
-        """Handle cell clicks - toggle on Select/Raster Name, make editable on Output Name"""
-        # Toggle selection only on columns 0 (Select) and 1 (Raster Name)
-        if column in [0, 1]:
-            checkbox_widget = self.rasterTable.cellWidget(row, 0)
-            if checkbox_widget:
-                checkbox = checkbox_widget.findChild(QCheckBox)
-                if checkbox:
-                    checkbox.setChecked(not checkbox.isChecked())
+    def add_rasters(self, paths):
+        """Add rasters to the table and probe their metadata in the background"""
+        added = self.rasterModel.add_rasters(paths)
+        self.metadataProber.request(added)
+        return added
+    
+    def table_cell_clicked(self, index):
+        """Handle cell clicks - toggle on Raster Name, edit Output Name, choose bands on Selected Bands"""
+        column = index.column()
+        # The Select column toggles through its check box; Raster Name toggles too
+        if column == RasterTableModel.NAME:
+            row = self.rasterModel.rows[index.row()]
+            self.rasterModel.setData(self.rasterModel.index(index.row(), RasterTableModel.SELECT),
+                                     Qt.Unchecked if row['checked'] else Qt.Checked, Qt.CheckStateRole)
         
         # Make Output File Name column editable when clicked
-        elif column == 2:
-            output_item = self.rasterTable.item(row, 2)
-            if output_item:
-                # Enable editing
-                output_item.setFlags(output_item.flags() | Qt.ItemIsEditable)
-                self.rasterTable.editItem(output_item)
+        elif column == RasterTableModel.OUTPUT:
+            self.rasterTable.edit(index)
+        
+        elif column == RasterTableModel.BANDS:
+            self.open_band_selection_dialog(index.row(), index.data(Qt.UserRole))
     
     def remove_selected_rows(self):
         """Remove selected rows from the table"""
-        rows_to_remove = []
-        for row in range(self.rasterTable.rowCount()):
-            checkbox_widget = self.rasterTable.cellWidget(row, 0)
-            if checkbox_widget:
-                checkbox = checkbox_widget.findChild(QCheckBox)
-                if checkbox and checkbox.isChecked():
-                    rows_to_remove.append(row)
-        
-        # Remove from bottom to top to maintain indices
-        for row in sorted(rows_to_remove, reverse=True):
-            raster_item = self.rasterTable.item(row, 1)
-            if raster_item:
-                input_path = raster_item.data(Qt.UserRole)
-                # Remove from band selections
-                if input_path in self.band_selections:
-                    del self.band_selections[input_path]
-            self.rasterTable.removeRow(row)
+        self.rasterModel.remove_checked()
     
     def select_bands_for_selected(self):
         """Open band selection dialog for the currently highlighted (selected) row"""
         # Get the currently selected row
-        current_row = self.rasterTable.currentRow()
+        current_row = self.rasterTable.currentIndex().row()
         
         if current_row < 0:
             # No row is highlighted/selected
@@ -342,28 +785,11 @@ class UnsupervisedClassifierDialog(QDialog):
             )
             return
         
-        # Get the raster item from the selected row
-        raster_item = self.rasterTable.item(current_row, 1)
-        if raster_item:
-            input_path = raster_item.data(Qt.UserRole)
-            self.open_band_selection_dialog(current_row, input_path)
-
-    # def select_bands_for_selected(self):
-    #     """Open band selection dialog for selected rasters"""
-    #     for row in range(self.rasterTable.rowCount()):
-    #         checkbox_widget = self.rasterTable.cellWidget(row, 0)
-    #         if checkbox_widget:
-    #             checkbox = checkbox_widget.findChild(QCheckBox)
-    #             if checkbox and checkbox.isChecked():
-    #                 raster_item = self.rasterTable.item(row, 1)
-    #                 if raster_item:
-    #                     input_path = raster_item.data(Qt.UserRole)
-    #                     self.open_band_selection_dialog(row, input_path)
-    #                     break  # Open only for first selected
+        self.open_band_selection_dialog(current_row, self.rasterModel.rows[current_row]['input'])
     
     def open_band_selection_dialog(self, row, raster_path):
         """Open band selection dialog for specific raster"""
-        dialog = BandSelectionDialog(raster_path, self)
+        dialog = BandSelectionDialog(raster_path, self, self.metadataProber.probe_now(raster_path))
         
         # Pre-select bands if already selected
         if raster_path in self.band_selections:
@@ -377,44 +803,8 @@ class UnsupervisedClassifierDialog(QDialog):
                     item.setCheckState(Qt.Unchecked)
         
         if dialog.exec_() == QDialog.Accepted:
-            selected_bands = dialog.get_selected_bands()
-            self.band_selections[raster_path] = selected_bands
-            
             # Update the "Selected Bands" column
-            bands_button = self.rasterTable.cellWidget(row, 3)
-            if bands_button:
-                label = bands_button.findChild(QLabel)
-                if label:
-                    label.setText(f"{len(selected_bands)} bands")
-    
-    def create_bands_cell_widget(self, row, raster_path):
-        """Create cell widget with band count and ... button"""
-        widget = QWidget()
-        layout = QHBoxLayout(widget)
-        layout.setContentsMargins(2, 2, 2, 2)
-        
-        # Get band count
-        try:
-            dataset = gdal.Open(raster_path)
-            num_bands = dataset.RasterCount if dataset else 0
-            dataset = None
-        except:
-            num_bands = 0
-        
-        # Default: all bands selected
-        if raster_path not in self.band_selections:
-            self.band_selections[raster_path] = list(range(1, num_bands + 1))
-        
-        label = QLabel(f"{len(self.band_selections[raster_path])} bands")
-        button = QPushButton("...")
-        button.setMaximumWidth(30)
-        button.clicked.connect(lambda: self.open_band_selection_dialog(row, raster_path))
-        
-        layout.addWidget(label)
-        layout.addWidget(button)
-        layout.addStretch()
-        
-        return widget
+            self.rasterModel.set_bands(row, dialog.get_selected_bands())
     
     def update_progress(self, current, total, message=""):
         """Update the progress bar and label"""
@@ -431,26 +821,15 @@ class UnsupervisedClassifierDialog(QDialog):
         self.progressLabel.setText("")
     
     def toggle_select_all(self):
-        row_count = self.rasterTable.rowCount()
-        if row_count == 0:
+        if self.rasterModel.rowCount() == 0:
             return
         
         if self.all_selected:
-            for row in range(row_count):
-                checkbox_widget = self.rasterTable.cellWidget(row, 0)
-                if checkbox_widget:
-                    checkbox = checkbox_widget.findChild(QCheckBox)
-                    if checkbox:
-                        checkbox.setChecked(False)
+            self.rasterModel.set_all_checked(False)
             self.selectAllButton.setText("Select All")
             self.all_selected = False
         else:
-            for row in range(row_count):
-                checkbox_widget = self.rasterTable.cellWidget(row, 0)
-                if checkbox_widget:
-                    checkbox = checkbox_widget.findChild(QCheckBox)
-                    if checkbox:
-                        checkbox.setChecked(True)
+            self.rasterModel.set_all_checked(True)
             self.selectAllButton.setText("Unselect All")
             self.all_selected = True
     
@@ -468,6 +847,19 @@ class UnsupervisedClassifierDialog(QDialog):
         if folder:
             self.outputFolderLineEdit.setText(folder)
     
+    def toggle_scratch_folder(self):
+        enabled = self.outOfCoreCheckBox.isChecked()
+        self.scratchFolderLineEdit.setEnabled(enabled)
+        self.scratchFolderButton.setEnabled(enabled)
+    
+    def toggle_cache_options(self):
+        self.cacheSizeSpinBox.setEnabled(self.cacheCheckBox.isChecked())
+    
+    def select_scratch_folder(self):
+        folder = QFileDialog.getExistingDirectory(self, "Select Scratch Folder", "")
+        if folder:
+            self.scratchFolderLineEdit.setText(folder)
+    
     def select_input_files(self):
         """Select multiple input files"""
         filenames, _ = QFileDialog.getOpenFileNames(
@@ -478,96 +870,130 @@ class UnsupervisedClassifierDialog(QDialog):
         )
         
         if filenames:
-            for filename in filenames:
-                self.add_raster_to_table_internal(filename)
+            self.add_rasters(filenames)
             
             # Update the line edit to show count
             self.inputFileLineEdit.setText(f"{len(filenames)} file(s) added")
     
+    def select_input_folder(self):
+        """Add all rasters in a folder whose names match the patterns"""
+        folder = QFileDialog.getExistingDirectory(self, "Select Input Folder", "")
+        if folder:
+            paths = find_rasters(folder, self.inputPatternLineEdit.text(), self.recursiveCheckBox.isChecked())
+            added = self.add_rasters(paths)
+            self.inputFileLineEdit.setText(f"{len(added)} file(s) added from {folder}")
+    
+    def toggle_mosaic(self):
+        self.mosaicNameLineEdit.setEnabled(self.mosaicCheckBox.isChecked())
+    
+    def set_batch_controls_enabled(self, enabled):
+        """Lock the raster list and the run and preview buttons while a batch or preview is running"""
+        for widget in (self.rasterTable, self.selectAllButton, self.removeButton, self.selectBandsButton,
+                       self.inputFileButton, self.inputFolderButton, self.mosaicCheckBox,
+                       self.previewButton, self.runButton):
+            widget.setEnabled(enabled)
+        self.mosaicNameLineEdit.setEnabled(enabled and self.mosaicCheckBox.isChecked())
+    
     def add_raster_to_table_internal(self, input_file):
         """Internal method to add raster to table"""
-        if not input_file or not os.path.exists(input_file):
-            return
-        
-        # Check if already in table
-        for row in range(self.rasterTable.rowCount()):
-            raster_item = self.rasterTable.item(row, 1)
-            if raster_item and raster_item.data(Qt.UserRole) == input_file:
-                return
-        
-        base_name = os.path.splitext(os.path.basename(input_file))[0]
-        default_output_name = f"{base_name}_classified.tif"
-        
-        row_position = self.rasterTable.rowCount()
-        self.rasterTable.insertRow(row_position)
-        
-        # Checkbox
-        checkbox = QCheckBox()
-        checkbox.setChecked(True)
-        checkbox_widget = QWidget()
-        checkbox_layout = QHBoxLayout(checkbox_widget)
-        checkbox_layout.addWidget(checkbox)
-        checkbox_layout.setAlignment(Qt.AlignCenter)
-        checkbox_layout.setContentsMargins(0, 0, 0, 0)
-        self.rasterTable.setCellWidget(row_position, 0, checkbox_widget)
-        
-        # Raster name
-        raster_item = QTableWidgetItem(base_name)
-        raster_item.setFlags(raster_item.flags() & ~Qt.ItemIsEditable)
-        raster_item.setData(Qt.UserRole, input_file)
-        self.rasterTable.setItem(row_position, 1, raster_item)
-        
-        # Output name (initially not editable, becomes editable on click)
-        output_item = QTableWidgetItem(default_output_name)
-        output_item.setFlags(output_item.flags() & ~Qt.ItemIsEditable)  # Initially not editable
-        self.rasterTable.setItem(row_position, 2, output_item)
-        
-        # Bands selection
-        bands_widget = self.create_bands_cell_widget(row_position, input_file)
-        self.rasterTable.setCellWidget(row_position, 3, bands_widget)
-        
-        self.rasterTable.setRowHeight(row_position, 35)
+        self.add_rasters([input_file])
     
     def get_selected_rasters(self):
         """Get list of selected rasters with their output names, paths, and bands"""
+        output_folder = None
+        if not self.sameAsInputCheckBox.isChecked():
+            output_folder = self.outputFolderLineEdit.text() or None
+        
+        rows = self.rasterModel.checked_rows()
+        if rows and self.mosaicCheckBox.isChecked():
+            return [self.get_mosaic(rows, output_folder)]
+        
         selected = []
-        for row in range(self.rasterTable.rowCount()):
-            checkbox_widget = self.rasterTable.cellWidget(row, 0)
-            if checkbox_widget:
-                checkbox = checkbox_widget.findChild(QCheckBox)
-                
-                if checkbox and checkbox.isChecked():
-                    raster_item = self.rasterTable.item(row, 1)
-                    output_item = self.rasterTable.item(row, 2)
-                    
-                    if raster_item and output_item:
-                        input_path = raster_item.data(Qt.UserRole)
-                        output_name = output_item.text()
-                        
-                        # Get selected bands
-                        selected_bands = self.band_selections.get(input_path, [])
-                        
-                        if self.sameAsInputCheckBox.isChecked():
-                            input_dir = os.path.dirname(input_path)
-                            output_path = os.path.join(input_dir, output_name)
-                        else:
-                            output_folder = self.outputFolderLineEdit.text()
-                            if output_folder:
-                                output_path = os.path.join(output_folder, output_name)
-                            else:
-                                input_dir = os.path.dirname(input_path)
-                                output_path = os.path.join(input_dir, output_name)
-                        
-                        selected.append({
-                            'input': input_path,
-                            'output': output_path,
-                            'bands': selected_bands
-                        })
+        for row in rows:
+            input_path = row['input']
+            # Outputs go next to the input unless an output folder is set
+            output_dir = output_folder or os.path.dirname(input_path)
+            selected.append({
+                'input': input_path,
+                'output': os.path.join(output_dir, row['output']),
+                'bands': self.get_bands(input_path)
+            })
         return selected
     
+    def get_mosaic(self, rows, output_folder):
+        """Selected raster entry for a VRT mosaic of rows, with the tile paths under 'tiles'"""
+        tiles = [row['input'] for row in rows]
+        if not output_folder:
+            # Next to the tiles: their common folder
+            try:
+                output_folder = os.path.commonpath([os.path.dirname(tile) for tile in tiles])
+            except ValueError:
+                output_folder = os.path.dirname(tiles[0])
+        output_path = os.path.join(output_folder, self.mosaicNameLineEdit.text().strip() or DEFAULT_MOSAIC_NAME)
+        return {
+            'input': os.path.splitext(output_path)[0] + '.vrt',
+            'output': output_path,
+            'bands': self.get_bands(tiles[0]),
+            'tiles': tiles,
+        }
+    
+    def get_bands(self, input_path):
+        """Band selection of a listed raster, probing its metadata now if it is still pending"""
+        if input_path not in self.band_selections:
+            self.rasterModel.set_metadata(input_path, self.metadataProber.probe_now(input_path))
+        return self.band_selections[input_path]
+    
+    def get_processing_options(self):
+        """Get the optional processing settings as a dict"""
+        use_components = self.pcaModeComboBox.currentText() == "Number of Components"
+        return {
+            'pca_enabled': self.pcaGroupBox.isChecked(),
+            'pca_components': self.pcaComponentsSpinBox.value() if use_components else None,
+            'pca_variance': None if use_components else self.pcaVarianceDoubleSpinBox.value() / 100.0,
+            'auto_k': self.autoKGroupBox.isEnabled() and self.autoKGroupBox.isChecked(),
+            'auto_k_min': min(self.autoKMinSpinBox.value(), self.autoKMaxSpinBox.value()),
+            'auto_k_max': max(self.autoKMinSpinBox.value(), self.autoKMaxSpinBox.value()),
+            'auto_k_criterion': self.autoKCriterionComboBox.currentData(),
+            'output_profile': self.outputProfileComboBox.currentText(),
+            'read_threads': self.readThreadsSpinBox.value(),
+            'worker_threads': self.workerThreadsSpinBox.value(),
+            'native_threads': self.nativeThreadsSpinBox.value(),
+            'out_of_core': self.outOfCoreCheckBox.isChecked(),
+            'memory_budget_mb': self.memoryBudgetSpinBox.value(),
+            'memory_policy': self.memoryPolicyComboBox.currentData(),
+            'scratch_dir': self.scratchFolderLineEdit.text().strip() or None,
+            'cache_enabled': self.cacheCheckBox.isChecked(),
+            'skip_unchanged': self.skipUnchangedCheckBox.isChecked(),
+            'use_band_stats': self.bandStatsCheckBox.isChecked(),
+            'cache_mb': self.cacheSizeSpinBox.value(),
+            'run_report': self.runReportCheckBox.isChecked(),
+            'trace_memory': self.traceMemoryCheckBox.isChecked(),
+            'profiler': self.profilerComboBox.currentData(),
+            'reuse_preview': self.reusePreviewCheckBox.isEnabled() and self.reusePreviewCheckBox.isChecked(),
+        }
+    
+    def set_preview_available(self, preview):
+        """Enable reusing the centroids of the last preview (a dict with method and k), if any"""
+        self.reusePreviewCheckBox.setEnabled(preview is not None)
+        if preview is not None:
+            self.reusePreviewCheckBox.setText(
+                f"Start the full run from the preview centroids ({preview['method']}, k={preview['k']})"
+            )
+        else:
+            self.reusePreviewCheckBox.setText("Start the full run from the preview centroids")
+    
+    def toggle_pca_mode(self):
+        use_components = self.pcaModeComboBox.currentText() == "Number of Components"
+        self.pcaComponentsSpinBox.setEnabled(use_components)
+        self.pcaVarianceDoubleSpinBox.setEnabled(not use_components)
+    
     def toggle_options(self):
-        if self.algorithmComboBox.currentText() == "ISODATA (Time Taking)":
+        method = self.algorithmComboBox.currentText()
+        if method == "ISODATA (Time Taking)":
             self.isodataOptionsGroupBox.show()
         else:
             self.isodataOptionsGroupBox.hide()
+        supports_auto_k = method in ("Kmeans (Best Method)", "ISODATA (Time Taking)", "Gaussian Mixture")
+        self.autoKGroupBox.setEnabled(supports_auto_k)
+        self.numClustersSpinBox.setEnabled(not (supports_auto_k and self.autoKGroupBox.isChecked()))
         self.adjustSize()
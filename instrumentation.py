@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# resource is Unix only; peak RSS is not reported on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+MB = 1024 * 1024
+
+# Environment variable enabling profiling without touching the dialog: cprofile, pyinstrument or 1
+PROFILE_ENV = 'UNSUPERVISED_CLASSIFIER_PROFILE'
+
+PROFILERS = ('cprofile', 'pyinstrument')
+
+# Functions listed in the text summary written next to a cProfile dump
+PROFILE_SUMMARY_LINES = 40
+
+
+def peak_rss_mb():
+    """Peak resident set size of the process so far in MB, or None where unavailable"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / MB if sys.platform == 'darwin' else peak / 1024
+
+
+class StageRecorder:
+    """Record wall time, CPU time and memory of the named stages of one run.
+
+    CPU time is process-wide, so it includes worker and native (BLAS) threads.
+    peak_rss_mb is the process high-water mark at the end of the stage; when
+    tracemalloc is tracing (Python 3.9+), peak_traced_mb is the peak of traced
+    allocations (NumPy arrays included) during the stage, nested stages included.
+    """
+    def __init__(self):
+        self.stages = []
+        self.open_stages = []
+        self.traced_peaks = {}
+
+    def _carry_peak(self, peak):
+        """Fold a traced peak into the enclosing stage, whose own peak is about to be reset"""
+        if self.open_stages:
+            parent = id(self.open_stages[-1])
+            self.traced_peaks[parent] = max(self.traced_peaks.get(parent, 0), peak)
+
+    @contextmanager
+    def stage(self, name):
+        """Measure the enclosed block as stage name; yields the stage record for extra fields"""
+        record = {'name': name}
+        tracing = tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak')
+        if tracing:
+            self._carry_peak(tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self.open_stages.append(record)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall_seconds'] = time.perf_counter() - wall
+            record['cpu_seconds'] = time.process_time() - cpu
+            record['peak_rss_mb'] = peak_rss_mb()
+            self.open_stages.pop()
+            if tracing:
+                peak = max(tracemalloc.get_traced_memory()[1], self.traced_peaks.pop(id(record), 0))
+                record['peak_traced_mb'] = peak / MB
+                self._carry_peak(peak)
+            self.stages.append(record)
+
+
+class BusyTime:
+    """Thread-safe totals of the time spent in named operations of overlapping stages"""
+    def __init__(self):
+        self.seconds = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.seconds[name] = self.seconds.get(name, 0.0) + elapsed
+
+
+def format_stages(stages):
+    """One-line summary of stage records, e.g. for the completion dialog"""
+    parts = [f"{stage['name']} {stage['wall_seconds']:.2f}s" for stage in stages]
+    peaks = [stage['peak_rss_mb'] for stage in stages if stage.get('peak_rss_mb') is not None]
+    if peaks:
+        parts.append(f"peak RSS {max(peaks):.0f} MB")
+    traced = [stage['peak_traced_mb'] for stage in stages if 'peak_traced_mb' in stage]
+    if traced:
+        parts.append(f"peak traced {max(traced):.0f} MB")
+    return ", ".join(parts)
+
+
+def write_run_report(path, report):
+    """Write a run report dict as JSON; returns True on success"""
+    try:
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+    except OSError:
+        return False
+    return True
+
+
+def profiler_from_env():
+    """Profiler requested through the PROFILE_ENV environment variable, or None"""
+    value = os.environ.get(PROFILE_ENV, '').strip().lower()
+    if value in PROFILERS:
+        return value
+    if value in ('1', 'true', 'yes', 'on'):
+        return 'cprofile'
+    return None
+
+
+@contextmanager
+def profiled(profiler, path_base):
+    """Profile the enclosed block and save the profile as path_base plus an extension.
+
+    profiler is 'cprofile', 'pyinstrument' or None to disable profiling.
+    cProfile writes path_base.prof (for pstats/snakeviz) and a plain-text
+    summary path_base.prof.txt; pyinstrument writes path_base.html and falls
+    back to cProfile when it is not installed. Yields the list of files
+    written, filled in when the block exits, also on errors. Only the calling
+    thread is profiled: time spent waiting for worker threads shows up as
+    waits in the pipeline functions.
+    """
+    files = []
+    if profiler == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            profiler = 'cprofile'
+    if profiler not in PROFILERS:
+        yield files
+        return
+
+    if profiler == 'pyinstrument':
+        session = Profiler()
+        session.start()
+        try:
+            yield files
+        finally:
+            session.stop()
+            path = path_base + '.html'
+            try:
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(session.output_html())
+                files.append(path)
+            except OSError:
+                pass
+        return
+
+    session = cProfile.Profile()
+    try:
+        session.enable()
+    except ValueError:
+        # Another profiler is already active in this thread
+        yield files
+        return
+    try:
+        yield files
+    finally:
+        session.disable()
+        path = path_base + '.prof'
+        try:
+            session.dump_stats(path)
+            files.append(path)
+            summary = io.StringIO()
+            pstats.Stats(session, stream=summary).sort_stats('cumulative').print_stats(PROFILE_SUMMARY_LINES)
+            with open(path + '.txt', 'w', encoding='utf-8') as f:
+                f.write(summary.getvalue())
+            files.append(path + '.txt')
+        except OSError:
+            pass
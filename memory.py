@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import numpy as np
+
+# psutil is optional; os.sysconf covers Linux and macOS without it
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+MB = 1024 * 1024
+
+# Share of the physical memory used as the default RAM budget
+DEFAULT_BUDGET_FRACTION = 0.75
+
+# Budget used when the physical memory cannot be determined
+FALLBACK_BUDGET_MB = 4096
+
+
+def total_memory_bytes():
+    """Physical memory of the machine in bytes, or None if it cannot be determined"""
+    if psutil is not None:
+        return psutil.virtual_memory().total
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def default_budget_mb():
+    """Default RAM budget for a classification job in MB"""
+    total = total_memory_bytes()
+    if not total:
+        return FALLBACK_BUDGET_MB
+    return int(total * DEFAULT_BUDGET_FRACTION / MB)
+
+
+class ScratchSpace:
+    """Allocate large working arrays in RAM or as memory-mapped scratch files.
+
+    When out-of-core mode is enabled, arrays are numpy.memmap files in a
+    private sub-directory of directory (the system temp directory if None),
+    which is removed by close(). Otherwise arrays are ordinary numpy arrays.
+    """
+    def __init__(self, directory=None, enabled=False):
+        self.directory = directory or None
+        self.enabled = enabled
+        self.path = None
+        self.arrays = []
+
+    def empty(self, shape, dtype=np.float64, name='scratch'):
+        """Return an uninitialised array of the given shape and dtype"""
+        if not self.enabled:
+            return np.empty(shape, dtype=dtype)
+        if self.path is None:
+            if self.directory and not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            self.path = tempfile.mkdtemp(prefix='unsupervised_classifier_', dir=self.directory)
+        filename = os.path.join(self.path, f"{name}_{len(self.arrays)}.dat")
+        array = np.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+        self.arrays.append(array)
+        return array
+
+    def close(self):
+        """Release the memory maps and delete the scratch files"""
+        for array in self.arrays:
+            mmap = getattr(array, '_mmap', None)
+            if mmap is not None:
+                try:
+                    mmap.close()
+                except (BufferError, ValueError):
+                    # Still referenced elsewhere; the file is removed below where the OS allows it
+                    pass
+        self.arrays = []
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
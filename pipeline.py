@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# threadpoolctl ships with scikit-learn; without it native thread pools are left alone
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+# Sentinel marking the end of a stage's output
+_DONE = object()
+
+# Seconds between checks of the stop flag while blocked on a queue
+_POLL_SECONDS = 0.1
+
+# Native (BLAS/OpenMP) thread budget of the running job, None for the library default
+_native_budget = None
+
+
+@contextmanager
+def limit_native_threads(n_threads):
+    """Limit the BLAS and OpenMP thread pools used by NumPy/scikit-learn to n_threads.
+
+    Limits nest: the previous limit is restored on exit. The limit also
+    becomes the budget that native_threads_per_worker() divides between
+    parallel workers.
+    """
+    global _native_budget
+    previous = _native_budget
+    _native_budget = n_threads or previous
+    try:
+        if n_threads and threadpool_limits is not None:
+            with threadpool_limits(limits=n_threads):
+                yield
+        else:
+            yield
+    finally:
+        _native_budget = previous
+
+
+def native_threads_per_worker(n_workers):
+    """Share of the native thread budget for each of n_workers parallel workers"""
+    total = _native_budget or os.cpu_count() or 1
+    return max(1, total // max(1, n_workers))
+
+
+class Cancelled(Exception):
+    """Raised at a progress checkpoint once the job has been cancelled"""
+
+
+class Feedback:
+    """Progress reporting and cancellation shared by the stages of one job.
+
+    callback(stage, done, total) is called by report(), which must run on the
+    thread driving the job (it typically updates the GUI); check() and
+    cancel() are safe from any thread. Both report() and check() raise
+    Cancelled once cancel() has been called, so every progress report is also
+    a cancellation checkpoint.
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def check(self):
+        """Raise Cancelled if the job has been cancelled"""
+        if self.cancelled.is_set():
+            raise Cancelled()
+
+    def report(self, stage, done, total):
+        """Report that done of total steps of stage are complete"""
+        self.check()
+        if self.callback is not None:
+            self.callback(stage, done, total)
+        self.check()
+
+
+class _Stop(Exception):
+    """Raised inside a stage when another stage has failed"""
+
+
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=_POLL_SECONDS)
+            return
+        except queue.Full:
+            continue
+    raise _Stop()
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=_POLL_SECONDS)
+        except queue.Empty:
+            continue
+    raise _Stop()
+
+
+def run_pipeline(windows, read, compute, write, n_workers=1, queue_size=4, feedback=None):
+    """Run read -> compute -> write over windows as three overlapping stages.
+
+    A reader thread calls read(window) and prefetches up to queue_size windows
+    ahead, n_workers threads call compute(window, data), and write(window,
+    result) runs on the calling thread as results arrive (not necessarily in
+    window order), so GDAL writes stay on a single thread. Wall time then
+    approaches the cost of the slowest stage instead of the sum of all three.
+    The first exception raised by any stage stops the pipeline and is
+    re-raised here. Native thread pools are limited so that the workers
+    together stay within the job's thread budget. With feedback, each
+    written window is reported as a 'write' step and all stages stop at
+    their next window once the job is cancelled.
+    """
+    windows = list(windows)
+    n_workers = max(1, n_workers)
+    read_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def fail(error):
+        errors.append(error)
+        stop.set()
+
+    def reader():
+        try:
+            for window in windows:
+                if feedback is not None:
+                    feedback.check()
+                _put(read_queue, (window, read(window)), stop)
+            for _ in range(n_workers):
+                _put(read_queue, _DONE, stop)
+        except _Stop:
+            pass
+        except Exception as e:
+            fail(e)
+
+    def worker():
+        try:
+            while True:
+                item = _get(read_queue, stop)
+                if item is _DONE:
+                    _put(write_queue, _DONE, stop)
+                    return
+                window, data = item
+                if feedback is not None:
+                    feedback.check()
+                _put(write_queue, (window, compute(window, data)), stop)
+        except _Stop:
+            pass
+        except Exception as e:
+            fail(e)
+
+    threads = [threading.Thread(target=reader, daemon=True)]
+    threads += [threading.Thread(target=worker, daemon=True) for _ in range(n_workers)]
+
+    with limit_native_threads(native_threads_per_worker(n_workers)):
+        for thread in threads:
+            thread.start()
+        try:
+            finished_workers = 0
+            written = 0
+            while finished_workers < n_workers:
+                item = _get(write_queue, stop)
+                if item is _DONE:
+                    finished_workers += 1
+                    continue
+                window, result = item
+                write(window, result)
+                written += 1
+                if feedback is not None:
+                    feedback.report('write', written, len(windows))
+        except _Stop:
+            pass
+        except BaseException as e:
+            fail(e)
+        finally:
+            for thread in threads:
+                thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+def map_row_chunks(func, n_rows, chunk_size, n_threads=1):
+    """Call func(rows) for every slice of chunk_size rows, spread over n_threads threads.
+
+    Meant for NumPy-heavy functions that release the GIL (matrix products,
+    argmax, ...), such as assigning labels to blocks of an in-memory or
+    memory-mapped feature matrix. func writes its own results.
+    """
+    chunks = [slice(start, min(start + chunk_size, n_rows)) for start in range(0, n_rows, chunk_size)]
+    if n_threads <= 1 or len(chunks) <= 1:
+        for rows in chunks:
+            func(rows)
+        return
+    with limit_native_threads(native_threads_per_worker(n_threads)):
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            # list() re-raises the first exception from the workers
+            list(executor.map(func, chunks))
@@ -0,0 +1,489 @@
+# -*- coding: utf-8 -*-
+import fnmatch
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from osgeo import gdal
+
+# Output profiles: GDAL creation options for the classified raster
+OUTPUT_PROFILES = {
+    'GeoTIFF (Tiled, DEFLATE)': {
+        'options': ['TILED=YES', 'COMPRESS=DEFLATE', 'PREDICTOR=2', 'BIGTIFF=IF_SAFER'],
+    },
+    'GeoTIFF (Tiled, LZW)': {
+        'options': ['TILED=YES', 'COMPRESS=LZW', 'PREDICTOR=2', 'BIGTIFF=IF_SAFER'],
+    },
+    'GeoTIFF (Tiled, ZSTD)': {
+        'options': ['TILED=YES', 'COMPRESS=ZSTD', 'PREDICTOR=2', 'BIGTIFF=IF_SAFER'],
+    },
+    'GeoTIFF (Uncompressed)': {
+        'options': [],
+    },
+    'Cloud-Optimized GeoTIFF (Nearest Overviews)': {
+        'options': ['TILED=YES', 'COMPRESS=DEFLATE', 'PREDICTOR=2', 'BIGTIFF=IF_SAFER'],
+        'cog': True,
+        'cog_options': ['COMPRESS=DEFLATE', 'PREDICTOR=YES', 'BIGTIFF=IF_SAFER'],
+        'overview_resampling': 'NEAREST',
+    },
+    'Cloud-Optimized GeoTIFF (Mode Overviews)': {
+        'options': ['TILED=YES', 'COMPRESS=DEFLATE', 'PREDICTOR=2', 'BIGTIFF=IF_SAFER'],
+        'cog': True,
+        'cog_options': ['COMPRESS=DEFLATE', 'PREDICTOR=YES', 'BIGTIFF=IF_SAFER'],
+        'overview_resampling': 'MODE',
+    },
+}
+
+DEFAULT_PROFILE = 'GeoTIFF (Tiled, DEFLATE)'
+
+BLOCK_SIZE = 512
+
+# GDAL data types whose statistics can be reused for normalization (they hold no NaN)
+INTEGER_TYPES = ('Byte', 'Int8', 'UInt16', 'Int16', 'UInt32', 'Int32', 'UInt64', 'Int64')
+
+# File name patterns of the rasters added from a folder
+RASTER_PATTERNS = '*.tif *.tiff'
+
+# Minimum number of rows per read window
+READ_WINDOW_ROWS = 256
+
+# Overviews are built until the smallest level fits in this many pixels
+MIN_OVERVIEW_SIZE = 256
+
+
+def overview_levels(ncols, nrows, min_size=MIN_OVERVIEW_SIZE):
+    """Return the power-of-two overview factors for a raster of the given size"""
+    levels = []
+    factor = 2
+    while max(ncols, nrows) / factor >= min_size:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def default_threads():
+    """Default worker thread count"""
+    return max(1, min(os.cpu_count() or 1, 8))
+
+
+def iter_windows(nrows, window_rows):
+    """Yield (yoff, rows) for full-width strips of window_rows rows"""
+    for yoff in range(0, nrows, window_rows):
+        yield yoff, min(window_rows, nrows - yoff)
+
+
+def profile_block_rows(profile):
+    """Block height of outputs written with profile (1 for untiled, strip-written profiles)"""
+    options = OUTPUT_PROFILES.get(profile, OUTPUT_PROFILES[DEFAULT_PROFILE])['options']
+    return BLOCK_SIZE if 'TILED=YES' in options else 1
+
+
+def aligned_window_rows(max_rows, output_block_rows=1, input_block_rows=1):
+    """Largest strip height up to max_rows that lines up with the output and input blocks.
+
+    The height divides the output block height or is a multiple of it, so
+    compressed output blocks are not rewritten by overlapping strips, and it
+    is a whole number of input blocks, so no input block is decoded twice.
+    When no height up to max_rows meets both, only the output is lined up.
+    """
+    max_rows = max(1, max_rows)
+    for step in (max(1, input_block_rows), 1):
+        for rows in range(max_rows // step * step, 0, -step):
+            if output_block_rows % rows == 0 or rows % output_block_rows == 0:
+                return rows
+    return 1
+
+
+def read_window_rows(dataset, bands):
+    """Choose a strip height that is a whole number of the input's natural blocks"""
+    block_rows = dataset.GetRasterBand(bands[0]).GetBlockSize()[1] or 1
+    return max(block_rows, (READ_WINDOW_ROWS // block_rows) * block_rows)
+
+
+class ThreadLocalDatasets:
+    """One GDAL dataset handle per thread (handles must not be shared between threads)"""
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.handles = []
+
+    def get(self):
+        dataset = getattr(self.local, 'dataset', None)
+        if dataset is None:
+            dataset = gdal.Open(self.path)
+            if dataset is None:
+                raise RuntimeError(f"Could not open file: {self.path}")
+            self.local.dataset = dataset
+            with self.lock:
+                self.handles.append(dataset)
+        return dataset
+
+    def close(self):
+        with self.lock:
+            self.handles.clear()
+        self.local = threading.local()
+
+
+def read_bands_into(dataset, bands, block, yoff, rows, ncols):
+    """Read a strip of each band directly into its column of a (pixels, bands) block.
+
+    Each column is exposed to GDAL as a (rows, ncols) band-strided view, so
+    GDAL converts to the block's dtype and interleaves the pixels as it reads:
+    no per-band temporary array, astype() copy or np.stack() is needed.
+    """
+    pixels = block.reshape(rows, ncols, len(bands))
+    for j, band in enumerate(bands):
+        dataset.GetRasterBand(band).ReadAsArray(0, yoff, ncols, rows, buf_obj=pixels[:, :, j])
+    return block
+
+
+class RasterWindowReader:
+    """Read full-width strips of selected bands as (pixels, bands) blocks.
+
+    Each calling thread reads through its own dataset handle, so strips can be
+    read and decoded on several threads at once.
+    """
+    def __init__(self, path, bands, dtype=np.float64):
+        self.bands = bands
+        self.dtype = dtype
+        self.handles = ThreadLocalDatasets(path)
+        self.ncols = self.handles.get().RasterXSize
+
+    def read(self, yoff, rows):
+        block = np.empty((rows * self.ncols, len(self.bands)), dtype=self.dtype)
+        read_bands_into(self.handles.get(), self.bands, block, yoff, rows, self.ncols)
+        return block
+
+    def close(self):
+        self.handles.close()
+
+
+def read_feature_matrix(path, bands, dtype=np.float64, n_threads=None, postprocess=None, out=None,
+                        feedback=None):
+    """Read the selected bands into a (rows*cols, bands) pixel-interleaved matrix.
+
+    Full-width strips are read concurrently, each worker thread using its own
+    dataset handle, so decompression of compressed inputs (DEFLATE GeoTIFF,
+    JPEG2000, ...) runs on several cores. postprocess, if given, is called in
+    the worker on each strip of the matrix right after it is read, which
+    overlaps cleaning work with the remaining reads. out, if given, is the
+    preallocated (rows*cols, bands) matrix to fill (e.g. a memory-mapped
+    scratch array). feedback, if given, receives a 'read' step per strip and
+    stops the remaining reads once the job is cancelled.
+    """
+    dataset = gdal.Open(path)
+    if dataset is None:
+        raise RuntimeError(f"Could not open file: {path}")
+    nrows, ncols = dataset.RasterYSize, dataset.RasterXSize
+    window_rows = read_window_rows(dataset, bands)
+    dataset = None
+
+    data = out if out is not None else np.empty((nrows * ncols, len(bands)), dtype=dtype)
+    handles = ThreadLocalDatasets(path)
+
+    def read_window(window):
+        if feedback is not None:
+            feedback.check()
+        yoff, rows = window
+        dataset = handles.get()
+        block = data[yoff * ncols:(yoff + rows) * ncols]
+        read_bands_into(dataset, bands, block, yoff, rows, ncols)
+        if postprocess is not None:
+            postprocess(block)
+
+    windows = list(iter_windows(nrows, window_rows))
+    try:
+        with ThreadPoolExecutor(max_workers=n_threads or default_threads()) as executor:
+            # Results arrive here in order, so progress is reported from the calling thread
+            for done, _ in enumerate(executor.map(read_window, windows), start=1):
+                if feedback is not None:
+                    feedback.report('read', done, len(windows))
+    finally:
+        handles.close()
+    return data
+
+
+def preview_size(ncols, nrows, max_pixels):
+    """(xsize, ysize) of a downsampled copy of a raster holding at most max_pixels pixels"""
+    scale = max(1.0, math.sqrt(ncols * nrows / max_pixels))
+    return max(1, int(ncols / scale)), max(1, int(nrows / scale))
+
+
+def read_preview(path, bands, max_pixels, dtype=np.float64):
+    """Read the selected bands downsampled to at most max_pixels pixels.
+
+    The whole extent is read into a smaller buffer with nearest-neighbour
+    resampling, which GDAL serves from the raster's overviews when it has
+    any, so previews of large rasters read only a fraction of the data.
+    Returns a dict with the (pixels, bands) matrix, the preview size and the
+    matching geotransform and projection.
+    """
+    dataset = gdal.Open(path)
+    if dataset is None:
+        raise RuntimeError(f"Could not open file: {path}")
+    ncols, nrows = dataset.RasterXSize, dataset.RasterYSize
+    xsize, ysize = preview_size(ncols, nrows, max_pixels)
+    
+    data = np.empty((xsize * ysize, len(bands)), dtype=dtype)
+    pixels = data.reshape(ysize, xsize, len(bands))
+    for j, band in enumerate(bands):
+        dataset.GetRasterBand(band).ReadAsArray(
+            0, 0, ncols, nrows, buf_xsize=xsize, buf_ysize=ysize, buf_obj=pixels[:, :, j],
+            resample_alg=gdal.GRIORA_NearestNeighbour
+        )
+    
+    x0, dx, rx, y0, ry, dy = dataset.GetGeoTransform()
+    sx, sy = ncols / xsize, nrows / ysize
+    preview = {
+        'data': data,
+        'xsize': xsize,
+        'ysize': ysize,
+        'geotransform': (x0, dx * sx, rx * sy, y0, ry * sx, dy * sy),
+        'projection': dataset.GetProjection(),
+    }
+    dataset = None
+    return preview
+
+
+def find_rasters(folder, patterns=RASTER_PATTERNS, recursive=False):
+    """Sorted paths of the files in folder whose names match any of the glob patterns.
+
+    patterns is a string of patterns separated by spaces or semicolons and is
+    matched case-insensitively; with recursive, subfolders are searched too.
+    """
+    patterns = [pattern.lower() for pattern in patterns.replace(';', ' ').split()] or ['*']
+    matches = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        matches.extend(
+            os.path.join(root, name) for name in sorted(files)
+            if any(fnmatch.fnmatchcase(name.lower(), pattern) for pattern in patterns)
+        )
+        if not recursive:
+            break
+    return matches
+
+
+def build_mosaic(vrt_path, paths):
+    """Write a GDAL VRT mosaicking the rasters in paths; returns (success, message).
+
+    The VRT is read like any other raster, so the streaming engine classifies
+    the tiles window by window with one model. The tiles must share band
+    count, data type and projection: GDAL leaves out tiles that do not match,
+    which is reported as a failure. A VRT that already mosaics the same
+    tiles, none of them modified since, is kept as is so that its size and
+    modification time (and the run fingerprint and feature cache key derived
+    from them) stay the same between runs.
+    """
+    if mosaic_is_current(vrt_path, paths):
+        return True, f"Mosaic of {len(paths)} rasters: {vrt_path}"
+    try:
+        dataset = gdal.BuildVRT(vrt_path, paths)
+    except RuntimeError as e:
+        return False, f"Could not build mosaic: {e}"
+    if dataset is None:
+        return False, "Could not build mosaic"
+    # Closing the dataset writes the VRT; reopen it to list the tiles it references
+    dataset = None
+    dataset = gdal.Open(vrt_path)
+    if dataset is None:
+        return False, f"Could not open mosaic: {vrt_path}"
+    used = len(dataset.GetFileList()) - 1
+    dataset = None
+    if used < len(paths):
+        return False, (f"Only {used} of {len(paths)} rasters could be mosaicked; "
+                       f"they must share band count, data type and projection")
+    return True, f"Mosaic of {len(paths)} rasters: {vrt_path}"
+
+
+def mosaic_is_current(vrt_path, paths):
+    """Whether the VRT at vrt_path mosaics exactly paths and is newer than all of them"""
+    try:
+        vrt_mtime = os.path.getmtime(vrt_path)
+        if any(os.path.getmtime(path) > vrt_mtime for path in paths):
+            return False
+        dataset = gdal.Open(vrt_path)
+    except (OSError, RuntimeError):
+        return False
+    if dataset is None:
+        return False
+    sources = dataset.GetFileList()[1:]
+    dataset = None
+    return {_normalized_path(path) for path in sources} == {_normalized_path(path) for path in paths}
+
+
+def _normalized_path(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+def raster_metadata(path):
+    """Band count, band descriptions, size, data type and nodata values of a raster.
+
+    Only the dataset header is read. Returns None if the file cannot be opened.
+    """
+    try:
+        dataset = gdal.Open(path)
+    except RuntimeError:
+        dataset = None
+    if dataset is None:
+        return None
+    bands = [dataset.GetRasterBand(i) for i in range(1, dataset.RasterCount + 1)]
+    metadata = {
+        'band_count': len(bands),
+        'descriptions': [band.GetDescription() or f"Band {i}" for i, band in enumerate(bands, start=1)],
+        'xsize': dataset.RasterXSize,
+        'ysize': dataset.RasterYSize,
+        'dtype': gdal.GetDataTypeName(bands[0].DataType) if bands else None,
+        'nodata': [band.GetNoDataValue() for band in bands],
+        'block_size': tuple(bands[0].GetBlockSize()) if bands else (0, 0),
+    }
+    bands = None
+    dataset = None
+    return metadata
+
+
+def _valid_statistics(band, stats):
+    """Whether GetStatistics returned exact, usable statistics"""
+    if stats is None or len(stats) < 4 or stats[3] < 0:
+        return False
+    return band.GetMetadataItem('STATISTICS_APPROXIMATE') != 'YES'
+
+
+def _statistics_usable(band):
+    """Whether GDAL statistics of band describe the same values as the feature matrix.
+
+    GDAL skips nodata and NaN pixels, which the feature matrix keeps (NaN as
+    zero), so only integer bands without a nodata value qualify.
+    """
+    return band.GetNoDataValue() is None and gdal.GetDataTypeName(band.DataType) in INTEGER_TYPES
+
+
+def band_statistics(path, bands):
+    """Per-band (mean, std) arrays from stored GDAL statistics, or None if they cannot be used.
+
+    Only exact statistics already stored with the raster (embedded or in a
+    PAM .aux.xml file) are reused; nothing is computed from the pixels.
+    """
+    dataset = gdal.Open(path)
+    if dataset is None:
+        return None
+    means, stds = [], []
+    try:
+        for band_number in bands:
+            band = dataset.GetRasterBand(band_number)
+            if not _statistics_usable(band):
+                return None
+            stats = band.GetStatistics(False, False)
+            if not _valid_statistics(band, stats):
+                return None
+            means.append(stats[2])
+            stds.append(stats[3])
+    except RuntimeError:
+        return None
+    finally:
+        dataset = None
+    return np.array(means, dtype=np.float64), np.array(stds, dtype=np.float64)
+
+
+def store_band_statistics(path, bands, minimum, maximum, mean, std):
+    """Save exact per-band statistics with the raster for band_statistics to reuse.
+
+    Bands whose statistics cannot be reused, or that already hold exact
+    statistics, are left alone, so the .aux.xml file GDAL writes when the
+    dataset is closed is only rewritten when something was added.
+    """
+    dataset = gdal.Open(path)
+    if dataset is None:
+        return
+    try:
+        for i, band_number in enumerate(bands):
+            band = dataset.GetRasterBand(band_number)
+            if _statistics_usable(band) and not _valid_statistics(band, band.GetStatistics(False, False)):
+                band.SetStatistics(float(minimum[i]), float(maximum[i]), float(mean[i]), float(std[i]))
+    except RuntimeError:
+        pass
+    finally:
+        dataset = None
+
+
+class ClassifiedRasterWriter:
+    """Write a single-band label raster block by block using an output profile.
+
+    Plain GeoTIFF profiles are written in place. COG profiles are written to a
+    tiled temporary GeoTIFF first and converted with the COG driver (which
+    builds the overviews) when the writer is closed.
+    """
+    def __init__(self, output_file, ncols, nrows, gdal_type, geotransform, projection,
+                 profile=DEFAULT_PROFILE):
+        self.output_file = output_file
+        self.ncols = ncols
+        self.nrows = nrows
+        self.profile = OUTPUT_PROFILES.get(profile, OUTPUT_PROFILES[DEFAULT_PROFILE])
+        self.is_cog = self.profile.get('cog', False)
+
+        options = list(self.profile['options'])
+        if 'TILED=YES' in options:
+            options += [f'BLOCKXSIZE={BLOCK_SIZE}', f'BLOCKYSIZE={BLOCK_SIZE}']
+
+        self.target_file = output_file + '.tmp.tif' if self.is_cog else output_file
+        driver = gdal.GetDriverByName('GTiff')
+        self.dataset = driver.Create(self.target_file, ncols, nrows, 1, gdal_type, options=options)
+        if self.dataset is None:
+            raise RuntimeError(f"Could not create output file: {output_file}")
+        self.dataset.SetGeoTransform(geotransform)
+        self.dataset.SetProjection(projection)
+        self.band = self.dataset.GetRasterBand(1)
+
+    def write(self, array, xoff=0, yoff=0):
+        """Write a 2D label array at the given pixel offset"""
+        self.band.WriteArray(array, xoff, yoff)
+
+    def close(self, metadata=None):
+        """Flush the output and build overviews / the COG if the profile asks for it.
+
+        metadata items are set last, so they are only present on complete outputs.
+        """
+        if self.dataset is None:
+            return
+        for key, value in (metadata or {}).items():
+            self.dataset.SetMetadataItem(key, str(value))
+        self.band.FlushCache()
+        self.band = None
+        self.dataset = None
+
+        if self.is_cog:
+            try:
+                self._write_cog()
+            finally:
+                if os.path.exists(self.target_file):
+                    gdal.GetDriverByName('GTiff').Delete(self.target_file)
+
+    def abort(self):
+        """Close and delete a partially written output"""
+        self.band = None
+        self.dataset = None
+        for path in {self.target_file, self.output_file}:
+            if os.path.exists(path):
+                gdal.GetDriverByName('GTiff').Delete(path)
+
+    def _write_cog(self):
+        resampling = self.profile.get('overview_resampling', 'NEAREST')
+        source = gdal.Open(self.target_file)
+        if gdal.GetDriverByName('COG') is not None:
+            options = list(self.profile['cog_options'])
+            options += [f'BLOCKSIZE={BLOCK_SIZE}', f'OVERVIEW_RESAMPLING={resampling}']
+            result = gdal.GetDriverByName('COG').CreateCopy(self.output_file, source, options=options)
+        else:
+            # GDAL < 3.1: build overviews on the tiled GeoTIFF and copy them in front of the data
+            levels = overview_levels(self.ncols, self.nrows)
+            if levels:
+                source.BuildOverviews(resampling, levels)
+            options = list(self.profile['options'])
+            options += [f'BLOCKXSIZE={BLOCK_SIZE}', f'BLOCKYSIZE={BLOCK_SIZE}', 'COPY_SRC_OVERVIEWS=YES']
+            result = gdal.GetDriverByName('GTiff').CreateCopy(self.output_file, source, options=options)
+        source = None
+        if result is None:
+            raise RuntimeError(f"Could not write Cloud-Optimized GeoTIFF: {self.output_file}")
+        result = None
@@ -0,0 +1,292 @@
+# coding=utf-8
+"""Benchmark suite: time each clustering method and I/O mode on synthetic rasters.
+
+Run from the directory containing the plugin, in the same Python
+environment as the tests (QGIS, GDAL and scikit-learn available)::
+
+    python -m unsupervised_classifier.test.benchmark --size 2000x2000 --bands 6 \
+        --output results.json --compare previous_results.json
+
+Results are saved as JSON so runs of different releases can be compared.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'mirjanalisha@gmail.com'
+__date__ = '2026-10-19'
+__copyright__ = 'Copyright 2024, Mirjan Ali Sha'
+
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from osgeo import gdal
+
+from ..classify import UnsupervisedClassifier, PREVIEW_TRANSDUCTIVE_METHODS
+from ..instrumentation import StageRecorder, format_stages, profiled, profiler_from_env, PROFILERS
+from ..pipeline import limit_native_threads
+
+METHODS = (
+    'Kmeans (Best Method)',
+    'ISODATA (Time Taking)',
+    'Gaussian Mixture',
+    'DBSCAN',
+    'Agglomerative Clustering',
+    'Spectral Clustering',
+)
+
+# I/O modes: processing options applied on top of the defaults
+IO_MODES = {
+    'in_memory': {},
+    'out_of_core': {'out_of_core': True},
+    'cache_cold': {'cache_enabled': True},
+    'cache_warm': {'cache_enabled': True},
+    'cog': {'output_profile': 'Cloud-Optimized GeoTIFF (Nearest Overviews)'},
+}
+
+# Synthetic data types: (GDAL type, value range used for class means)
+DTYPES = {
+    'uint8': (gdal.GDT_Byte, 255),
+    'uint16': (gdal.GDT_UInt16, 10000),
+    'int16': (gdal.GDT_Int16, 10000),
+    'float32': (gdal.GDT_Float32, 1.0),
+}
+
+# Isodata parameters matching the dialog defaults
+ISODATA = {'max_iter': 100, 'max_merge': 0.5, 'min_split_std': 0.5, 'max_std': 1.0, 'min_samples': 10}
+
+# Number of pixels compared with the ground truth
+ACCURACY_SAMPLE = 100000
+
+
+def parse_size(text):
+    """Parse ROWSxCOLS into a (rows, cols) tuple"""
+    rows, cols = text.lower().split('x')
+    return int(rows), int(cols)
+
+
+def make_synthetic_raster(path, rows, cols, bands, dtype='uint16', classes=5, patch=32,
+                          noise=0.15, seed=0):
+    """Write a tiled multi-band GeoTIFF with a known patchy class structure.
+
+    Classes are assigned to square patches of patch pixels; each class has a
+    random mean per band and Gaussian noise of noise times the spacing between
+    class means. The file is written in strips so large rasters do not need
+    to fit in memory. Returns the (coarse class grid, patch) ground truth.
+    """
+    gdal_type, value_range = DTYPES[dtype]
+    rng = np.random.default_rng(seed)
+    grid = rng.integers(0, classes, size=(-(-rows // patch), -(-cols // patch)))
+    means = rng.uniform(0.1, 0.9, size=(classes, bands)) * value_range
+    sigma = noise * value_range / classes
+
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(path, cols, rows, bands, gdal_type,
+                            options=['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+    dataset.SetGeoTransform((0, 10, 0, 0, 0, -10))
+    for yoff in range(0, rows, 512):
+        strip_rows = min(512, rows - yoff)
+        row_classes = grid[np.arange(yoff, yoff + strip_rows) // patch]
+        labels = row_classes[:, np.arange(cols) // patch]
+        for band in range(bands):
+            values = means[labels, band] + rng.normal(0, sigma, size=labels.shape)
+            if dtype != 'float32':
+                values = np.clip(np.rint(values), 0, np.iinfo(dtype).max)
+            dataset.GetRasterBand(band + 1).WriteArray(values.astype(dtype), 0, yoff)
+    dataset = None
+    return grid, patch
+
+
+def accuracy(output_file, truth, sample_size=ACCURACY_SAMPLE, seed=0):
+    """Adjusted Rand index of the output labels against the ground truth, on a pixel sample"""
+    from sklearn.metrics import adjusted_rand_score
+    grid, patch = truth
+    dataset = gdal.Open(output_file)
+    if dataset is None:
+        return None
+    labels = dataset.GetRasterBand(1).ReadAsArray()
+    dataset = None
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, labels.shape[0], size=sample_size)
+    cols = rng.integers(0, labels.shape[1], size=sample_size)
+    return float(adjusted_rand_score(grid[rows // patch, cols // patch], labels[rows, cols]))
+
+
+def environment():
+    """Versions and hardware the results were measured with"""
+    import sklearn
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'scikit-learn': sklearn.__version__,
+        'gdal': gdal.__version__,
+    }
+
+
+def run_case(plugin, input_file, output_file, method, bands, classes, processing,
+             profiler=None, profile_base=None):
+    """Classify one raster and return (success, message, stage records).
+
+    With a profiler, the run is profiled and the profile saved as profile_base
+    plus an extension.
+    """
+    recorder = StageRecorder()
+    with limit_native_threads(processing.get('native_threads')), recorder.stage('total'), \
+            profiled(profiler, profile_base):
+        success, message = plugin.process_single_raster(
+            input_file, output_file, method, classes, list(range(1, bands + 1)),
+            ISODATA['max_iter'], ISODATA['max_merge'], ISODATA['min_split_std'],
+            ISODATA['max_std'], ISODATA['min_samples'], False, dict(processing),
+            recorder=recorder
+        )
+    return success, message, recorder.stages
+
+
+def run_benchmarks(args):
+    """Run every requested (method, I/O mode) combination and return the results dict"""
+    workdir = tempfile.mkdtemp(prefix='unsupervised_classifier_benchmark_', dir=args.workdir)
+    plugin = UnsupervisedClassifier(iface=None)
+    results = []
+    try:
+        rasters = {}
+        for size_name, size in (('inductive', args.size), ('transductive', args.transductive_size)):
+            path = os.path.join(workdir, f'{size_name}.tif')
+            truth = make_synthetic_raster(path, size[0], size[1], args.bands, args.dtype,
+                                          args.classes, seed=args.seed)
+            rasters[size_name] = (path, size, truth)
+
+        for method in args.methods:
+            path, size, truth = rasters[
+                'transductive' if method in PREVIEW_TRANSDUCTIVE_METHODS else 'inductive'
+            ]
+            for mode in args.modes:
+                processing = dict(IO_MODES[mode], cache_dir=os.path.join(workdir, 'cache'))
+                if args.threads:
+                    processing.update(read_threads=args.threads, worker_threads=args.threads,
+                                      native_threads=args.threads)
+                if mode == 'cache_warm':
+                    # Populate the cache first so the timed runs hit it
+                    run_case(plugin, path, os.path.join(workdir, 'warmup.tif'), method,
+                             args.bands, args.classes, processing)
+                for repeat in range(args.repeat):
+                    if mode == 'cache_cold':
+                        shutil.rmtree(processing['cache_dir'], ignore_errors=True)
+                    output_file = os.path.join(workdir, 'output.tif')
+                    profile_base = os.path.join(
+                        args.profile_dir, f"{re.sub(r'[^A-Za-z0-9]+', '_', method).strip('_')}_{mode}_{repeat}"
+                    )
+                    success, message, stages = run_case(
+                        plugin, path, output_file, method, args.bands, args.classes, processing,
+                        profiler=args.profile, profile_base=profile_base
+                    )
+                    result = {
+                        'method': method,
+                        'mode': mode,
+                        'repeat': repeat,
+                        'rows': size[0],
+                        'cols': size[1],
+                        'bands': args.bands,
+                        'dtype': args.dtype,
+                        'classes': args.classes,
+                        'success': success,
+                        'message': message,
+                        'seconds': stages[-1]['wall_seconds'],
+                        'ari': accuracy(output_file, truth) if success else None,
+                        'stages': stages,
+                    }
+                    results.append(result)
+                    print(f"{method} / {mode} #{repeat}: "
+                          f"{'ok' if success else message} - {format_stages(stages)}")
+                    if os.path.exists(output_file):
+                        gdal.GetDriverByName('GTiff').Delete(output_file)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': environment(),
+        'config': {
+            'size': list(args.size),
+            'transductive_size': list(args.transductive_size),
+            'bands': args.bands,
+            'dtype': args.dtype,
+            'classes': args.classes,
+            'repeat': args.repeat,
+            'threads': args.threads,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+
+
+def best_times(report):
+    """Fastest successful run time per (method, mode)"""
+    times = {}
+    for result in report['results']:
+        if result['success']:
+            key = (result['method'], result['mode'])
+            times[key] = min(times.get(key, float('inf')), result['seconds'])
+    return times
+
+
+def compare(report, baseline):
+    """Print the speed-up of report over a baseline report for shared (method, mode) pairs"""
+    current, previous = best_times(report), best_times(baseline)
+    if report['config'] != baseline['config']:
+        print("Warning: benchmark configurations differ, times are not directly comparable")
+    for key in sorted(set(current) & set(previous)):
+        print(f"{key[0]} / {key[1]}: {previous[key]:.2f}s -> {current[key]:.2f}s "
+              f"({previous[key] / max(current[key], 1e-9):.2f}x)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=parse_size, default=(1000, 1000),
+                        help="ROWSxCOLS of the raster for K-means, ISODATA and GMM")
+    parser.add_argument('--transductive-size', type=parse_size, default=(100, 100),
+                        help="ROWSxCOLS of the raster for DBSCAN, Agglomerative and Spectral")
+    parser.add_argument('--bands', type=int, default=4)
+    parser.add_argument('--dtype', choices=sorted(DTYPES), default='uint16')
+    parser.add_argument('--classes', type=int, default=5)
+    parser.add_argument('--methods', nargs='+', choices=METHODS, default=list(METHODS))
+    parser.add_argument('--modes', nargs='+', choices=list(IO_MODES), default=list(IO_MODES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=None,
+                        help="Read, worker and native thread count (default: the plugin defaults)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=None, help="Directory for the temporary rasters")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', default=None, help="Earlier results JSON to compare against")
+    parser.add_argument('--profile', choices=PROFILERS, default=profiler_from_env(),
+                        help="Profile every timed run (adds overhead to the timings)")
+    parser.add_argument('--profile-dir', default='.', help="Directory for the profiles")
+    args = parser.parse_args(argv)
+    if args.profile and not os.path.isdir(args.profile_dir):
+        os.makedirs(args.profile_dir)
+
+    report = run_benchmarks(args)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
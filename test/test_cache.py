@@ -0,0 +1,80 @@
+# coding=utf-8
+"""Feature cache test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'mirjanalisha@gmail.com'
+__date__ = '2026-10-19'
+__copyright__ = 'Copyright 2024, Mirjan Ali Sha'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from ..cache import FeatureCache
+
+
+class FeatureCacheTest(unittest.TestCase):
+    """Test the on-disk feature matrix cache."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.directory = tempfile.mkdtemp()
+        self.raster = os.path.join(self.directory, 'raster.tif')
+        with open(self.raster, 'wb') as f:
+            f.write(b'raster')
+        self.cache = FeatureCache(os.path.join(self.directory, 'cache'), max_bytes=10 ** 6)
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_round_trip(self):
+        """Test a stored entry is loaded back unchanged."""
+        key = self.cache.key(self.raster, [1, 2], {'pca_enabled': False})
+        features = np.arange(20, dtype=float).reshape(10, 2)
+        self.assertIsNone(self.cache.load(key))
+        self.assertTrue(self.cache.store(key, {'mean': np.zeros(2), 'std': np.ones(2)}, features))
+        preprocessing, loaded = self.cache.load(key)
+        np.testing.assert_array_equal(loaded, features)
+        np.testing.assert_array_equal(preprocessing['std'], np.ones(2))
+
+    def test_key_changes(self):
+        """Test the key depends on bands, options and the file itself."""
+        key = self.cache.key(self.raster, [1, 2], {'pca_enabled': False})
+        self.assertNotEqual(key, self.cache.key(self.raster, [1], {'pca_enabled': False}))
+        self.assertNotEqual(key, self.cache.key(self.raster, [1, 2], {'pca_enabled': True}))
+        with open(self.raster, 'ab') as f:
+            f.write(b'changed')
+        self.assertNotEqual(key, self.cache.key(self.raster, [1, 2], {'pca_enabled': False}))
+
+    def test_lru_eviction(self):
+        """Test the least recently used entry is evicted past the size cap."""
+        features = np.zeros((50000, 1))  # 400 kB per entry
+        arrays = {'mean': np.zeros(1), 'std': np.ones(1)}
+        for name in ('a', 'b'):
+            self.cache.store(name, arrays, features)
+        # Mark 'a' as used more recently than 'b'
+        os.utime(os.path.join(self.cache.directory, 'b'), (0, 0))
+        self.cache.store('c', arrays, features)
+        self.assertIsNotNone(self.cache.load('a'))
+        self.assertIsNone(self.cache.load('b'))
+        self.assertIsNotNone(self.cache.load('c'))
+
+    def test_oversized_entry_skipped(self):
+        """Test an entry larger than the cache is not stored."""
+        self.assertFalse(self.cache.store('big', {'mean': np.zeros(1)}, np.zeros((200000, 1))))
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(FeatureCacheTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,398 @@
+# coding=utf-8
+"""Classification pipeline test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'mirjanalisha@gmail.com'
+__date__ = '2026-10-19'
+__copyright__ = 'Copyright 2024, Mirjan Ali Sha'
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+from osgeo import gdal
+
+from .. import classify
+from ..classify import (UnsupervisedClassifier, assign_labels, cdist, output_dtype_for, plan_memory,
+                        cluster_statistics, fit_preprocessor, select_num_clusters, K_CRITERIA,
+                        fit_pca, transform_pca)
+from ..memory import MB, ScratchSpace
+from ..raster_io import BLOCK_SIZE, aligned_window_rows, raster_metadata
+
+
+def write_raster(path, arrays):
+    """Write a list of 2D float arrays as the bands of a GeoTIFF."""
+    rows, cols = arrays[0].shape
+    dataset = gdal.GetDriverByName('GTiff').Create(path, cols, rows, len(arrays), gdal.GDT_Float32)
+    for i, array in enumerate(arrays, start=1):
+        dataset.GetRasterBand(i).WriteArray(array)
+    dataset.FlushCache()
+    dataset = None
+
+
+class ProcessSingleRasterTest(unittest.TestCase):
+    """Test classifying a whole raster."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.directory = tempfile.mkdtemp()
+        self.input = os.path.join(self.directory, 'input.tif')
+        rng = np.random.default_rng(0)
+        self.classes = rng.integers(0, 3, size=(60, 40))
+        write_raster(self.input, [
+            (self.classes * 50 + rng.normal(0, 2, self.classes.shape) + band).astype(np.float32)
+            for band in range(3)
+        ])
+        self.plugin = UnsupervisedClassifier.__new__(UnsupervisedClassifier)
+        self.plugin.iface = mock.Mock()
+        self.plugin.report_lines = []
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def classify(self, output, options):
+        """Classify the test raster with K-means into output."""
+        return self.plugin.process_single_raster(
+            self.input, output, 'Kmeans (Best Method)', 3, [1, 2, 3],
+            100, 0.5, 0.5, 1.0, 10, False, dict(options)
+        )
+
+    def read_labels(self, path):
+        """Read the first band of path."""
+        dataset = gdal.Open(path)
+        return dataset.GetRasterBand(1).ReadAsArray()
+
+    def test_cache_hit_does_not_read_input(self):
+        """A feature cache hit classifies without reading the input raster."""
+        options = {
+            'cache_enabled': True,
+            'cache_dir': os.path.join(self.directory, 'cache'),
+            'worker_threads': 2,
+        }
+        first = os.path.join(self.directory, 'first.tif')
+        second = os.path.join(self.directory, 'second.tif')
+        self.assertTrue(self.classify(first, options)[0])
+        
+        unreadable = mock.Mock(side_effect=AssertionError('input raster was read'))
+        with mock.patch.object(classify, 'read_feature_matrix', unreadable), \
+                mock.patch.object(classify, 'RasterWindowReader', unreadable):
+            success, msg = self.classify(second, options)
+        self.assertTrue(success, msg)
+        np.testing.assert_array_equal(self.read_labels(first), self.read_labels(second))
+
+    def test_stored_band_statistics_are_reused(self):
+        """A second run normalizes with the statistics stored by the first instead of computing them."""
+        path = os.path.join(self.directory, 'integer.tif')
+        dataset = gdal.GetDriverByName('GTiff').Create(path, 40, 60, 2, gdal.GDT_UInt16)
+        dataset.GetRasterBand(1).WriteArray((self.classes * 50).astype(np.uint16))
+        dataset.GetRasterBand(2).WriteArray(np.full((60, 40), 9, dtype=np.uint16))
+        dataset = None
+        output = os.path.join(self.directory, 'output.tif')
+        
+        def run():
+            return self.plugin.process_single_raster(
+                path, output, 'Kmeans (Best Method)', 3, [1, 2],
+                100, 0.5, 0.5, 1.0, 10, False, {'use_band_stats': True}
+            )
+        self.assertTrue(run()[0])
+        first = self.read_labels(output)
+        unreadable = mock.Mock(side_effect=AssertionError('statistics were computed'))
+        with mock.patch.object(classify, 'normalization_stats', unreadable):
+            success, msg = run()
+        self.assertTrue(success, msg)
+        np.testing.assert_array_equal(self.read_labels(output), first)
+
+    def run_batch(self, output, bands, options):
+        """Run the batch dialog flow on the test raster; returns how many rasters were classified."""
+        dlg = mock.Mock()
+        dlg.get_selected_rasters.return_value = [{'input': self.input, 'output': output, 'bands': bands}]
+        dlg.algorithmComboBox.currentText.return_value = 'Kmeans (Best Method)'
+        dlg.numClustersSpinBox.value.return_value = 3
+        dlg.maxIterSpinBox.value.return_value = 100
+        dlg.maxMergeDoubleSpinBox.value.return_value = 0.5
+        dlg.minSplitStdDoubleSpinBox.value.return_value = 0.5
+        dlg.maxStdDoubleSpinBox.value.return_value = 1.0
+        dlg.minSamplesSpinBox.value.return_value = 10
+        dlg.openInQgisCheckBox.isChecked.return_value = False
+        dlg.get_processing_options.return_value = dict(options)
+        dlg.metadataProber.probe_now.side_effect = raster_metadata
+        self.plugin.dlg = dlg
+        self.plugin.preview = None
+        with mock.patch.object(self.plugin, 'process_single_raster', wraps=self.plugin.process_single_raster) as run, \
+                mock.patch.object(classify, 'QMessageBox') as message_box:
+            self.plugin.run_clustering()
+        message_box.critical.assert_not_called()
+        return run.call_count
+
+    def test_unchanged_run_is_skipped(self):
+        """A second identical run is skipped; other options, bands or a modified input re-run."""
+        output = os.path.join(self.directory, 'output.tif')
+        options = {'skip_unchanged': True, 'use_band_stats': False}
+        self.assertEqual(self.run_batch(output, [1, 2, 3], options), 1)
+        self.assertEqual(self.run_batch(output, [1, 2, 3], options), 0)
+        
+        self.assertEqual(self.run_batch(output, [1, 2, 3], dict(options, use_band_stats=True)), 1)
+        self.assertEqual(self.run_batch(output, [3, 1], dict(options, use_band_stats=True)), 1)
+        self.assertEqual(self.run_batch(output, [3, 1], dict(options, use_band_stats=True)), 0)
+        mtime = os.stat(self.input).st_mtime_ns + 10 ** 9
+        os.utime(self.input, ns=(mtime, mtime))
+        self.assertEqual(self.run_batch(output, [3, 1], dict(options, use_band_stats=True)), 1)
+        
+        # Without skip_unchanged every run classifies
+        self.assertEqual(self.run_batch(output, [3, 1], dict(options, use_band_stats=True, skip_unchanged=False)), 1)
+
+
+class AssignLabelsTest(unittest.TestCase):
+    """Test the nearest-center kernel against pairwise distances."""
+
+    def check_nearest(self, data, centers, rtol):
+        """assign_labels picks a center as near as the one cdist picks."""
+        distances = cdist(data.astype(np.float64), centers.astype(np.float64))
+        expected = distances.argmin(axis=1)
+        labels = assign_labels(data, centers, chunk_size=997, n_threads=3)
+        rows = np.arange(data.shape[0])
+        np.testing.assert_allclose(distances[rows, labels], distances[rows, expected], rtol=rtol)
+        return labels, expected
+
+    def test_float64(self):
+        """Float64 labels match cdist exactly."""
+        rng = np.random.default_rng(1)
+        labels, expected = self.check_nearest(rng.normal(size=(5000, 4)), rng.normal(size=(8, 4)), 1e-12)
+        np.testing.assert_array_equal(labels, expected)
+
+    def test_float32(self):
+        """Float32 labels are nearest within single precision."""
+        rng = np.random.default_rng(2)
+        self.check_nearest(rng.normal(size=(5000, 6)).astype(np.float32),
+                           rng.normal(size=(12, 6)).astype(np.float32), 1e-4)
+
+    def test_large_k(self):
+        """Thousands of centers are handled in bounded chunks."""
+        rng = np.random.default_rng(3)
+        self.check_nearest(rng.normal(size=(3000, 5)), rng.normal(size=(2000, 5)), 1e-9)
+
+
+class OutputDtypeTest(unittest.TestCase):
+    """Test the choice of the output label type."""
+
+    def test_boundaries(self):
+        """The smallest type holding the largest label is chosen."""
+        self.assertEqual(output_dtype_for(255), (np.uint8, gdal.GDT_Byte))
+        self.assertEqual(output_dtype_for(256), (np.uint16, gdal.GDT_UInt16))
+        self.assertEqual(output_dtype_for(65535), (np.uint16, gdal.GDT_UInt16))
+        self.assertEqual(output_dtype_for(65536), (np.uint32, gdal.GDT_UInt32))
+
+    def test_too_many_classes(self):
+        """Labels beyond UInt32 are rejected."""
+        with self.assertRaises(ValueError):
+            output_dtype_for(2 ** 32)
+
+
+class PlanMemoryTest(unittest.TestCase):
+    """Test sizing runs to the memory budget."""
+
+    def test_out_of_core_switch(self):
+        """An inductive run over budget in memory switches to out-of-core scratch arrays."""
+        plan = plan_memory(5000, 5000, 8, 'Kmeans (Best Method)', 10, 1024 * MB)
+        self.assertTrue(plan['out_of_core'])
+        self.assertTrue(plan['fits'])
+        self.assertLessEqual(plan['peak_bytes'], 1024 * MB)
+        
+        plan = plan_memory(5000, 5000, 8, 'Kmeans (Best Method)', 10, 8192 * MB)
+        self.assertFalse(plan['out_of_core'])
+        self.assertTrue(plan['fits'])
+
+    def test_transductive_over_budget(self):
+        """Pairwise methods on a full scene do not fit and cannot go out of core."""
+        for method in ('Agglomerative Clustering', 'Spectral Clustering', 'DBSCAN'):
+            plan = plan_memory(1000, 1000, 4, method, 8, 4096 * MB)
+            self.assertFalse(plan['fits'])
+            self.assertFalse(plan['out_of_core'])
+            self.assertIn(method, plan['message'])
+        for method in ('Agglomerative Clustering', 'DBSCAN'):
+            self.assertTrue(plan_memory(100, 100, 4, method, 8, 4096 * MB)['fits'])
+
+    def test_window_rows(self):
+        """Windows grow with the budget and line up with the output tiles and input blocks."""
+        previous = 0
+        for budget_mb in (64, 256, 1024, 4096, 16384, 65536):
+            rows = plan_memory(20000, 10000, 4, 'Kmeans (Best Method)', 10, budget_mb * MB,
+                               input_block_rows=16)['window_rows']
+            self.assertGreaterEqual(rows, previous)
+            self.assertEqual(BLOCK_SIZE % rows, 0)
+            if rows >= 16:
+                self.assertEqual(rows % 16, 0)
+            previous = rows
+        self.assertEqual(previous, BLOCK_SIZE)
+        
+        rows = plan_memory(20000, 10000, 4, 'Kmeans (Best Method)', 10, 65536 * MB,
+                           input_block_rows=7, output_block_rows=1)['window_rows']
+        self.assertEqual(rows % 7, 0)
+
+    def test_aligned_window_rows(self):
+        """The largest height meeting both block constraints is chosen."""
+        self.assertEqual(aligned_window_rows(262, 512, 1), 256)
+        self.assertEqual(aligned_window_rows(600, 512, 16), 512)
+        self.assertEqual(aligned_window_rows(1024, 512, 1024), 1024)
+        self.assertEqual(aligned_window_rows(300, 1, 7), 294)
+        # No multiple of 3 divides 512: only the output is lined up
+        self.assertEqual(aligned_window_rows(100, 512, 3), 64)
+
+
+class StatisticsTest(unittest.TestCase):
+    """Test the chunked statistics and the in-place normalization."""
+
+    def setUp(self):
+        """Runs before each test."""
+        rng = np.random.default_rng(4)
+        self.raw = rng.normal(100, 20, size=(10000, 3))
+        self.raw[:, 2] = 7.0
+        self.labels = rng.integers(0, 6, size=10000)
+        self.scratch = ScratchSpace(enabled=True)
+
+    def tearDown(self):
+        """Runs after each test."""
+        self.scratch.close()
+
+    def memmap(self, array):
+        """Copy array to a memory-mapped scratch array."""
+        copy = self.scratch.empty(array.shape, array.dtype, 'test')
+        copy[:] = array
+        return copy
+
+    def check_cluster_statistics(self, data):
+        """cluster_statistics of data matches boolean-mask statistics of the raw values."""
+        counts, means, stds = cluster_statistics(data, self.labels, 7, chunk_size=999)
+        for label in range(6):
+            mask = self.labels == label
+            self.assertEqual(counts[label], mask.sum())
+            np.testing.assert_allclose(means[label], np.mean(self.raw[mask], axis=0), rtol=1e-12)
+            np.testing.assert_allclose(stds[label], np.std(self.raw[mask], axis=0), rtol=1e-9, atol=1e-12)
+        # A label without pixels
+        self.assertEqual(counts[6], 0)
+
+    def test_cluster_statistics(self):
+        """Per-label statistics match boolean-mask mean and std."""
+        self.check_cluster_statistics(self.raw)
+
+    def test_cluster_statistics_memmap(self):
+        """Memory-mapped scratch matrices give the same statistics."""
+        self.check_cluster_statistics(self.memmap(self.raw))
+
+    def check_fit_preprocessor(self, data, stats=None):
+        """fit_preprocessor of data matches the z-score of the raw values."""
+        preprocessor, normalized = fit_preprocessor(data, scratch=self.scratch, stats=stats)
+        std = np.std(self.raw, axis=0)
+        std[std == 0] = 1
+        expected = (self.raw - np.mean(self.raw, axis=0)) / std
+        np.testing.assert_allclose(normalized, expected, rtol=1e-9, atol=1e-12)
+        # Normalized in place
+        self.assertIs(normalized, data)
+        np.testing.assert_allclose(preprocessor.transform(self.raw[100:300].copy()), expected[100:300],
+                                   rtol=1e-9, atol=1e-12)
+
+    def test_fit_preprocessor(self):
+        """Normalization matches the z-score of np.mean and np.std, constant bands left at zero."""
+        self.check_fit_preprocessor(self.raw.copy())
+
+    def test_fit_preprocessor_memmap(self):
+        """A memory-mapped scratch matrix is normalized in place the same way."""
+        self.check_fit_preprocessor(self.memmap(self.raw))
+
+    def test_fit_preprocessor_stored_statistics(self):
+        """Stored statistics with a zero standard deviation give the same result."""
+        self.check_fit_preprocessor(self.raw.copy(), stats=(np.mean(self.raw, axis=0), np.std(self.raw, axis=0)))
+
+
+class SelectNumClustersTest(unittest.TestCase):
+    """Test choosing the number of clusters from a k sweep."""
+
+    def blobs(self, n_blobs):
+        """Well-separated isotropic blobs of 3-band pixels."""
+        rng = np.random.default_rng(5)
+        centers = np.array([[0, 0, 0], [10, 0, 0], [0, 10, 0], [0, 0, 10], [10, 10, 10]], dtype=float)
+        return centers[rng.integers(0, n_blobs, size=2000)] + rng.normal(0, 0.5, size=(2000, 3))
+
+    def test_known_k_is_chosen(self):
+        """Every criterion picks the number of blobs."""
+        for n_blobs in (4, 5):
+            data = self.blobs(n_blobs)
+            for criterion in K_CRITERIA:
+                sweep = select_num_clusters(data, k_min=2, k_max=7, criterion=criterion, n_jobs=2)
+                self.assertEqual(sweep['k'], n_blobs, criterion)
+                self.assertEqual(sweep['centers'].shape, (n_blobs, 3))
+                self.assertEqual([r['k'] for r in sweep['scores']], list(range(2, 8)))
+
+    def test_unknown_criterion(self):
+        """An unknown criterion is rejected."""
+        with self.assertRaises(ValueError):
+            select_num_clusters(self.blobs(4), criterion='gap')
+
+
+class PcaTest(unittest.TestCase):
+    """Test the sampled PCA fit and the chunked projection."""
+
+    def setUp(self):
+        """Runs before each test."""
+        rng = np.random.default_rng(6)
+        mixing = np.array([[3.0, 1.0, 0.5, 0.0], [0.0, 2.0, 0.5, 0.2], [0.0, 0.0, 1.0, 0.3],
+                           [0.0, 0.0, 0.0, 0.1]])
+        self.data = rng.normal(size=(5000, 4)) @ mixing + 50
+
+    def test_matches_svd(self):
+        """Components and explained variance match the SVD of the centred matrix."""
+        pca, n_keep = fit_pca(self.data, sample_size=len(self.data))
+        self.assertEqual(n_keep, 4)
+        centred = self.data - self.data.mean(axis=0)
+        _, singular_values, vt = np.linalg.svd(centred, full_matrices=False)
+        variance = singular_values ** 2 / (len(self.data) - 1)
+        np.testing.assert_allclose(pca.mean_, self.data.mean(axis=0), rtol=1e-9)
+        np.testing.assert_allclose(pca.explained_variance_, variance, rtol=1e-6)
+        np.testing.assert_allclose(pca.explained_variance_ratio_, variance / variance.sum(), rtol=1e-6)
+        # Components are defined up to their sign
+        signs = np.sign(np.sum(pca.components_ * vt, axis=1))
+        np.testing.assert_allclose(pca.components_ * signs[:, None], vt, atol=1e-6)
+
+    def test_components_kept(self):
+        """n_components caps the components kept; variance_threshold keeps the fewest reaching it."""
+        pca, n_keep = fit_pca(self.data, n_components=2, sample_size=len(self.data))
+        self.assertEqual(n_keep, 2)
+        pca, n_keep = fit_pca(self.data, variance_threshold=0.9, sample_size=len(self.data))
+        cumulative = np.cumsum(pca.explained_variance_ratio_)
+        self.assertGreaterEqual(cumulative[n_keep - 1], 0.9)
+        self.assertLess(cumulative[n_keep - 2], 0.9)
+
+    def test_chunked_transform(self):
+        """Projecting chunk by chunk into out matches the one-shot projection."""
+        pca, n_keep = fit_pca(self.data, n_components=3, sample_size=len(self.data))
+        components = pca.components_[:n_keep]
+        expected = (self.data - pca.mean_) @ components.T
+        out = np.empty((len(self.data), n_keep))
+        self.assertIs(transform_pca(self.data, components, pca.mean_, chunk_size=777, out=out), out)
+        np.testing.assert_allclose(out, expected, rtol=1e-12, atol=1e-9)
+        np.testing.assert_allclose(transform_pca(self.data, components, pca.mean_), expected,
+                                   rtol=1e-12, atol=1e-9)
+
+
+if __name__ == "__main__":
+    suite = unittest.TestSuite([
+        unittest.makeSuite(ProcessSingleRasterTest),
+        unittest.makeSuite(AssignLabelsTest),
+        unittest.makeSuite(OutputDtypeTest),
+        unittest.makeSuite(PlanMemoryTest),
+        unittest.makeSuite(StatisticsTest),
+        unittest.makeSuite(SelectNumClustersTest),
+        unittest.makeSuite(PcaTest),
+    ])
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
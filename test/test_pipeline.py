@@ -0,0 +1,135 @@
+# coding=utf-8
+"""Threaded pipeline test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'mirjanalisha@gmail.com'
+__date__ = '2026-10-19'
+__copyright__ = 'Copyright 2024, Mirjan Ali Sha'
+
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from ..pipeline import run_pipeline, map_row_chunks, Feedback, Cancelled
+
+
+class PipelineTestCase(unittest.TestCase):
+    """Check that no thread started by a test outlives it."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.threads = set(threading.enumerate())
+
+    def tearDown(self):
+        """Runs after each test."""
+        self.assertEqual(set(threading.enumerate()) - self.threads, set())
+
+
+class RunPipelineTest(PipelineTestCase):
+    """Test the read -> compute -> write pipeline."""
+
+    def test_matches_sequential_run(self):
+        """Every window is read, computed and written once, as in a sequential loop."""
+        windows = [(yoff, 3) for yoff in range(0, 300, 3)]
+
+        def read(window):
+            return np.arange(window[0], window[0] + window[1])
+
+        def compute(window, data):
+            return data * 2 + 1
+        expected = {window: compute(window, read(window)) for window in windows}
+
+        results = {}
+        def write(window, result):
+            self.assertNotIn(window, results)
+            results[window] = result
+        run_pipeline(windows, read, compute, write, n_workers=4, queue_size=2)
+
+        self.assertEqual(sorted(results), windows)
+        for window in windows:
+            np.testing.assert_array_equal(results[window], expected[window])
+
+    def test_first_error_is_reraised(self):
+        """The first exception of any stage stops the pipeline and is re-raised."""
+        def read(window):
+            if window == 50:
+                raise KeyError(window)
+            return window
+
+        def compute(window, data):
+            if window == 0:
+                raise ValueError('bad window')
+            return data
+
+        with self.assertRaisesRegex(ValueError, 'bad window'):
+            run_pipeline(range(100), read, compute, lambda window, result: None, n_workers=3)
+
+    def test_write_error_is_reraised(self):
+        """An exception raised by write on the calling thread is re-raised."""
+        def write(window, result):
+            raise OSError('disk full')
+
+        with self.assertRaisesRegex(OSError, 'disk full'):
+            run_pipeline(range(20), lambda window: window, lambda window, data: data, write, n_workers=2)
+
+    def test_cancel_stops_all_stages(self):
+        """Cancelling stops reading, computing and writing and raises Cancelled."""
+        feedback = Feedback()
+        read_windows = []
+
+        def read(window):
+            read_windows.append(window)
+            return window
+
+        def compute(window, data):
+            time.sleep(0.001)
+            return data
+
+        def write(window, result):
+            if window >= 5:
+                feedback.cancel()
+
+        with self.assertRaises(Cancelled):
+            run_pipeline(range(1000), read, compute, write, n_workers=2, feedback=feedback)
+        self.assertLess(len(read_windows), 1000)
+
+
+class MapRowChunksTest(PipelineTestCase):
+    """Test spreading row chunks over threads."""
+
+    def test_matches_sequential_run(self):
+        """Every row is handled exactly once, as in a sequential loop."""
+        data = np.arange(1000, dtype=np.float64)
+        out = np.zeros_like(data)
+        calls = np.zeros(data.shape[0], dtype=np.int64)
+
+        def double(rows):
+            out[rows] = data[rows] * 2
+            calls[rows] += 1
+        map_row_chunks(double, data.shape[0], 64, n_threads=4)
+
+        np.testing.assert_array_equal(out, data * 2)
+        np.testing.assert_array_equal(calls, 1)
+
+    def test_error_is_reraised(self):
+        """An exception raised for any chunk is re-raised."""
+        def fail(rows):
+            if rows.start == 512:
+                raise ValueError('bad chunk')
+
+        with self.assertRaisesRegex(ValueError, 'bad chunk'):
+            map_row_chunks(fail, 1000, 64, n_threads=4)
+
+
+if __name__ == "__main__":
+    suite = unittest.TestSuite([unittest.makeSuite(RunPipelineTest), unittest.makeSuite(MapRowChunksTest)])
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
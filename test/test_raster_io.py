@@ -0,0 +1,298 @@
+# coding=utf-8
+"""Raster input discovery and reading test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'mirjanalisha@gmail.com'
+__date__ = '2026-10-19'
+__copyright__ = 'Copyright 2024, Mirjan Ali Sha'
+
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import numpy as np
+from osgeo import gdal
+
+from .. import raster_io
+from ..raster_io import (find_rasters, build_mosaic, iter_windows, read_bands_into, read_feature_matrix,
+                         RasterWindowReader, band_statistics, store_band_statistics, ClassifiedRasterWriter,
+                         BLOCK_SIZE)
+
+
+class FindRastersTest(unittest.TestCase):
+    """Test finding the rasters of a folder by file name pattern."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.directory, 'tiles', 'north'))
+        for name in ('b.tif', 'A.TIF', 'notes.txt', os.path.join('tiles', 'c.tiff'),
+                     os.path.join('tiles', 'north', 'd_B4.jp2')):
+            open(os.path.join(self.directory, name), 'wb').close()
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def relative(self, paths):
+        return [os.path.relpath(path, self.directory) for path in paths]
+
+    def test_default_patterns(self):
+        """GeoTIFFs of the folder itself are found, case-insensitively and sorted."""
+        self.assertEqual(self.relative(find_rasters(self.directory)), ['A.TIF', 'b.tif'])
+
+    def test_recursive(self):
+        """Subfolders are searched with recursive."""
+        self.assertEqual(self.relative(find_rasters(self.directory, recursive=True)),
+                         ['A.TIF', 'b.tif', os.path.join('tiles', 'c.tiff')])
+
+    def test_custom_patterns(self):
+        """Patterns may be separated by spaces or semicolons."""
+        self.assertEqual(self.relative(find_rasters(self.directory, '*_b4.jp2; b*', recursive=True)),
+                         ['b.tif', os.path.join('tiles', 'north', 'd_B4.jp2')])
+
+
+class BuildMosaicTest(unittest.TestCase):
+    """Test building the VRT of a mosaic."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.directory = tempfile.mkdtemp()
+        self.tiles = [os.path.join(self.directory, f'tile_{i}.tif') for i in range(3)]
+        for i, path in enumerate(self.tiles):
+            dataset = gdal.GetDriverByName('GTiff').Create(path, 4, 4, 1, gdal.GDT_Byte)
+            dataset.SetGeoTransform((i * 4, 1, 0, 0, 0, -1))
+            dataset.GetRasterBand(1).WriteArray(np.full((4, 4), i, dtype=np.uint8))
+            dataset = None
+        self.vrt = os.path.join(self.directory, 'mosaic.vrt')
+        # Tiles older than any VRT built by the tests
+        for path in self.tiles:
+            os.utime(path, (1000000000, 1000000000))
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def build(self, tiles):
+        success, message = build_mosaic(self.vrt, tiles)
+        self.assertTrue(success, message)
+        return os.stat(self.vrt).st_mtime_ns
+
+    def test_unchanged_mosaic_is_kept(self):
+        """Rebuilding with the same, unmodified tiles leaves the VRT untouched."""
+        built = self.build(self.tiles)
+        os.utime(self.vrt, ns=(built - 10 ** 9, built - 10 ** 9))
+        self.assertEqual(self.build(list(reversed(self.tiles))), built - 10 ** 9)
+
+    def test_changed_tiles_rebuild(self):
+        """A different tile list or a modified tile rebuilds the VRT."""
+        built = self.build(self.tiles[:2])
+        os.utime(self.vrt, ns=(built - 10 ** 9, built - 10 ** 9))
+        self.assertNotEqual(self.build(self.tiles), built - 10 ** 9)
+        
+        os.utime(self.vrt, ns=(2 * 10 ** 18, 2 * 10 ** 18))
+        os.utime(self.tiles[0], ns=(3 * 10 ** 18, 3 * 10 ** 18))
+        self.assertNotEqual(self.build(self.tiles), 2 * 10 ** 18)
+
+
+class ReadBandsTest(unittest.TestCase):
+    """Test reading bands straight into pixel-interleaved feature matrices."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'bands.tif')
+        self.nrows, self.ncols = 50, 23
+        dataset = gdal.GetDriverByName('GTiff').Create(self.path, self.ncols, self.nrows, 4, gdal.GDT_UInt16,
+                                                       options=['TILED=YES', 'BLOCKXSIZE=16', 'BLOCKYSIZE=16'])
+        pixels = np.arange(self.nrows * self.ncols, dtype=np.uint16).reshape(self.nrows, self.ncols)
+        for band in range(1, 5):
+            dataset.GetRasterBand(band).WriteArray(pixels + band * 10000)
+        dataset = None
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def expected(self, bands, yoff=0, rows=None):
+        """The (pixels, bands) matrix of a strip, read band by band with ReadAsArray."""
+        rows = self.nrows - yoff if rows is None else rows
+        dataset = gdal.Open(self.path)
+        strips = [dataset.GetRasterBand(band).ReadAsArray(0, yoff, self.ncols, rows) for band in bands]
+        return np.stack(strips, axis=-1).reshape(-1, len(bands)).astype(np.float64)
+
+    def test_read_bands_into_window(self):
+        """Each band lands in its own column of the block, in the order asked for."""
+        dataset = gdal.Open(self.path)
+        for bands in ([1, 2, 3, 4], [3, 1]):
+            block = np.full((7 * self.ncols, len(bands)), -1.0)
+            self.assertIs(read_bands_into(dataset, bands, block, 10, 7, self.ncols), block)
+            np.testing.assert_array_equal(block, self.expected(bands, 10, 7))
+
+    def test_read_feature_matrix(self):
+        """Strips read on several threads fill an array or a memory map like a sequential read."""
+        memmap = np.memmap(os.path.join(self.directory, 'features.dat'), dtype=np.float32, mode='w+',
+                           shape=(self.nrows * self.ncols, 2))
+        with mock.patch.object(raster_io, 'READ_WINDOW_ROWS', 16):
+            for bands in ([1, 2, 3, 4], [3, 1]):
+                np.testing.assert_array_equal(read_feature_matrix(self.path, bands, n_threads=3),
+                                              self.expected(bands))
+            self.assertIs(read_feature_matrix(self.path, [3, 1], n_threads=3, out=memmap), memmap)
+        np.testing.assert_array_equal(memmap, self.expected([3, 1]))
+        del memmap
+
+    def test_window_reader(self):
+        """Windows read concurrently by RasterWindowReader match ReadAsArray."""
+        reader = RasterWindowReader(self.path, [3, 1])
+        windows = list(iter_windows(self.nrows, 16))
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            blocks = list(executor.map(lambda window: reader.read(*window), windows))
+        reader.close()
+        for (yoff, rows), block in zip(windows, blocks):
+            self.assertEqual(block.dtype, np.float64)
+            np.testing.assert_array_equal(block, self.expected([3, 1], yoff, rows))
+
+
+class BandStatisticsTest(unittest.TestCase):
+    """Test reusing and storing exact band statistics."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'bands.tif')
+        rng = np.random.default_rng(7)
+        self.pixels = [rng.integers(0, 1000, size=(30, 20)), np.full((30, 20), 7), np.zeros((30, 20))]
+        dataset = gdal.GetDriverByName('GTiff').Create(self.path, 20, 30, 3, gdal.GDT_UInt16)
+        for band, pixels in enumerate(self.pixels, start=1):
+            dataset.GetRasterBand(band).WriteArray(pixels.astype(np.uint16))
+        # An empty band: every pixel is nodata
+        dataset.GetRasterBand(3).SetNoDataValue(0)
+        dataset = None
+        self.aux = self.path + '.aux.xml'
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def store(self, bands):
+        """Store the exact statistics of bands, as the classification does."""
+        pixels = np.stack([self.pixels[band - 1].ravel() for band in bands], axis=-1).astype(np.float64)
+        store_band_statistics(self.path, bands, pixels.min(axis=0), pixels.max(axis=0), pixels.mean(axis=0),
+                              pixels.std(axis=0))
+
+    def test_stored_statistics_are_reused(self):
+        """Stored statistics are returned, a constant band with a zero deviation."""
+        self.assertIsNone(band_statistics(self.path, [1, 2]))
+        self.store([1, 2])
+        mean, std = band_statistics(self.path, [2, 1])
+        np.testing.assert_allclose(mean, [7, self.pixels[0].mean()], rtol=1e-9)
+        np.testing.assert_allclose(std, [0, self.pixels[0].std()], rtol=1e-9)
+        # Bands with a nodata value never use GDAL statistics, which skip nodata pixels
+        self.store([1, 2, 3])
+        self.assertIsNone(band_statistics(self.path, [1, 3]))
+
+    def test_approximate_statistics_are_ignored(self):
+        """Statistics flagged as approximate are not reused."""
+        dataset = gdal.Open(self.path)
+        band = dataset.GetRasterBand(1)
+        band.SetStatistics(0.0, 999.0, 500.0, 288.0)
+        band.SetMetadataItem('STATISTICS_APPROXIMATE', 'YES')
+        dataset = None
+        self.assertIsNone(band_statistics(self.path, [1]))
+
+    def test_stored_statistics_are_not_rewritten(self):
+        """Storing the statistics of a batch again leaves the .aux.xml file alone."""
+        self.store([1, 2, 3])
+        self.assertTrue(os.path.exists(self.aux))
+        os.utime(self.aux, ns=(10 ** 18, 10 ** 18))
+        self.store([1, 2, 3])
+        self.assertEqual(os.stat(self.aux).st_mtime_ns, 10 ** 18)
+
+
+class ClassifiedRasterWriterTest(unittest.TestCase):
+    """Test writing label rasters with the output profiles."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.directory = tempfile.mkdtemp()
+        self.output = os.path.join(self.directory, 'labels.tif')
+        self.nrows, self.ncols = 900, 1100
+        self.labels = (np.arange(self.nrows * self.ncols) % 7).reshape(self.nrows, self.ncols).astype(np.uint8)
+        self.geotransform = (100.0, 10.0, 0.0, 200.0, 0.0, -10.0)
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def writer(self, profile):
+        return ClassifiedRasterWriter(self.output, self.ncols, self.nrows, gdal.GDT_Byte, self.geotransform, '',
+                                      profile=profile)
+
+    def write(self, profile, metadata=None):
+        """Write the labels in BLOCK_SIZE-row strips and open the closed output."""
+        writer = self.writer(profile)
+        for yoff, rows in iter_windows(self.nrows, BLOCK_SIZE):
+            writer.write(self.labels[yoff:yoff + rows], 0, yoff)
+        writer.close(metadata=metadata)
+        dataset = gdal.Open(self.output)
+        self.assertIsNotNone(dataset)
+        np.testing.assert_array_equal(dataset.GetRasterBand(1).ReadAsArray(), self.labels)
+        self.assertEqual(tuple(dataset.GetGeoTransform()), self.geotransform)
+        return dataset
+
+    def test_tiled_profile(self):
+        """Tiled profiles write BLOCK_SIZE square tiles in place, with the metadata items."""
+        dataset = self.write('GeoTIFF (Tiled, DEFLATE)', metadata={'RUN_KEY': 'abc'})
+        self.assertEqual(list(dataset.GetRasterBand(1).GetBlockSize()), [BLOCK_SIZE, BLOCK_SIZE])
+        self.assertEqual(dataset.GetMetadataItem('RUN_KEY'), 'abc')
+        self.assertEqual(os.listdir(self.directory), ['labels.tif'])
+
+    def test_uncompressed_profile(self):
+        """The uncompressed profile writes full-width strips."""
+        dataset = self.write('GeoTIFF (Uncompressed)')
+        self.assertEqual(dataset.GetRasterBand(1).GetBlockSize()[0], self.ncols)
+
+    def test_cog_profile(self):
+        """COG profiles write a temporary tiled GeoTIFF and copy it, with overviews, on close."""
+        writer = self.writer('Cloud-Optimized GeoTIFF (Nearest Overviews)')
+        self.assertEqual(writer.target_file, self.output + '.tmp.tif')
+        self.assertTrue(os.path.exists(writer.target_file))
+        self.assertFalse(os.path.exists(self.output))
+        writer.abort()
+        
+        dataset = self.write('Cloud-Optimized GeoTIFF (Nearest Overviews)', metadata={'RUN_KEY': 'abc'})
+        band = dataset.GetRasterBand(1)
+        self.assertEqual(list(band.GetBlockSize()), [BLOCK_SIZE, BLOCK_SIZE])
+        self.assertGreater(band.GetOverviewCount(), 0)
+        self.assertEqual(dataset.GetMetadataItem('RUN_KEY'), 'abc')
+        self.assertEqual(os.listdir(self.directory), ['labels.tif'])
+
+    def test_unknown_profile_uses_default(self):
+        """An unknown profile name falls back to the default tiled profile."""
+        dataset = self.write('No such profile')
+        self.assertEqual(list(dataset.GetRasterBand(1).GetBlockSize()), [BLOCK_SIZE, BLOCK_SIZE])
+
+    def test_abort_removes_partial_output(self):
+        """Aborting a half-written output deletes it, including the temporary file of a COG."""
+        for profile in ('GeoTIFF (Tiled, DEFLATE)', 'Cloud-Optimized GeoTIFF (Mode Overviews)'):
+            writer = self.writer(profile)
+            writer.write(self.labels[:BLOCK_SIZE])
+            writer.abort()
+            self.assertEqual(os.listdir(self.directory), [], profile)
+
+
+if __name__ == "__main__":
+    suite = unittest.TestSuite([unittest.makeSuite(FindRastersTest), unittest.makeSuite(BuildMosaicTest),
+                                unittest.makeSuite(ReadBandsTest), unittest.makeSuite(BandStatisticsTest),
+                                unittest.makeSuite(ClassifiedRasterWriterTest)])
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
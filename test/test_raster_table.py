@@ -0,0 +1,157 @@
+# coding=utf-8
+"""Raster table model test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'mirjanalisha@gmail.com'
+__date__ = '2026-10-19'
+__copyright__ = 'Copyright 2024, Mirjan Ali Sha'
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from qgis.PyQt.QtCore import Qt
+
+from .. import classify_dialog
+from ..classify_dialog import RasterTableModel, MetadataProber
+
+
+class RasterTableModelTest(unittest.TestCase):
+    """Test the batch raster table model."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.directory = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(3):
+            path = os.path.join(self.directory, f'tile_{i}.tif')
+            open(path, 'wb').close()
+            self.paths.append(path)
+        self.model = RasterTableModel()
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_add_skips_duplicates_and_missing(self):
+        """Each existing path is added once."""
+        missing = os.path.join(self.directory, 'missing.tif')
+        self.assertEqual(self.model.add_rasters(self.paths + [self.paths[0], missing]), self.paths)
+        self.assertEqual(self.model.add_rasters(self.paths), [])
+        self.assertEqual(self.model.rowCount(), 3)
+        self.assertEqual(self.model.data(self.model.index(0, RasterTableModel.OUTPUT)),
+                         'tile_0_classified.tif')
+
+    def test_check_and_remove(self):
+        """Unchecked rows are kept, checked rows are removed with their band selections."""
+        self.model.add_rasters(self.paths)
+        self.model.set_metadata(self.paths[1], None)
+        self.model.set_all_checked(False)
+        self.model.setData(self.model.index(1, RasterTableModel.SELECT), Qt.Checked, Qt.CheckStateRole)
+        self.assertEqual([row['input'] for row in self.model.checked_rows()], [self.paths[1]])
+        self.assertEqual(self.model.remove_checked(), 1)
+        self.assertEqual(self.model.rowCount(), 2)
+        self.assertNotIn(self.paths[1], self.model.paths)
+        self.assertNotIn(self.paths[1], self.model.band_selections)
+        self.assertEqual(self.model.paths, {self.paths[0]: 0, self.paths[2]: 1})
+        self.assertEqual(self.model.add_rasters([self.paths[1]]), [self.paths[1]])
+
+    def test_metadata_selects_all_bands(self):
+        """Probed metadata selects every band unless bands were already chosen."""
+        self.model.add_rasters(self.paths)
+        index = self.model.index(0, RasterTableModel.BANDS)
+        self.assertEqual(self.model.data(index), 'Reading...')
+        metadata = {'band_count': 3, 'descriptions': ['Band 1', 'Band 2', 'Band 3'],
+                    'xsize': 10, 'ysize': 10, 'dtype': 'UInt16', 'nodata': [None] * 3}
+        self.model.set_metadata(self.paths[0], metadata)
+        self.assertEqual(self.model.band_selections[self.paths[0]], [1, 2, 3])
+        self.model.set_bands(0, [2])
+        self.model.set_metadata(self.paths[0], metadata)
+        self.assertEqual(self.model.band_selections[self.paths[0]], [2])
+        self.assertEqual(self.model.data(index), '1 bands ...')
+
+    def test_edit_output_name(self):
+        """The output name is editable but cannot be blank."""
+        self.model.add_rasters(self.paths)
+        index = self.model.index(0, RasterTableModel.OUTPUT)
+        self.assertTrue(self.model.setData(index, 'renamed.tif'))
+        self.assertFalse(self.model.setData(index, '  '))
+        self.assertEqual(self.model.rows[0]['output'], 'renamed.tif')
+
+
+class MetadataProberTest(unittest.TestCase):
+    """Test the background raster header prober."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.prober = MetadataProber(n_threads=1)
+        self.metadata = {'band_count': 3, 'xsize': 10, 'ysize': 10}
+        self.release = threading.Event()
+        self.probes = []
+
+    def tearDown(self):
+        """Runs after each test."""
+        self.release.set()
+        self.prober.executor.shutdown(wait=True)
+
+    def blocked_probe(self, path):
+        """Stand-in for raster_metadata that waits until the test releases it."""
+        self.probes.append(path)
+        self.release.wait(5)
+        return self.metadata
+
+    def test_cache_hits_are_emitted_straight_away(self):
+        """A cached path is reported from request itself, without probing it again."""
+        self.prober.cache['a.tif'] = self.metadata
+        probed = []
+        self.prober.probed.connect(lambda path, metadata: probed.append((path, metadata)))
+        unreadable = mock.Mock(side_effect=AssertionError('raster was probed'))
+        with mock.patch.object(classify_dialog, 'raster_metadata', unreadable):
+            self.prober.request(['a.tif'])
+        self.assertEqual(probed, [('a.tif', self.metadata)])
+
+    def test_pending_path_is_probed_once(self):
+        """Requesting a path again while its probe is pending does not queue another."""
+        with mock.patch.object(classify_dialog, 'raster_metadata', self.blocked_probe):
+            self.prober.request(['a.tif'])
+            self.prober.request(['a.tif'])
+            self.release.set()
+            self.prober.executor.shutdown(wait=True)
+        self.assertEqual(self.probes, ['a.tif'])
+        self.assertEqual(self.prober.get('a.tif'), self.metadata)
+        self.assertEqual(self.prober.pending, set())
+
+    def test_probe_now_fills_cache(self):
+        """probe_now reads an uncached path once and serves it from the cache after."""
+        with mock.patch.object(classify_dialog, 'raster_metadata', self.blocked_probe):
+            self.release.set()
+            self.assertEqual(self.prober.probe_now('a.tif'), self.metadata)
+            self.assertEqual(self.prober.probe_now('a.tif'), self.metadata)
+        self.assertEqual(self.probes, ['a.tif'])
+        self.assertEqual(self.prober.get('a.tif'), self.metadata)
+
+    def test_shutdown_drops_queued_probes(self):
+        """Probes still queued at shutdown never run."""
+        with mock.patch.object(classify_dialog, 'raster_metadata', self.blocked_probe):
+            self.prober.request(['a.tif', 'b.tif', 'c.tif'])
+            while not self.probes:
+                self.release.wait(0.01)
+            self.prober.shutdown()
+            self.release.set()
+            self.prober.executor.shutdown(wait=True)
+        self.assertEqual(self.probes, ['a.tif'])
+
+
+if __name__ == "__main__":
+    suite = unittest.TestSuite([unittest.makeSuite(RasterTableModelTest), unittest.makeSuite(MetadataProberTest)])
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)